@@ -0,0 +1,420 @@
+import datetime
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+from xml.sax.saxutils import quoteattr
+
+
+# search parameters of the mock server: resourceType -> {parameter: reference element}
+SEARCH_PARAMS = {
+    "Encounter": {"subject": "subject", "patient": "subject"},
+    "MedicationStatement": {"subject": "subject", "patient": "subject",
+                            "encounter": "context", "context": "context",
+                            "medication": "medicationReference"},
+    "MedicationAdministration": {"subject": "subject", "patient": "subject",
+                                 "encounter": "context", "context": "context",
+                                 "medication": "medicationReference"},
+    "MedicationRequest": {"subject": "subject", "patient": "subject",
+                          "encounter": "encounter", "medication": "medicationReference"}
+}
+
+
+class Store():
+    """in-memory resources of the mock server with indices for the supported
+    reference searches"""
+
+    def __init__(self, resources=None):
+        self.resources = {}
+        self.index = {}
+        self.lock = threading.Lock()
+        for resource in resources or []:
+            self.put(resource)
+
+    def put(self, resource):
+        res_type = resource["resourceType"]
+        with self.lock:
+            self.resources.setdefault(res_type, {})[resource["id"]] = resource
+            for param, element in SEARCH_PARAMS.get(res_type, {}).items():
+                reference = (resource.get(element) or {}).get("reference")
+                if reference is not None:
+                    key = (res_type, param, reference.split("/")[-1])
+                    self.index.setdefault(key, {})[resource["id"]] = resource
+
+    def search(self, res_type, query):
+        ids = query.get("_id")
+        if ids is not None:
+            found = self.resources.get(res_type, {})
+            result = [found[i] for i in ids.split(",") if i in found]
+        else:
+            result = None
+            for param, value in query.items():
+                if res_type == "Patient" and param in ("_has:Encounter:patient:_id", "encounter"):
+                    # the patient of an encounter
+                    encounter = self.resources.get("Encounter", {}).get(value, {})
+                    patient = encounter.get("subject", {}).get("reference", "").split("/")[-1]
+                    patient = self.resources.get("Patient", {}).get(patient)
+                    matches = [patient] if patient is not None else []
+                elif param in SEARCH_PARAMS.get(res_type, {}):
+                    matches = list(self.index.get((res_type, param, value), {}).values())
+                else:
+                    continue
+                if result is None:
+                    result = matches
+                else:
+                    keep = {r["id"] for r in matches}
+                    result = [r for r in result if r["id"] in keep]
+            if result is None:
+                result = list(self.resources.get(res_type, {}).values())
+
+        if "_lastUpdated" in query:
+            value = query["_lastUpdated"]
+            prefix, stamp = value[:2], _instant(value[2:])
+            updated = [(r, _instant(r.get("meta", {}).get("lastUpdated"))) for r in result]
+            if prefix == "gt":
+                result = [r for r, t in updated if t is not None and t > stamp]
+            elif prefix == "ge":
+                result = [r for r, t in updated if t is not None and t >= stamp]
+
+        return result
+
+
+class MockFHIRServer():
+    """A local stand-in FHIR server for benchmarks.
+    Supports reads of searchsets with paging links (_count, _offset), _id
+    (comma-separated), reference searches (see SEARCH_PARAMS), the KDS
+    Patient search ?_has:Encounter:patient:_id=, _summary=true, _elements,
+    _include, _revinclude and _include:iterate on the reference parameters
+    (unless includes is False, then they are ignored like by servers
+    without include support; see /metadata) and transaction/batch bundles
+    (also gzip-compressed) posted or put to the base. Responses to reads carry
+    an ETag and If-None-Match is answered with 304 Not Modified.
+    Every request can be delayed by latency seconds and answered with a 503
+    with probability error_rate. With max_concurrent, requests beyond that
+    many concurrent ones are answered with a 429 and Retry-After.
+    Attributes
+    --------------
+    store : Store
+        the server's resources
+    latency : float
+        delay of every response in seconds
+    error_rate : float
+        probability of a 503 response
+    page_size : int
+        default _count
+    includes : bool
+        if False, _include and _revinclude are ignored
+    max_concurrent : int
+        maximum number of requests served at the same time, None for no limit
+    retry_after : int
+        Retry-After (seconds) of the 429 responses
+    Methods
+    --------------
+    start(), stop()
+        runs the server in a background thread
+    url
+        the server's FHIR-base incl. trailing "/"
+    stats()
+        returns the number of requests per method and the bytes sent and
+        received, also served at /_stats (and reset by /_reset)
+    """
+
+    def __init__(self, resources=None, latency=0.0, error_rate=0.0, page_size=50,
+                 host="127.0.0.1", port=0, seed=0, includes=True, max_concurrent=None, retry_after=1):
+        self.store = Store(resources)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.includes = includes
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.active = 0
+        self.random = random.Random(seed)
+        self.counts = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{0}:{1}/".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {"requests": dict(self.counts),
+                    "bytes_sent": self.bytes_sent,
+                    "bytes_received": self.bytes_received}
+
+    def reset_stats(self):
+        with self._lock:
+            self.counts = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def _count(self, method, sent, received):
+        with self._lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/_stats":
+                    self._reply(200, server.stats())
+                elif self.path == "/_reset":
+                    server.reset_stats()
+                    self._reply(200, {})
+                else:
+                    self._serve("GET", b"")
+
+            def _reply(self, status, payload, headers=(), received=None):
+                # the request is counted (unless received is None) before
+                # the response is sent, so clients see it in the stats
+                query = parse_qs(urlsplit(self.path).query)
+                xml = "xml" in query.get("_format", [""])[0] or "xml" in self.headers.get("Accept", "")
+                data = _xml(payload) if xml else json.dumps(payload).encode("utf-8")
+                if status == 200 and self.command == "GET":
+                    etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+                    headers = list(headers) + [("ETag", etag)]
+                    if self.headers.get("If-None-Match") == etag:
+                        if received is not None:
+                            server._count(self.command, 0, received)
+                        self.send_response(304)
+                        for header in headers:
+                            self.send_header(*header)
+                        self.end_headers()
+                        return b""
+                if received is not None:
+                    server._count(self.command, len(data), received)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/fhir+" + ("xml" if xml else "json") + "; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                self.wfile.write(data)
+                return data
+
+            def do_POST(self):
+                self._serve("POST", self._body())
+
+            def do_PUT(self):
+                self._serve("PUT", self._body())
+
+            def _body(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                return body
+
+            def _serve(self, method, body):
+                with server._lock:
+                    server.active += 1
+                    overloaded = server.max_concurrent is not None and server.active > server.max_concurrent
+                try:
+                    if overloaded:
+                        self._reply(429, _outcome("Too many requests (injected)"),
+                                    [("Retry-After", str(server.retry_after))], len(body))
+                        return
+                    self._respond(method, body)
+                finally:
+                    with server._lock:
+                        server.active -= 1
+
+            def _respond(self, method, body):
+                if server.latency:
+                    time.sleep(server.latency)
+                with server._lock:
+                    failed = server.error_rate and server.random.random() < server.error_rate
+                if failed:
+                    status, payload = 503, _outcome("Service unavailable (injected)")
+                elif method == "GET":
+                    status, payload = server._get(self.path)
+                else:
+                    status, payload = server._transaction(body)
+                self._reply(status, payload, [("Retry-After", "0")] if failed else [], len(body))
+
+        return Handler
+
+    def _get(self, path):
+        parts = urlsplit(path)
+        params = parse_qs(parts.query)
+        query = {k: v[0] for k, v in params.items()}
+        segments = [s for s in parts.path.split("/") if s]
+        if segments == ["metadata"]:
+            return 200, self._capability_statement()
+        if segments and segments[-1][:1].isupper():
+            res_type = segments[-1]
+        elif len(segments) >= 2 and segments[-2][:1].isupper():
+            # read: /Type/id
+            resource = self.store.resources.get(segments[-2], {}).get(segments[-1])
+            if resource is None:
+                return 404, _outcome("Not found")
+            return 200, resource
+        else:
+            return 400, _outcome("No resource type given")
+
+        result = self.store.search(res_type, query)
+        count = int(query.get("_count", self.page_size))
+        offset = int(query.get("_offset", 0))
+        page = result[offset:offset + count]
+        if query.get("_summary") == "true":
+            page = [{"resourceType": r["resourceType"], "id": r["id"], "meta": r.get("meta", {})} for r in page]
+        elif "_elements" in query:
+            keep = {"resourceType", "id", "meta"} | set(query["_elements"].split(","))
+            page = [{k: v for k, v in r.items() if k in keep} for r in page]
+        bundle = {"resourceType": "Bundle", "type": "searchset", "total": len(result),
+                  "link": [{"relation": "self", "url": self.url + path.lstrip("/")}]}
+        if offset + count < len(result):
+            next_query = dict(params, _offset=[str(offset + count)], _count=[str(count)])
+            bundle["link"].append({"relation": "next",
+                                   "url": self.url + res_type + "?" + urlencode(next_query, doseq=True, safe=":,")})
+        if page:
+            bundle["entry"] = [{"fullUrl": self.url + r["resourceType"] + "/" + r["id"],
+                                "resource": r,
+                                "search": {"mode": "match"}} for r in page]
+            if self.includes:
+                bundle["entry"].extend({"fullUrl": self.url + r["resourceType"] + "/" + r["id"],
+                                        "resource": r,
+                                        "search": {"mode": "include"}} for r in self._included(page, params))
+        return 200, bundle
+
+    def _included(self, page, params):
+        """returns the resources of _include, _revinclude and
+        _include:iterate for a page of matches"""
+        found = {}
+
+        def include(resources, values):
+            for value in values:
+                res_type, _, param = value.partition(":")
+                element = SEARCH_PARAMS.get(res_type, {}).get(param)
+                for r in resources:
+                    if element is None or r["resourceType"] != res_type:
+                        continue
+                    target_type, _, target_id = (r.get(element) or {}).get("reference", "").partition("/")
+                    target = self.store.resources.get(target_type, {}).get(target_id)
+                    if target is not None:
+                        found[(target_type, target_id)] = target
+
+        include(page, params.get("_include", []))
+        for value in params.get("_revinclude", []):
+            res_type, _, param = value.partition(":")
+            for r in page:
+                for match in self.store.index.get((res_type, param, r["id"]), {}).values():
+                    found[(res_type, match["id"])] = match
+        include(list(found.values()), params.get("_include:iterate", []))
+        matches = {(r["resourceType"], r["id"]) for r in page}
+
+        return [r for key, r in found.items() if key not in matches]
+
+    def _capability_statement(self):
+        resources = []
+        for res_type, params in sorted(SEARCH_PARAMS.items()):
+            resources.append({
+                "type": res_type,
+                "searchInclude": [res_type + ":" + p for p in params] if self.includes else [],
+                "searchRevInclude": [r + ":" + p for r, ps in sorted(SEARCH_PARAMS.items())
+                                     for p in ps if self.includes]
+            })
+        return {"resourceType": "CapabilityStatement", "status": "active", "kind": "instance",
+                "fhirVersion": "4.0.1", "format": ["json"],
+                "rest": [{"mode": "server", "resource": resources}]}
+
+    def _transaction(self, body):
+        try:
+            bundle = json.loads(body)
+        except ValueError:
+            return 400, _outcome("Invalid json")
+        entries = []
+        for entry in bundle.get("entry") or []:
+            resource = entry.get("resource")
+            if resource is not None and "id" in resource:
+                self.store.put(resource)
+            entries.append({"response": {"status": "200 OK"}})
+        return 200, {"resourceType": "Bundle", "type": "transaction-response", "entry": entries}
+
+
+def _instant(value):
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _xml(resource):
+    """FHIR XML of a resource, as far as the mock server's resources need it"""
+    parts = []
+    _xml_resource(resource, parts, ' xmlns="http://hl7.org/fhir"')
+    return ('<?xml version="1.0" encoding="UTF-8"?>' + "".join(parts)).encode("utf-8")
+
+
+def _xml_resource(resource, parts, attributes=""):
+    parts.append("<" + resource["resourceType"] + attributes + ">")
+    _xml_elements(resource, parts, ())
+    parts.append("</" + resource["resourceType"] + ">")
+
+
+def _xml_elements(data, parts, attributes):
+    for key, value in data.items():
+        if key == "resourceType" or key in attributes or key.startswith("_"):
+            continue
+        if key == "div":
+            # the narrative is xhtml already
+            parts.append(value)
+            continue
+        items = value if isinstance(value, list) else [value]
+        # id and extensions of primitives are kept in "_" + key
+        extras = data.get("_" + key)
+        extras = extras if isinstance(extras, list) else [extras] * len(items)
+        for item, extra in zip(items, extras):
+            if isinstance(item, dict) and "resourceType" in item:
+                parts.append("<" + key + ">")
+                _xml_resource(item, parts)
+                parts.append("</" + key + ">")
+            elif isinstance(item, dict):
+                # id and (extension) url of elements are attributes
+                names = [name for name in ("id", "url") if isinstance(item.get(name), str)]
+                parts.append("<" + key + "".join(" " + name + "=" + quoteattr(item[name]) for name in names) + ">")
+                _xml_elements(item, parts, names)
+                parts.append("</" + key + ">")
+            else:
+                text = ("true" if item else "false") if isinstance(item, bool) else str(item)
+                extra = extra or {}
+                parts.append("<" + key + (" id=" + quoteattr(extra["id"]) if "id" in extra else "") +
+                             ("" if item is None else " value=" + quoteattr(text)))
+                if "extension" in extra:
+                    parts.append(">")
+                    _xml_elements({"extension": extra["extension"]}, parts, ())
+                    parts.append("</" + key + ">")
+                else:
+                    parts.append("/>")
+
+
+def _outcome(text):
+    return {"resourceType": "OperationOutcome",
+            "issue": [{"severity": "error", "code": "processing", "details": {"text": text}}]}
@@ -0,0 +1,270 @@
+"""Offline benchmarks of the transfer pipeline against local mock FHIR servers.
+
+Runs Loader.getRecord, Utils.link_search, Connector.connect (with a worker
+pool and staged) and AsyncConnector.connect for the
+"ID Logik" and "KDS" profiles on synthetic data and reports encounters (or
+resources) per second, requests and KB downloaded per encounter and peak
+memory, e.g.:
+
+    python benchmarks/run.py --patients 50 --latency 0.005 --workers 4
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import tracemalloc
+import urllib.request
+from timeit import default_timer as timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# the package of this checkout, also if it isn't installed
+sys.path.insert(0, ROOT)
+
+from mockserver import MockFHIRServer  # noqa: E402
+import synthetic  # noqa: E402
+from fhirutils.loader import Loader, Connector  # noqa: E402
+from fhirutils.aio import AsyncConnector  # noqa: E402
+from fhirutils.utils import Utils  # noqa: E402
+from fhirutils.transport import Transport  # noqa: E402
+from fhirutils.httpcache import HTTPCache  # noqa: E402
+from fhirutils.ratelimit import RateLimiter  # noqa: E402
+
+
+CONFIG_PATH = os.path.join(ROOT, "config.json")
+
+PROFILES = {
+    "ID Logik": ["Encounter", "Patient", "MedicationStatement", "Medication"],
+    "KDS": ["Encounter", "Patient", "MedicationStatement", "MedicationAdministration", "Medication"]
+}
+
+
+def serve(data_options, server_options, pipe):
+    """runs a mock server in a child process, sends its url through pipe"""
+    resources = synthetic.generate(**data_options) if data_options is not None else []
+    server = MockFHIRServer(resources, **server_options).start()
+    pipe.send(server.url)
+    pipe.recv()  # blocks until the parent asks to stop
+    server.stop()
+
+
+class ServerProcess():
+    def __init__(self, data_options, server_options):
+        self.pipe, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve,
+                                               args=(data_options, server_options, child),
+                                               daemon=True)
+        self.process.start()
+        self.url = self.pipe.recv()
+
+    def stats(self):
+        with urllib.request.urlopen(self.url + "_stats") as response:
+            return json.loads(response.read())
+
+    def reset(self):
+        urllib.request.urlopen(self.url + "_reset").read()
+
+    def stop(self):
+        self.pipe.send("stop")
+        self.process.join()
+
+
+def measure(func):
+    """runs func, returns (result, seconds, peak memory in MB)"""
+    tracemalloc.start()
+    start = timer()
+    try:
+        result = func()
+    finally:
+        seconds = timer() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, seconds, peak / 1024 ** 2
+
+
+def requests_of(*servers):
+    return sum(sum(server.stats()["requests"].values()) for server in servers)
+
+
+def bench_get_record(source, encounters, profile, count, include, cachepath=None, form="json"):
+    transport = Transport(cache=HTTPCache(cachepath)) if cachepath is not None else None
+    loader = Loader(fhirbase=source.url, verbose=0, include=include, transport=transport)
+
+    def run():
+        for enc in encounters:
+            loader.getRecord(enc, PROFILES[profile], CONFIG_PATH, profile, count=count, form=form)
+
+    return run
+
+
+def bench_link_search(source, count):
+    utils = Utils()
+
+    def run():
+        return sum(1 for _ in utils.iter_link_search(source.url + "MedicationStatement?_count=" + str(count)))
+
+    return run
+
+
+def bench_connect(source, destination, encounters, profile, count, workers, include, pool="thread", adaptive=False):
+    connector = Connector(fhirbase_source=source.url,
+                          fhirbase_destination=destination.url,
+                          enc_no_lst=encounters,
+                          verbose=0,
+                          include=include,
+                          transport=Transport(limiter=RateLimiter()) if adaptive else None)
+
+    def run():
+        return connector.connect(PROFILES[profile], CONFIG_PATH, profile,
+                                 method="POST", count=count, workers=workers, pool=pool)
+
+    return run
+
+
+def bench_connect_async(source, destination, encounters, profile, count, in_flight, include, adaptive=False):
+    connector = AsyncConnector(fhirbase_source=source.url,
+                               fhirbase_destination=destination.url,
+                               enc_no_lst=encounters,
+                               verbose=0,
+                               include=include,
+                               transport=Transport(limiter=RateLimiter()) if adaptive else None)
+
+    def run():
+        try:
+            return asyncio.run(connector.connect(PROFILES[profile], CONFIG_PATH, profile,
+                                                 method="POST", count=count, max_in_flight=in_flight))
+        finally:
+            connector.close()
+
+    return run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=30)
+    parser.add_argument("--encounters-per-patient", type=int, default=3)
+    parser.add_argument("--statements", type=int, default=10, help="MedicationStatements per encounter")
+    parser.add_argument("--administrations", type=int, default=5, help="MedicationAdministrations per encounter")
+    parser.add_argument("--medications", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="response delay of the mock servers in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of injected 503 responses")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--max-concurrent", type=int,
+                        help="the mock servers answer requests beyond this many concurrent ones with 429")
+    parser.add_argument("--count", type=int, default=100, help="_count of the Loader's searches")
+    parser.add_argument("--workers", type=int, default=1, help="Connector.connect workers")
+    parser.add_argument("--in-flight", type=int, default=20, help="AsyncConnector.connect max_in_flight")
+    parser.add_argument("--include", action="store_true", help="combine searches via _include (see planner.py)")
+    parser.add_argument("--cache", action="store_true",
+                        help="also rerun getRecord with a warm HTTPCache (revalidated via ETag)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="connect with a RateLimiter (adaptive concurrency, Retry-After)")
+    parser.add_argument("--xml", action="store_true", help="also measure getRecord with XML responses")
+    parser.add_argument("--profiles", nargs="+", default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    data_options = {
+        "patients": args.patients,
+        "encounters_per_patient": args.encounters_per_patient,
+        "statements_per_encounter": args.statements,
+        "administrations_per_encounter": args.administrations,
+        "medications": args.medications
+    }
+    server_options = {"latency": args.latency, "error_rate": args.error_rate, "page_size": args.page_size,
+                      "max_concurrent": args.max_concurrent}
+    encounters = ["enc-{0}-{1}".format(p, e)
+                  for p in range(args.patients)
+                  for e in range(args.encounters_per_patient)]
+
+    # keeps the logfiles of the runs out of the working directory
+    os.chdir(tempfile.mkdtemp(prefix="fhirutils-bench-"))
+    source = ServerProcess(data_options, server_options)
+    results = []
+    try:
+        for profile in args.profiles:
+            scenarios = [
+                ("getRecord", bench_get_record(source, encounters, profile, args.count, args.include), None),
+                ("connect", None, None),
+                ("connect_staged", None, None),
+                ("connect_async", None, None)
+            ]
+            if args.xml:
+                scenarios.insert(1, ("getRecord_xml",
+                                     bench_get_record(source, encounters, profile, args.count, args.include, form="xml"),
+                                     None))
+            if args.cache:
+                cachepath = os.path.join(os.getcwd(), profile.replace(" ", "_") + ".cache.db")
+                # the first run fills the cache, the measured one revalidates
+                bench_get_record(source, encounters, profile, args.count, args.include, cachepath)()
+                scenarios.insert(1, ("getRecord_cached",
+                                     bench_get_record(source, encounters, profile, args.count, args.include, cachepath),
+                                     None))
+            for name, run, destination in scenarios:
+                if name == "connect":
+                    destination = ServerProcess(None, server_options)
+                    run = bench_connect(source, destination, encounters, profile, args.count, args.workers, args.include,
+                                        adaptive=args.adaptive)
+                elif name == "connect_staged":
+                    destination = ServerProcess(None, server_options)
+                    run = bench_connect(source, destination, encounters, profile, args.count, args.workers, args.include,
+                                        pool="staged", adaptive=args.adaptive)
+                elif name == "connect_async":
+                    destination = ServerProcess(None, server_options)
+                    run = bench_connect_async(source, destination, encounters, profile, args.count, args.in_flight,
+                                              args.include, adaptive=args.adaptive)
+                source.reset()
+                result, seconds, peak = measure(run)
+                servers = [source] + ([destination] if destination is not None else [])
+                results.append({
+                    "scenario": name,
+                    "profile": profile,
+                    "encounters": len(encounters),
+                    "seconds": seconds,
+                    "encounters_per_second": len(encounters) / seconds,
+                    "requests_per_encounter": requests_of(*servers) / len(encounters),
+                    "kb_per_encounter": sum(server.stats()["bytes_sent"] for server in servers) / 1024 / len(encounters),
+                    "failed": len(result) if isinstance(result, list) else 0,
+                    "peak_memory_mb": peak
+                })
+                if destination is not None:
+                    destination.stop()
+
+        source.reset()
+        found, seconds, peak = measure(bench_link_search(source, args.page_size))
+        results.append({
+            "scenario": "link_search",
+            "profile": "",
+            "resources": found,
+            "seconds": seconds,
+            "resources_per_second": found / seconds,
+            "requests": requests_of(source),
+            "kb_per_resource": source.stats()["bytes_sent"] / 1024 / max(found, 1),
+            "peak_memory_mb": peak
+        })
+    finally:
+        source.stop()
+
+    print("{0:<16} {1:<9} {2:>9} {3:>12} {4:>10} {5:>10} {6:>7} {7:>10}".format(
+        "scenario", "profile", "seconds", "items/s", "req/item", "KB/item", "failed", "peak MB"))
+    for r in results:
+        items = r.get("encounters", r.get("resources"))
+        rate = r.get("encounters_per_second", r.get("resources_per_second"))
+        per_item = r["requests_per_encounter"] if "requests_per_encounter" in r else r["requests"] / max(items, 1)
+        kb = r.get("kb_per_encounter", r.get("kb_per_resource", 0.0))
+        print("{0:<16} {1:<9} {2:>9.2f} {3:>12.1f} {4:>10.2f} {5:>10.2f} {6:>7} {7:>10.1f}".format(
+            r["scenario"], r["profile"], r["seconds"], rate, per_item, kb, r.get("failed", 0), r["peak_memory_mb"]))
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"options": vars(args), "results": results}, f, indent=2)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
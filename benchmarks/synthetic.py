@@ -0,0 +1,84 @@
+import random
+
+
+def generate(patients=100,
+             encounters_per_patient=3,
+             statements_per_encounter=10,
+             administrations_per_encounter=5,
+             medications=200,
+             unresolvable_rate=0.01,
+             seed=0):
+    """returns a list of synthetic FHIR resources: Patients, Encounters,
+    Medications, MedicationStatements and MedicationAdministrations.
+    Statements and administrations refer to their patient (subject), their
+    encounter (context) and a random medication; a share of unresolvable_rate
+    statements has the non-resolvable reference "Medication/?"."""
+    rnd = random.Random(seed)
+    resources = []
+    families = ["Müller", "Schmidt", "Schneider", "Fischer", "Weber", "Meyer", "Wagner", "Becker"]
+    given = ["Jürgen", "Käthe", "Anna", "Lukas", "Sören", "Maria", "Björn", "Lena"]
+
+    for m in range(medications):
+        resources.append({
+            "resourceType": "Medication",
+            "id": "med-{0}".format(m),
+            "meta": {"lastUpdated": _stamp(rnd)},
+            "code": {"coding": [{"system": "http://fhir.de/CodeSystem/bfarm/atc",
+                                 "code": "A{0:02d}BC{1:02d}".format(m % 100, m % 37)}]}
+        })
+
+    for p in range(patients):
+        patient_id = "pat-{0}".format(p)
+        resources.append({
+            "resourceType": "Patient",
+            "id": patient_id,
+            "meta": {"lastUpdated": _stamp(rnd)},
+            "name": [{"family": rnd.choice(families), "given": [rnd.choice(given)]}],
+            "gender": rnd.choice(["male", "female"]),
+            "birthDate": "19{0:02d}-0{1}-1{2}".format(rnd.randint(30, 99), rnd.randint(1, 9), rnd.randint(0, 9))
+        })
+        for e in range(encounters_per_patient):
+            encounter_id = "enc-{0}-{1}".format(p, e)
+            resources.append({
+                "resourceType": "Encounter",
+                "id": encounter_id,
+                "meta": {"lastUpdated": _stamp(rnd)},
+                "status": "finished",
+                "class": {"code": "IMP"},
+                "subject": {"reference": "Patient/" + patient_id}
+            })
+            for s in range(statements_per_encounter):
+                if rnd.random() < unresolvable_rate:
+                    medication = "Medication/?"
+                else:
+                    medication = "Medication/med-{0}".format(rnd.randrange(medications))
+                resources.append({
+                    "resourceType": "MedicationStatement",
+                    "id": "ms-{0}-{1}-{2}".format(p, e, s),
+                    "meta": {"lastUpdated": _stamp(rnd)},
+                    "status": "active",
+                    "subject": {"reference": "Patient/" + patient_id},
+                    "context": {"reference": "Encounter/" + encounter_id},
+                    "medicationReference": {"reference": medication}
+                })
+            for a in range(administrations_per_encounter):
+                resources.append({
+                    "resourceType": "MedicationAdministration",
+                    "id": "ma-{0}-{1}-{2}".format(p, e, a),
+                    "meta": {"lastUpdated": _stamp(rnd)},
+                    "status": "completed",
+                    "subject": {"reference": "Patient/" + patient_id},
+                    "context": {"reference": "Encounter/" + encounter_id},
+                    "medicationReference": {"reference": "Medication/med-{0}".format(rnd.randrange(medications))},
+                    "effectiveDateTime": "2021-01-0{0}T08:00:00+01:00".format(rnd.randint(1, 9))
+                })
+
+    return resources
+
+
+def encounter_ids(resources):
+    return [r["id"] for r in resources if r["resourceType"] == "Encounter"]
+
+
+def _stamp(rnd):
+    return "2021-0{0}-1{1}T12:00:00+01:00".format(rnd.randint(1, 9), rnd.randint(0, 9))
@@ -0,0 +1,653 @@
+"""asyncio front end of Loader and Connector.
+
+AsyncLoader downloads the independent searches of a record concurrently
+(the latency of a record is about that of its slowest search instead of the
+sum of all searches) and AsyncConnector keeps many records in flight in a
+single process. The HTTP requests are still sent by the (blocking) Transport,
+on a thread pool; the number of concurrent requests per server is limited.
+
+    connector = AsyncConnector(fhirbase_source, fhirbase_destination, enc_no_lst)
+    failed = asyncio.run(connector.connect(req_resources, config_path, profile))
+"""
+
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from .loader import Loader, Connector
+from .planner import search_url
+from .upload import BundleUploader
+from .utils import Progress, compile_path, next_link, id_chunks
+from . import serialization
+
+
+# error state of the record the current task works on, see AsyncConnector
+_record = contextvars.ContextVar("record", default=None)
+
+
+class ErrorStatus():
+    """descriptor for the errorstatus (and warningstatus) attribute of
+    AsyncLoader and AsyncConnector. Within AsyncConnector.transfer() it is
+    the error state of the transferred record (shared by all tasks working
+    on that record), otherwise a plain attribute."""
+
+    def __init__(self, key="error"):
+        self.key = key
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        state = _record.get()
+        if state is None:
+            return obj.__dict__.get("_" + self.key + "status", False)
+        return state.get(self.key, False)
+
+    def __set__(self, obj, value):
+        state = _record.get()
+        if state is None:
+            obj.__dict__["_" + self.key + "status"] = value
+        else:
+            state[self.key] = value
+
+
+class HostLimiter():
+    """Limits the number of concurrent requests per server (scheme + host).
+    Usage: async with limiter(url): ...
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphores = {}
+        self._loop = None
+
+    def __call__(self, url):
+        # semaphores belong to an event loop, e.g. one asyncio.run()
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._semaphores = {}
+            self._loop = loop
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.limit)
+            self._semaphores[key] = semaphore
+        return semaphore
+
+
+class AsyncLoader(Loader):
+    """Loader whose download methods are coroutines.
+    getRecord() validates the encounter and resolves its patient, then runs
+    the planned searches (incl. their pages) concurrently and finally
+    downloads the referenced medications in concurrent batches.
+    Patient-scoped searches and medication batches that are already running
+    for another encounter are awaited instead of being sent again.
+    Attributes
+    --------------
+    max_per_host : int
+        maximum number of concurrent requests per server, defaults to the
+        transport's pool_size
+    executor : ThreadPoolExecutor
+        runs the blocking requests, created if not given
+    see Loader for the other attributes
+    Methods
+    --------------
+    getRecord(enc_no, req_resources, config_path, profile, savepath,
+              destinationfile, count, form, pretty, output, compress)
+        coroutine, returns the bundle of an encounter or None if the
+        encounter is invalid
+    fetch(url, form)
+        coroutine, sends a GET request, returns (response, parsed json)
+    resolveEncounters(enc_no_lst, form)
+        coroutine, see Loader.resolveEncounters, the batches run concurrently
+    groupByPatient(enc_no_lst, config_path, profile, form)
+        coroutine, see Loader.groupByPatient
+    close()
+        shuts the executor down
+    """
+
+    errorstatus = ErrorStatus()
+    warningstatus = ErrorStatus("warning")
+
+    def __init__(self, fhirbase=None, logpath=None, max_per_host=None, executor=None, **kwargs):
+        super().__init__(fhirbase=fhirbase, logpath=logpath, **kwargs)
+        if max_per_host is None:
+            max_per_host = self.transport.pool_size
+        self.max_per_host = max_per_host
+        self.limiter = HostLimiter(max_per_host)
+        # source and destination
+        self.executor = executor if executor is not None else \
+            ThreadPoolExecutor(max_workers=2 * max_per_host, thread_name_prefix="aio")
+        self._inflight = {}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def requestError(self, search_url, error):
+        """reports a request that failed after its retries (e.g. a timeout)"""
+        errormsg = "Download Error: " + search_url + ": " + type(error).__name__ + " " + str(error)
+        self.errorstatus = True
+        if self.verbose > 0:
+            print(errormsg)
+        self.writeLogmsg(errormsg)
+
+    async def run_blocking(self, url, func, *args):
+        """runs func(*args) on the executor, counted against url's server"""
+        async with self.limiter(url):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def fetch(self, url, form="json"):
+        if self.verbose > 0:
+            print(url)
+
+        def get():
+            req = self.transport.get(url)
+            json_data = serialization.loads_response(req) if req.ok else None
+            return req, json_data
+
+        return await self.run_blocking(url, get)
+
+    async def getRecord(self,
+                        enc_no,
+                        req_resources,
+                        config_path,
+                        profile,
+                        savepath=None,
+                        destinationfile=None,
+                        count=100,
+                        form="json",
+                        pretty=False,
+                        output=None,
+                        compress=False):
+        enc_id = enc_no
+        res_dict = self.loadConfig(config_path, profile)
+        plan = self._plans.get((profile, tuple(req_resources)))
+        if plan is None:
+            # may download the CapabilityStatement
+            plan = await self.run_blocking(self.fhirbase, self.getPlan, res_dict, profile, req_resources)
+
+        checks = []
+        if enc_id not in self.valid_encounters:
+            checks.append(self.checkValidEncounter([enc_id]))
+        if enc_id not in self.encounter_index and plan.needs_patient:
+            checks.append(self.getPatientNumber([enc_id], res_dict, form))
+        with self.metrics.timer("validate_encounter"):
+            results = await asyncio.gather(*checks)
+        if enc_id not in self.valid_encounters and not results.pop(0):
+            self.invalidEncounter(enc_id)
+            return None
+        pat_id = None
+        if enc_id in self.encounter_index:
+            pat_id = self.encounter_index[enc_id]
+        elif results and results[0] is not None:
+            pat_id = results[0][0]
+
+        writer = None
+        if savepath is not None and output is not None:
+            writer = self.openWriter(savepath, destinationfile, output, compress, pretty, form)
+        try:
+            found = {}
+            med_id_lst = []
+            results = await asyncio.gather(*(self.runStep(step, enc_id, pat_id, form, count,
+                                                          self.pageSink(step, found, med_id_lst, writer))
+                                             for step in plan.steps))
+            for step, result in zip(plan.steps, results):
+                self.collectStep(step, result, found, med_id_lst, writer)
+            fallbacks = [step for resource, step in plan.fallbacks.items() if not found.get(resource)]
+            results = await asyncio.gather(*(self.runStep(step, enc_id, pat_id, form, count,
+                                                          self.pageSink(step, found, med_id_lst, writer))
+                                             for step in fallbacks))
+            for step, result in zip(fallbacks, results):
+                self.collectStep(step, result, found, med_id_lst, writer)
+
+            medications = []
+            if plan.medications:
+                with self.metrics.timer("medication"):
+                    included = self.includedMedications(found, medications)
+                    medications.extend(await self.getMedicationResources(
+                        [med for med in med_id_lst if med not in included], form))
+
+            res_lst = self.assembleRecord(enc_id, plan, found, medications, writer)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if pat_id is not None:
+            self.releasePatient(pat_id, req_resources)
+
+        if writer is not None:
+            self.printSaved(writer.path)
+            return writer.path
+
+        with self.metrics.timer("bundle"):
+            bundle = self.utils.create_bundle(res_lst=res_lst, btype="transaction", form=form)
+
+        if savepath is not None:
+            self.saveBundle(bundle, savepath, destinationfile, pretty)
+
+        return bundle
+
+    async def runStep(self, step, enc_id, pat_id, form="json", count=100, sink=None):
+        """runs a planned search, patient-scoped searches are served from
+        patient_cache or shared with a running search (so they are never
+        passed to sink, collectStep() gets their whole result); without a
+        patient id they aren't run"""
+        url = search_url(self.fhirbase, step, enc_id, pat_id, form, count)
+        if step.code != "patient_id":
+            with self.metrics.timer("search." + step.resource):
+                return await self.searchResources(step.resource, url, form, sink)
+
+        if pat_id is None:
+            self.unresolvedPatient(enc_id, step.resource)
+            return None
+        key = (pat_id, step.resource)
+        result = self.patient_cache.get(key)
+        if result is not None:
+            return result
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._searchPatientScoped(key, step.resource, url, form))
+            self._inflight[key] = task
+        # the search is shared by the records of the patient, its errors are
+        # errors of every record awaiting it
+        result, error = await asyncio.shield(task)
+        if error:
+            self.errorstatus = True
+        return result
+
+    async def _searchPatientScoped(self, key, resource, search_url, form):
+        """returns the result of a shared search and whether it reported
+        errors, these aren't charged to the record that started it"""
+        state = {"error": False}
+        _record.set(state)
+        try:
+            with self.metrics.timer("search." + resource):
+                try:
+                    result = await self.searchResources(resource, search_url, form)
+                except requests.RequestException as e:
+                    self.requestError(search_url, e)
+                    result = None
+            if result is not None:
+                self.patient_cache.put(key, result)
+            return result, state["error"]
+        finally:
+            del self._inflight[key]
+
+    async def searchResources(self, resource, search_url, form="json", sink=None):
+        entries = []
+        med_ids = []
+        while search_url is not None:
+            req, json_data = await self.fetch(search_url, form)
+            if not self.printRequestsMessage(req, search_url):
+                return None
+            if json_data is None:
+                break
+            self.extractEntries(resource, json_data, entries, med_ids)
+            if sink is not None:
+                sink(entries)
+                entries = []
+            search_url = next_link(json_data)
+
+        return entries, med_ids
+
+    async def resolveEncounters(self, enc_no_lst, form="json"):
+        todo = [enc for enc in dict.fromkeys(enc_no_lst) if enc not in self.valid_encounters]
+        chunks = list(id_chunks(todo, self.enc_batch_size))
+        found = await asyncio.gather(*(self._resolveEncounterBatch(chunk, form) for chunk in chunks))
+
+        return [enc
+                for chunk, found_chunk in zip(chunks, found) if found_chunk is not None
+                for enc in chunk if enc not in found_chunk]
+
+    async def _resolveEncounterBatch(self, chunk, form):
+        found = set()
+        search_url = self.encounterBatchUrl(chunk)
+        while search_url is not None:
+            try:
+                req, json_data = await self.fetch(search_url, form)
+            except requests.RequestException as e:
+                # validated one by one by getRecord()
+                self.requestError(search_url, e)
+                return None
+            if not self.printRequestsMessage(req, search_url) or json_data is None:
+                return None
+            self.indexEncounters(json_data, found)
+            search_url = next_link(json_data)
+
+        return found
+
+    async def groupByPatient(self, enc_no_lst, config_path, profile, form="json"):
+        res_dict = self.loadConfig(config_path, profile)
+        unknown = [enc for enc in enc_no_lst if enc not in self.encounter_index]
+        patients = dict(zip(unknown, await asyncio.gather(*(self.getPatientNumber([enc], res_dict, form)
+                                                            for enc in unknown))))
+        groups = {}
+        for enc in enc_no_lst:
+            if enc in self.encounter_index:
+                pat_no = [self.encounter_index[enc]]
+            else:
+                pat_no = patients[enc]
+            groups.setdefault(pat_no[0] if pat_no else None, []).append(enc)
+
+        return groups
+
+    async def getPatientNumber(self, enc_no, res_dict, form="json"):
+        search_url = self.fhirbase + "Patient" + res_dict["Patient"][0] + enc_no[0]
+        try:
+            req, json_data = await self.fetch(search_url, form)
+        except requests.RequestException as e:
+            self.requestError(search_url, e)
+            return None
+        if not req.ok:
+            self.printRequestsMessage(req, search_url)
+            return None
+        pat_no = None
+        try:
+            for item in json_data["entry"]:
+                pat_no = item["resource"]["id"]
+            return [pat_no]
+        except (KeyError, TypeError):
+            msg = "Warning: Encounter ID " + \
+                enc_no[0] + \
+                " -> Requested resource (Patient): No resource found"
+            print(msg)
+            self.warningstatus = True
+            self.writeLogmsg(msg)
+
+    async def checkValidEncounter(self, enc_no):
+        search_url = self.fhirbase + "Encounter?_id=" + enc_no[0]
+        req, json_data = await self.fetch(search_url)
+        errormsg = "Encounter identifier validation failed."
+        if not self.printRequestsMessage(req, search_url):
+            self.writeLogmsg(errormsg)
+            return False
+        if json_data["total"] > 0:
+            return True
+        self.writeLogmsg(errormsg)
+        return False
+
+    async def getMedicationResources(self, med_id_lst, form="json"):
+        """returns the medications of med_id_lst, served from medication_cache,
+        shared with running batches of other records or downloaded in
+        concurrent batches"""
+        res_lst = []
+        missing = []
+        tasks = {}
+        for med in med_id_lst:
+            item = self.medication_cache.get(med)
+            if item is not None:
+                res_lst.append(item)
+            elif ("Medication", med) in self._inflight:
+                tasks[med] = self._inflight[("Medication", med)]
+            else:
+                missing.append(med)
+
+        for chunk in id_chunks(missing, self.med_batch_size):
+            task = asyncio.ensure_future(self._getMedicationBatch(chunk, form))
+            for med in chunk:
+                self._inflight[("Medication", med)] = task
+                tasks[med] = task
+
+        for med, task in tasks.items():
+            # batches are shared by records, their errors are errors of every
+            # record awaiting them
+            found, error = await asyncio.shield(task)
+            if error:
+                self.errorstatus = True
+            if med in found:
+                res_lst.append(found[med])
+            else:
+                self.warningstatus = True
+
+        return res_lst
+
+    async def _getMedicationBatch(self, chunk, form):
+        """returns the medications of a shared batch found by id and whether
+        it reported errors, these are charged by getMedicationResources() to
+        every awaiting record"""
+        state = {"error": False}
+        _record.set(state)
+        found = {}
+        search_url = self.fhirbase + "Medication?_id=" + ",".join(chunk) + \
+            "&_count=" + str(len(chunk))
+        try:
+            while search_url is not None:
+                try:
+                    req, json_data = await self.fetch(search_url, form)
+                except requests.RequestException as e:
+                    self.requestError(search_url, e)
+                    break
+                if not self.printRequestsMessage(req, search_url) or json_data is None:
+                    break
+                for item in self.pipeline.process(json_data.get("entry", [])):
+                    med = compile_path("resource.id").first(item)
+                    self.medication_cache.put(med, item)
+                    found[med] = item
+                search_url = next_link(json_data)
+        finally:
+            for med in chunk:
+                del self._inflight[("Medication", med)]
+
+        for med in chunk:
+            if med not in found:
+                msg = "Warning: Medication ID " + \
+                    med + \
+                    " -> Requested resource (Medication): No resource found"
+                if self.logpath is not None:
+                    self.writeLogmsg(msg)
+
+        return found, state["error"]
+
+
+class AsyncConnector(Connector):
+    """Connector that transfers up to max_in_flight records concurrently
+    within one process, see AsyncLoader. Every record has its own error
+    state. Incremental matching (incr) and the sync state work as in
+    Connector.
+    Attributes
+    --------------
+    max_per_host : int
+        maximum number of concurrent requests per server (source and
+        destination each), defaults to the transport's pool_size
+    see Connector for the other attributes
+    Methods
+    --------------
+    connect(req_resources, config_path, profile, method, count, form,
+            max_in_flight, ...)
+        coroutine, transfers every encounter in enc_no_lst, returns the list
+        of encounter ids whose transfer reported errors
+    upload_record(enc_no, req_resources, config_path, profile, method, count, form, ...)
+        coroutine, downloads a single encounter's record and uploads it
+    sync(req_resources, config_path, profile, method, count, form, overlap, ...)
+        coroutine, see Connector.sync()
+    close()
+        shuts the loader's executor down
+    """
+
+    errorstatus = ErrorStatus()
+
+    def __init__(self, fhirbase_source=None, fhirbase_destination=None, enc_no_lst=None,
+                 max_per_host=None, **kwargs):
+        super().__init__(fhirbase_source=fhirbase_source,
+                         fhirbase_destination=fhirbase_destination,
+                         enc_no_lst=enc_no_lst,
+                         **kwargs)
+        self.loader = AsyncLoader(fhirbase=self.fhirbase_source,
+                                  logpath=self.logpath,
+                                  verbose=self.verbose,
+                                  transport=self.transport,
+                                  medication_cache=self.loader.medication_cache,
+                                  pipeline=self.loader.pipeline,
+                                  include=self.loader.include,
+                                  revinclude=self.loader.revinclude,
+                                  max_per_host=max_per_host)
+        self.max_per_host = self.loader.max_per_host
+
+    def close(self):
+        self.loader.close()
+
+    async def connect(self,
+                      req_resources,
+                      config_path,
+                      profile,
+                      method="PUT",
+                      count=100,
+                      form="json",
+                      max_in_flight=50,
+                      max_entries=None,
+                      max_bytes=None,
+                      compress=False,
+                      upload_workers=1,
+                      metrics_path=None,
+                      metrics_format="json",
+                      metrics_interval=None):
+        """see Connector.connect(), max_in_flight is the number of records
+        that are transferred concurrently (instead of workers and pool)"""
+        args = (req_resources, config_path, profile)
+        kwargs = {"method": method,
+                  "count": count,
+                  "form": form,
+                  "max_entries": max_entries,
+                  "max_bytes": max_bytes,
+                  "compress": compress,
+                  "upload_workers": upload_workers}
+        progress = Progress(len(self.enc_no_lst))
+        failed = []
+
+        enc_no_lst = await self.resolve_encounters(progress, failed, form)
+        groups = await self.group_encounters(req_resources, config_path, profile, form, enc_no_lst)
+
+        def pending():
+            for pat, encs in groups:
+                if pat is not None:
+                    self.loader.registerPatient(pat, encs)
+                yield from encs
+        encounters = pending()
+
+        async def worker():
+            # the workers share one iterator, next() doesn't yield control
+            for enc in encounters:
+                error = await self.transfer(enc, *args, **kwargs)
+                self.finish(enc, error, progress, failed)
+
+        if metrics_path is not None and metrics_interval is not None:
+            self.metrics.start_export(metrics_path, metrics_format, metrics_interval)
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, max_in_flight))))
+        finally:
+            if self.syncstate is not None:
+                self.syncstate.commit()
+            if self.log is not None:
+                self.log.flush()
+            if metrics_path is not None:
+                self.metrics.stop_export()
+                self.metrics.export(metrics_path, metrics_format)
+
+        if self.verbose > 0:
+            print("Rules: " + self.loader.pipeline.summary())
+            if self.fingerprints is not None:
+                print("Unchanged resources skipped: " + str(self.fingerprints.skipped))
+
+        return failed
+
+    async def sync(self,
+                   req_resources,
+                   config_path,
+                   profile,
+                   method="PUT",
+                   count=100,
+                   form="json",
+                   overlap=300,
+                   **kwargs):
+        """see Connector.sync(), kwargs are options of connect()"""
+        watermarks = self._sync_start(req_resources, config_path, profile, method)
+        new_mark, scan = await self.loader.run_blocking(self.fhirbase_source, self._scan_changes,
+                                                        watermarks, count, form, overlap)
+        if new_mark is None:
+            return list(self._requested)
+        if scan is not None and scan.patients:
+            await self.loader.resolveEncounters(self._requested, form)
+        self.enc_no_lst = self._sync_encounters(scan)
+
+        failed = await self.connect(req_resources, config_path, profile, method=method, count=count, form=form, **kwargs)
+        medications_ok = scan is None or not scan.medications or \
+            await self.loader.run_blocking(self.fhirbase_destination, self.upload_medications,
+                                           scan.medications, kwargs)
+        self._sync_finish(profile, watermarks, new_mark, failed, medications_ok)
+
+        return failed
+
+    async def resolve_encounters(self, progress, failed, form="json"):
+        with self.metrics.timer("validate_encounter"):
+            invalid = await self.loader.resolveEncounters(self.enc_no_lst, form)
+        self.invalid_encounters = invalid
+        self.report_invalid(invalid, progress, failed)
+        invalid = set(invalid)
+
+        return [enc for enc in self.enc_no_lst if enc not in invalid]
+
+    async def group_encounters(self, req_resources, config_path, profile, form="json", enc_no_lst=None):
+        if enc_no_lst is None:
+            enc_no_lst = self.enc_no_lst
+        res_dict = self.loader.loadConfig(config_path, profile)
+        if not any(res_dict[r][1][0] == "patient_id" for r in req_resources if r in res_dict):
+            return [(self.loader.encounter_index.get(enc), [enc]) for enc in enc_no_lst]
+
+        groups = await self.loader.groupByPatient(enc_no_lst, config_path, profile, form)
+        unresolved = groups.pop(None, [])
+
+        return list(groups.items()) + [(None, [enc]) for enc in unresolved]
+
+    async def transfer(self, enc_no, *args, **kwargs):
+        # a fresh error state for this record, seen by every task the
+        # record's download spawns
+        _record.set({"error": False})
+        try:
+            await self.upload_record(enc_no, *args, **kwargs)
+        except requests.RequestException as e:
+            # a request of this record failed after its retries, shared
+            # searches report their errors to every awaiting record instead
+            self.report_error(enc_no, e)
+
+        return self.errorstatus
+
+    async def upload_record(self,
+                            enc_no,
+                            req_resources,
+                            config_path,
+                            profile,
+                            method="PUT",
+                            count=100,
+                            form="json",
+                            max_entries=None,
+                            max_bytes=None,
+                            compress=False,
+                            upload_workers=1):
+        with self.metrics.timer("download"):
+            bundle = await self.loader.getRecord(enc_no,
+                                                 req_resources,
+                                                 config_path,
+                                                 profile,
+                                                 count=count,
+                                                 form=form)
+        if bundle is None:
+            return []
+
+        if self.debug_path is not None:
+            serialization.dump(bundle, self.debug_path)
+
+        uploader = BundleUploader(self.transport,
+                                  self.fhirbase_destination,
+                                  method=method,
+                                  max_entries=max_entries,
+                                  max_bytes=max_bytes,
+                                  compress=compress,
+                                  workers=upload_workers,
+                                  fingerprints=self.fingerprints)
+        with self.metrics.timer("upload"):
+            results = await self.loader.run_blocking(self.fhirbase_destination, uploader.upload, bundle)
+
+        self.report_upload(enc_no, results)
+
+        return results
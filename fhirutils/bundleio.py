@@ -0,0 +1,282 @@
+"""Streaming output and input of bundles.
+
+A BundleWriter writes bundle entries to disk one at a time, so a record
+doesn't have to be kept in memory (and serialized as a whole) to be saved.
+Two layouts are written:
+- "json": one bundle file, {"resourceType": "Bundle", ..., "entry": [...]}
+- "ndjson": a directory with one file per resource type (<type>.ndjson),
+  one resource per line as in FHIR bulk data exports. Only the resources
+  are written, the entries' other fields (e.g. request) are left out.
+Both can be gzip-compressed (.json.gz resp. <type>.ndjson.gz).
+
+iter_bundle() reads both layouts (and FHIR XML bundles, *.xml) back entry
+by entry. A json bundle is parsed one entry at a time from a buffered
+stream of the file, so memory is bounded by the largest entry, not by the
+file.
+"""
+
+import codecs
+import gzip
+import json
+import os
+from . import serialization
+from . import xmlio
+
+
+# bytes read from a bundle file at a time
+CHUNK_SIZE = 1024 ** 2
+
+_WHITESPACE = " \t\n\r"
+
+
+def _open(path, mode, compress):
+    if compress:
+        return gzip.open(path, mode, compresslevel=6) if "w" in mode else gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _is_gzip(path):
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+class BundleWriter():
+    """Writes bundle entries to a file resp. directory as they arrive, see
+    module docstring. Use it as context manager or call close(), a json
+    bundle is only complete after close().
+    Attributes
+    --------------
+    path : str
+        the bundle file (output "json") resp. the directory of the ndjson
+        files (output "ndjson", created if missing, ndjson files already in
+        it are removed)
+    output : str
+        "json" or "ndjson"
+    compress : bool
+        gzip-compress the files, default: True if path ends with ".gz"
+    bundle : dict
+        the bundle's fields except entry (e.g. from Utils.create_bundle()),
+        default {"resourceType": "Bundle", "type": "transaction"}
+    pretty : bool
+        if True a json bundle is indented, else compact (default)
+    count : int
+        number of entries written
+    counts : dict
+        resource type -> number of entries written
+    Methods
+    --------------
+    write(entry)
+        writes a bundle entry ({"resource": ...})
+    write_all(entries)
+        writes every entry of an iterable
+    close()
+        completes and closes the file(s)
+    """
+
+    def __init__(self, path, output="json", compress=None, bundle=None, pretty=False):
+        if output not in ("json", "ndjson"):
+            raise ValueError("output must be 'json' or 'ndjson', not " + repr(output))
+        self.path = path
+        self.output = output
+        self.compress = compress if compress is not None else str(path).endswith(".gz")
+        self.bundle = bundle if bundle is not None else {"resourceType": "Bundle", "type": "transaction"}
+        self.pretty = pretty
+        self.count = 0
+        self.counts = {}
+        self._files = {}
+        self._closed = False
+        if output == "json":
+            self._files[None] = _open(path, "wb", self.compress)
+            self._write_header()
+        else:
+            os.makedirs(path, exist_ok=True)
+            # like a bundle file, the ndjson files of a previous record are replaced
+            for name in os.listdir(path):
+                if name.endswith((".ndjson", ".ndjson.gz")):
+                    os.remove(os.path.join(path, name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _write_header(self):
+        header = {key: value for key, value in self.bundle.items() if key != "entry"}
+        data = serialization.dumps(header, pretty=self.pretty)
+        # the header without its closing brace, followed by the entry array
+        data = data.rstrip()[:-1].rstrip()
+        if header:
+            data += b","
+        self._files[None].write(data + (b'\n  "entry": [' if self.pretty else b'"entry":['))
+
+    def write(self, entry):
+        resource = entry.get("resource") or {}
+        resource_type = resource.get("resourceType")
+        if self.output == "json":
+            data = serialization.dumps(entry, pretty=self.pretty)
+            if self.pretty:
+                # json strings contain no raw line breaks, indent every line
+                data = b"\n    " + data.replace(b"\n", b"\n    ")
+            self._files[None].write((b"," if self.count else b"") + data)
+        else:
+            f = self._files.get(resource_type)
+            if f is None:
+                name = (resource_type or "Unknown") + ".ndjson" + (".gz" if self.compress else "")
+                f = _open(os.path.join(self.path, name), "wb", self.compress)
+                self._files[resource_type] = f
+            f.write(serialization.dumps(resource) + b"\n")
+        self.count += 1
+        self.counts[resource_type] = self.counts.get(resource_type, 0) + 1
+
+    def write_all(self, entries):
+        for entry in entries:
+            self.write(entry)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.output == "json":
+            self._files[None].write(b"\n  ]\n}\n" if self.pretty else b"]}")
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+def iter_bundle(path, resource_type=None, chunk_size=CHUNK_SIZE):
+    """yields the entries ({"resource": ...}) of a json bundle file, an
+    ndjson file, a directory of ndjson files or an XML bundle file (*.xml),
+    gzip-compressed or not. If
+    resource_type is given, only entries of resources of this type (str or
+    collection of str) are yielded."""
+    if isinstance(resource_type, str):
+        resource_type = (resource_type,)
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            base = name[:-3] if name.endswith(".gz") else name
+            if not base.endswith(".ndjson"):
+                continue
+            if resource_type is not None and base[:-len(".ndjson")] not in resource_type:
+                continue
+            yield from _filter(_iter_ndjson(os.path.join(path, name)), resource_type)
+        return
+    base = path[:-3] if path.endswith(".gz") else path
+    if base.endswith(".ndjson"):
+        yield from _filter(_iter_ndjson(path), resource_type)
+    elif base.endswith(".xml"):
+        with _open(path, "rb", _is_gzip(path)) as f:
+            yield from _filter(xmlio.iter_entries(f), resource_type)
+    else:
+        yield from _filter(_iter_json_entries(path, chunk_size), resource_type)
+
+
+def _filter(entries, resource_type):
+    for entry in entries:
+        if resource_type is None or (entry.get("resource") or {}).get("resourceType") in resource_type:
+            yield entry
+
+
+def _iter_ndjson(path):
+    with _open(path, "rb", _is_gzip(path)) as f:
+        for line in f:
+            if line.strip():
+                yield {"resource": serialization.loads(line)}
+
+
+def _iter_json_entries(path, chunk_size):
+    """yields the elements of the top level "entry" array of a json bundle;
+    the other fields of the bundle are parsed and skipped"""
+    with _open(path, "rb", _is_gzip(path)) as f:
+        reader = _JSONReader(f, chunk_size)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key == "entry" and reader.peek() == "[":
+                reader.expect("[")
+                if reader.peek() != "]":
+                    while True:
+                        yield reader.value()
+                        if reader.separator("]"):
+                            break
+                else:
+                    reader.expect("]")
+            else:
+                reader.value()
+            if reader.separator("}"):
+                return
+
+
+class _JSONReader():
+    """Incremental parser of a json document from a binary file: values are
+    parsed one at a time with json.JSONDecoder.raw_decode() from a buffer
+    that is refilled from the file as needed"""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._start = True
+
+    def _fill(self, size=None):
+        if self.eof:
+            return False
+        data = self.f.read(size or self.chunk_size)
+        self.eof = not data
+        # an incremental decoder keeps multibyte characters split by a chunk
+        text = self._decoder.decode(data, final=self.eof)
+        if self._start:
+            self._start = False
+            text = text.lstrip("\ufeff")
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of the bundle")
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("expected " + repr(char) + " at offset " + str(self.pos) + ", found " + repr(found))
+        self.pos += 1
+
+    def separator(self, closing):
+        """consumes "," (returns False) or closing (returns True)"""
+        if self.peek() == closing:
+            self.pos += 1
+            return True
+        self.expect(",")
+        return False
+
+    def value(self):
+        self.peek()
+        # a value that doesn't fit the buffer is parsed again after every
+        # refill, the refills grow so that this stays linear
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill(size):
+                    size *= 2
+                    continue
+                raise
+            # a number at the end of the buffer may continue in the file
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
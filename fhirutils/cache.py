@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+from . import serialization
+
+
+class LRUCache():
+    """A thread-safe in-memory cache with least-recently-used eviction.
+    The cache is bounded by the number of items and/or by the summed size of
+    the items in bytes. The size of an item is estimated by its serialized
+    json representation unless sizeof is given.
+    Attributes
+    --------------
+    max_items : int
+        maximum number of items, None for no limit
+    max_bytes : int
+        maximum summed size of all items in bytes, None for no limit
+    sizeof : callable
+        returns the size of an item in bytes
+    hits : int
+        number of successful lookups
+    misses : int
+        number of failed lookups
+    Methods
+    --------------
+    get(key, default)
+        returns the cached item and marks it as recently used
+    put(key, value)
+        adds an item, evicts least recently used items if a limit is exceeded
+    pop(key, default)
+        removes an item and returns it
+    clear()
+        removes every item
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if sizeof is not None else _json_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self._bytes += size
+            while (
+                (self.max_items is not None and len(self._items) > self.max_items) or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._bytes -= evicted
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                return default
+            self._bytes -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+
+def _json_size(value):
+    return len(serialization.dumps(value))
@@ -0,0 +1,285 @@
+"""Command line interface of fhirutils.
+
+    fhirutils connect --source URL --destination URL --profile KDS --encounters encounters.csv
+    fhirutils load --source URL --profile KDS --out bundles ENCOUNTER [ENCOUNTER ...]
+    fhirutils get PATH SOURCE
+
+Run fhirutils <command> --help for all options. The modules of a command are
+imported when the command runs, so the start stays fast.
+"""
+
+import argparse
+import csv
+import sys
+
+
+def read_encounters(path):
+    """returns the encounter ids of a csv file (first column, one encounter
+    per line) without duplicates, in the order of the file"""
+    encounters = {}
+    with open(path, "r", newline="") as f:
+        for row in csv.reader(f):
+            if row and row[0].strip():
+                encounters[row[0].strip()] = None
+
+    return list(encounters)
+
+
+def include_option(value):
+    return {"no": False, "yes": True, "auto": "auto"}[value]
+
+
+def requested_resources(args, loader):
+    """the requested resources: --resources or every resource of the
+    profile followed by Medication"""
+    if args.resources:
+        return args.resources
+    return list(loader.loadConfig(args.config, args.profile)) + ["Medication"]
+
+
+def make_transport(args):
+    """a Transport with the response cache of --cache and the rate limiter of
+    --adaptive, None without both"""
+    if args.cache is None and not args.adaptive:
+        return None
+    from .transport import Transport
+    cache = None
+    if args.cache is not None:
+        from .httpcache import HTTPCache
+        cache = HTTPCache(args.cache, ttl=args.cache_ttl)
+    return Transport(cache=cache, limiter=make_limiter(args) if args.adaptive else None)
+
+
+def make_limiter(args):
+    """a RateLimiter with the caps of the source and (connect) the destination"""
+    from .ratelimit import RateLimiter
+    hosts = {}
+    for server, prefix in ((args.source, "max_"), (getattr(args, "destination", None), "destination_max_")):
+        if server is None:
+            continue
+        caps = {name: getattr(args, prefix + name) for name in ("concurrency", "rate")}
+        hosts[server] = {"max_" + name: value for name, value in caps.items() if value is not None}
+    return RateLimiter(hosts=hosts)
+
+
+def make_fingerprints(args):
+    """a FingerprintIndex of the destination with --fingerprints, else None"""
+    if args.fingerprints is None:
+        return None
+    from .fingerprint import FingerprintIndex
+    return FingerprintIndex(args.fingerprints, args.destination, verify=args.verify_fingerprints)
+
+
+def add_source_options(parser):
+    parser.add_argument("--source", required=True, help="the source's FHIR-base incl. trailing /")
+    parser.add_argument("--profile", required=True, help="profile key in the config file")
+    parser.add_argument("--config", default="config.json", help="path to config.json (default: ./config.json)")
+    parser.add_argument("--resources", nargs="+",
+                        help="requested resources (default: the profile's resources and Medication)")
+    parser.add_argument("--count", type=int, default=100, help="_count of the searches")
+    parser.add_argument("--format", choices=["json", "xml"], default="json",
+                        help="_format of the searches, XML is converted to json entry by entry")
+    parser.add_argument("--include", choices=["no", "yes", "auto"], default="no",
+                        help="combine searches via _include, \"auto\" asks the CapabilityStatement")
+    parser.add_argument("--revinclude", action="store_true", help="combine searches via _revinclude")
+    parser.add_argument("--cache", help="on-disk response cache (sqlite), revalidated on reruns")
+    parser.add_argument("--cache-ttl", type=float, default=7 * 24 * 3600,
+                        help="seconds after which a cached response is downloaded again")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adapt the concurrent requests per server to 429/503 responses and latency, "
+                             "honour Retry-After")
+    parser.add_argument("--max-concurrency", type=int,
+                        help="maximum concurrent requests to the source with --adaptive (default 10)")
+    parser.add_argument("--max-rate", type=float, help="maximum requests per second to the source with --adaptive")
+    parser.add_argument("--logpath", help="logfile")
+    parser.add_argument("--quiet", action="store_true", help="print only errors and the summary")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="fhirutils", description="FHIR download, transfer and extraction tools")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    connect = commands.add_parser("connect", help="transfer encounters' records to another server")
+    add_source_options(connect)
+    connect.add_argument("--destination", required=True, help="the destination's FHIR-base incl. trailing /")
+    connect.add_argument("--encounters", required=True, help="csv file with one encounter id per line")
+    connect.add_argument("--method", choices=["PUT", "POST"], default="PUT", help="upload method")
+    connect.add_argument("--incr", action="store_true", help="skip encounters already on the destination")
+    connect.add_argument("--statepath", help="sync state database (sqlite)")
+    connect.add_argument("--delta", action="store_true",
+                         help="transfer only records changed since the last --delta run (needs --statepath, PUT)")
+    connect.add_argument("--overlap", type=int, default=300,
+                         help="seconds the --delta watermarks are moved back, default 300")
+    connect.add_argument("--workers", type=int, default=1, help="encounters transferred in parallel")
+    connect.add_argument("--pool", choices=["thread", "process", "staged"], default="thread",
+                         help="worker pool, \"staged\" overlaps downloads and uploads")
+    connect.add_argument("--queue-size", type=int, help="records waiting per stage with --pool staged")
+    connect.add_argument("--async", dest="use_async", action="store_true",
+                         help="use AsyncConnector instead of a worker pool")
+    connect.add_argument("--in-flight", type=int, default=50, help="records in flight with --async")
+    connect.add_argument("--max-per-host", type=int, help="concurrent requests per server with --async")
+    connect.add_argument("--max-entries", type=int, help="maximum entries per uploaded transaction")
+    connect.add_argument("--max-bytes", type=int, help="maximum bytes per uploaded transaction")
+    connect.add_argument("--compress", action="store_true", help="gzip-compress uploads")
+    connect.add_argument("--fingerprints",
+                         help="index (sqlite) of uploaded resources' fingerprints, unchanged ones aren't uploaded again")
+    connect.add_argument("--verify-fingerprints", action="store_true",
+                         help="compare unchanged resources with the destination's copies before skipping them")
+    connect.add_argument("--destination-max-concurrency", type=int,
+                         help="maximum concurrent requests to the destination with --adaptive (default 10)")
+    connect.add_argument("--destination-max-rate", type=float,
+                         help="maximum requests per second to the destination with --adaptive")
+    connect.add_argument("--upload-workers", type=int, default=1, help="transactions of a record uploaded in parallel")
+    connect.add_argument("--metrics-path", help="write the run's metrics to this file")
+    connect.add_argument("--metrics-format", choices=["json", "prometheus"], default="json")
+    connect.add_argument("--metrics-interval", type=float, help="also write the metrics every n seconds")
+    connect.set_defaults(func=run_connect)
+
+    load = commands.add_parser("load", help="download encounters' records as bundles")
+    add_source_options(load)
+    load.add_argument("encounter", nargs="*", help="encounter ids")
+    load.add_argument("--encounters", help="csv file with one encounter id per line")
+    load.add_argument("--out", default=".", help="directory the bundles are written to (<encounter>.json)")
+    load.add_argument("--pretty", action="store_true", help="indent the bundles")
+    load.add_argument("--output", choices=["json", "ndjson"],
+                      help="stream the entries to disk as they arrive: a bundle file (json) "
+                           "or a directory with one file per resource type (ndjson)")
+    load.add_argument("--gzip", action="store_true", help="gzip-compress streamed output")
+    load.add_argument("--explain", action="store_true", help="print the planned requests, download nothing")
+    load.set_defaults(func=run_load)
+
+    get = commands.add_parser("get", help="print the values of a json path in a resource/bundle")
+    get.add_argument("path", help="json path, e.g. entry.X.resource.id")
+    get.add_argument("source", help="search url or local file")
+    get.add_argument("--type", choices=["url", "local"], default="url", help="the source's type")
+    get.add_argument("--format", choices=["json", "xml"], default="json", help="the source's format")
+    get.set_defaults(func=run_get)
+
+    return parser
+
+
+def run_connect(args):
+    if args.delta and args.statepath is None:
+        print("--delta requires --statepath.", file=sys.stderr)
+        return 2
+    options = {
+        "fhirbase_source": args.source,
+        "fhirbase_destination": args.destination,
+        "enc_no_lst": read_encounters(args.encounters),
+        "incr": args.incr,
+        "logpath": args.logpath,
+        "verbose": 0 if args.quiet else 1,
+        "statepath": args.statepath,
+        "include": include_option(args.include),
+        "revinclude": args.revinclude,
+        "transport": make_transport(args),
+        "fingerprints": make_fingerprints(args)
+    }
+    kwargs = {
+        "method": args.method,
+        "count": args.count,
+        "form": args.format,
+        "max_entries": args.max_entries,
+        "max_bytes": args.max_bytes,
+        "compress": args.compress,
+        "upload_workers": args.upload_workers,
+        "metrics_path": args.metrics_path,
+        "metrics_format": args.metrics_format,
+        "metrics_interval": args.metrics_interval
+    }
+    if args.delta:
+        kwargs["overlap"] = args.overlap
+    if args.use_async:
+        import asyncio
+        from .aio import AsyncConnector
+        connector = AsyncConnector(max_per_host=args.max_per_host, **options)
+        run = connector.sync if args.delta else connector.connect
+        try:
+            failed = asyncio.run(run(requested_resources(args, connector.loader),
+                                     args.config, args.profile,
+                                     max_in_flight=args.in_flight, **kwargs))
+        finally:
+            connector.close()
+    else:
+        from .loader import Connector
+        connector = Connector(**options)
+        run = connector.sync if args.delta else connector.connect
+        failed = run(requested_resources(args, connector.loader),
+                     args.config, args.profile,
+                     workers=args.workers, pool=args.pool,
+                     queue_size=args.queue_size, **kwargs)
+
+    if failed:
+        print(str(len(failed)) + " encounter(s) failed: " + ", ".join(failed), file=sys.stderr)
+        return 1
+    return 0
+
+
+def run_load(args):
+    from .loader import Loader
+
+    encounters = list(args.encounter)
+    if args.encounters is not None:
+        encounters.extend(read_encounters(args.encounters))
+    if not encounters:
+        print("No encounters given.", file=sys.stderr)
+        return 2
+
+    loader = Loader(fhirbase=args.source,
+                    logpath=args.logpath,
+                    verbose=0 if args.quiet else 1,
+                    include=include_option(args.include),
+                    revinclude=args.revinclude,
+                    transport=make_transport(args))
+    req_resources = requested_resources(args, loader)
+
+    if args.explain:
+        for enc in encounters:
+            print("Encounter " + enc + ":")
+            for line in loader.explain(enc, req_resources, args.config, args.profile,
+                                       form=args.format, count=args.count):
+                print("  " + line)
+        return 0
+
+    failed = loader.resolveEncounters(encounters, form=args.format)
+    if failed:
+        print("Encounter identifier validation failed for: " + ", ".join(failed), file=sys.stderr)
+    invalid = set(failed)
+    for enc in encounters:
+        if enc in invalid:
+            continue
+        loader.errorstatus = False
+        loader.warningstatus = False
+        bundle = loader.getRecord(enc, req_resources, args.config, args.profile,
+                                  savepath=args.out, destinationfile=destination_name(enc, args),
+                                  count=args.count, form=args.format, pretty=args.pretty,
+                                  output=args.output, compress=args.gzip)
+        if bundle is None or loader.errorstatus or loader.warningstatus:
+            failed.append(enc)
+
+    if failed:
+        print(str(len(failed)) + " encounter(s) with errors: " + ", ".join(failed), file=sys.stderr)
+        return 1
+    return 0
+
+
+def destination_name(enc, args):
+    """<encounter>.json, <encounter>.json.gz or <encounter> (ndjson directory)"""
+    if args.output == "ndjson":
+        return enc
+    return enc + ".json" + (".gz" if args.output is not None and args.gzip else "")
+
+
+def run_get(args):
+    from .utils import Utils
+    from . import serialization
+
+    for path, value in Utils().get(i=args.path, s=args.source, t=args.type, f=args.format, as_frame=False):
+        print(path + "\t" + serialization.dumps(value).decode("utf-8"))
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
@@ -0,0 +1,270 @@
+"""Columnar extraction of FHIR resources to Arrow record batches and Parquet.
+
+A ColumnarExtractor applies a set of json paths (the syntax of Utils.get())
+to a stream of resources and/or bundles in a single pass and collects the
+values column by column. Every batch_size rows a pyarrow.RecordBatch is
+built and the columns are cleared, so memory is bounded by one batch no
+matter how many resources are streamed.
+
+pyarrow is only needed for iter_batches(), to_table() and write_parquet()
+and imported when they are called (pip install pyarrow).
+"""
+
+import datetime
+import re
+from .utils import compile_path
+from . import serialization
+
+# FHIR date, dateTime and instant, the parts are optional from the right
+_DATETIME = re.compile(r"(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?"
+                       r"(Z|[+-]\d{2}:\d{2})?)?)?)?$")
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("pyarrow is required for Arrow/Parquet output, install it with: pip install pyarrow")
+    return pyarrow
+
+
+def iter_entries(source, resource_type=None):
+    """yields bundle entries ({"resource": ...}) of an iterable of bundles,
+    bundle entries and resources. Bundles are flattened, resources are
+    wrapped as entries, so paths always start at the entry (e.g.
+    "resource.id"). If resource_type is given, only entries of resources of
+    this type (str or collection of str) are yielded."""
+    if isinstance(resource_type, str):
+        resource_type = (resource_type,)
+    for item in source:
+        if "resource" in item and "resourceType" not in item:
+            entries = (item,)
+        elif item.get("resourceType") == "Bundle":
+            entries = item.get("entry") or ()
+        else:
+            entries = ({"resource": item},)
+        for entry in entries:
+            if resource_type is None or entry.get("resource", {}).get("resourceType") in resource_type:
+                yield entry
+
+
+class ColumnarExtractor():
+    """Extracts columns from FHIR resources by json paths, see module docstring.
+    A path without WILDCARD yields one value per row (the first match, None
+    if nothing matches), a path with WILDCARD a list of every match. Values
+    that are objects or lists are stored as json strings.
+    Attributes
+    --------------
+    columns : dict
+        column name -> json path; a list of paths is taken as {path: path}
+    types : dict
+        column name -> pyarrow.DataType (e.g. pa.timestamp("ms", tz="UTC"))
+        or the name of a type without parameters (e.g. "int64", "date32",
+        "timestamp[ms]"). FHIR date, dateTime and instant strings are parsed
+        for timestamp and date columns: values with an offset are converted
+        to UTC, partial dates ("2021", "2021-07") are their first day, date
+        columns keep the date as written. Other columns are inferred from the first
+        batch (string if they are empty, double if they are integers, as
+        FHIR decimals like doses may be integral in one batch only) and keep
+        that type. Every batch is converted to the schema, a value that
+        doesn't fit its column's type raises a ValueError naming the column
+    batch_size : int
+        rows per record batch resp. Parquet row group
+    resource_type : str or collection of str
+        only resources of this type are extracted, None for every resource
+    rows : int
+        number of rows extracted so far
+    Methods
+    --------------
+    iter_columns(source)
+        yields dicts column name -> list of values with up to batch_size rows
+    iter_batches(source)
+        yields pyarrow.RecordBatch objects
+    to_table(source)
+        returns a pyarrow.Table of every row
+    write_parquet(source, path, compression)
+        writes the rows to a Parquet file, one row group per batch
+    """
+
+    def __init__(self, columns, types=None, batch_size=65536, resource_type=None):
+        if not isinstance(columns, dict):
+            columns = {path: path for path in columns}
+        self.columns = columns
+        self.types = dict(types or {})
+        self.batch_size = batch_size
+        self.resource_type = resource_type
+        self.rows = 0
+        self._schema = None
+        self._paths = [(name, compile_path(path)) for name, path in columns.items()]
+
+    def iter_columns(self, source):
+        names = list(self.columns)
+        extractors = [self._extractor(path) for _, path in self._paths]
+        data = [[] for _ in names]
+        rows = 0
+        for entry in iter_entries(source, self.resource_type):
+            for values, extract in zip(data, extractors):
+                values.append(extract(entry))
+            rows += 1
+            if rows == self.batch_size:
+                self.rows += rows
+                yield dict(zip(names, data))
+                data = [[] for _ in names]
+                rows = 0
+        if rows:
+            self.rows += rows
+            yield dict(zip(names, data))
+
+    def iter_batches(self, source):
+        pa = _pyarrow()
+        for columns in self.iter_columns(source):
+            if self._schema is None:
+                self._schema = self._infer_schema(pa, columns)
+            arrays = [self._array(pa, field.name, columns[field.name], field.type) for field in self._schema]
+            yield pa.RecordBatch.from_arrays(arrays, schema=self._schema)
+
+    def to_table(self, source):
+        pa = _pyarrow()
+        batches = list(self.iter_batches(source))
+        if not batches:
+            return pa.Table.from_batches([], schema=self._empty_schema(pa))
+        return pa.Table.from_batches(batches)
+
+    def write_parquet(self, source, path, compression="snappy"):
+        """writes the rows of source to the Parquet file path, every record
+        batch as a row group; returns the number of rows written"""
+        pa = _pyarrow()
+        import pyarrow.parquet as pq
+
+        rows = self.rows
+        writer = None
+        try:
+            for batch in self.iter_batches(source):
+                if writer is None:
+                    writer = pq.ParquetWriter(path, batch.schema, compression=compression)
+                writer.write_table(pa.Table.from_batches([batch]), row_group_size=self.batch_size)
+            if writer is None:
+                writer = pq.ParquetWriter(path, self._empty_schema(pa), compression=compression)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return self.rows - rows
+
+    def _extractor(self, path):
+        if path.wildcard:
+            return lambda entry: [_scalar(value) for value in path.values(entry)]
+        return lambda entry: _scalar(path.first(entry))
+
+    def _type(self, pa, name):
+        data_type = self.types.get(name)
+        if isinstance(data_type, str):
+            data_type = pa.type_for_alias(data_type)
+        return data_type
+
+    def _infer_schema(self, pa, columns):
+        fields = []
+        for name, path in self._paths:
+            data_type = self._type(pa, name)
+            if data_type is None:
+                data_type = self._array(pa, name, columns[name], None).type
+                if pa.types.is_null(data_type):
+                    data_type = pa.list_(pa.string()) if path.wildcard else pa.string()
+                elif path.wildcard and pa.types.is_null(data_type.value_type):
+                    data_type = pa.list_(pa.string())
+                elif pa.types.is_integer(data_type):
+                    data_type = pa.float64()
+                elif path.wildcard and pa.types.is_integer(data_type.value_type):
+                    data_type = pa.list_(pa.float64())
+            elif path.wildcard and not pa.types.is_list(data_type):
+                data_type = pa.list_(data_type)
+            fields.append(pa.field(name, data_type))
+
+        return pa.schema(fields)
+
+    def _empty_schema(self, pa):
+        if self._schema is not None:
+            return self._schema
+        return self._infer_schema(pa, {name: [] for name in self.columns})
+
+    def _array(self, pa, name, values, data_type):
+        """builds the array of column name; values are converted to data_type
+        without loss (strings are parsed, e.g. dates to timestamps), values
+        that don't fit raise a ValueError"""
+        temporal = _temporal(pa, data_type)
+        if temporal is not None:
+            return self._temporal_array(pa, name, values, data_type, pa.types.is_date(temporal))
+        try:
+            array = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # mixed types, stored as strings
+            if any(isinstance(value, list) for value in values):
+                values = [None if value is None else [_text(v) for v in value] for value in values]
+                array = pa.array(values, type=pa.list_(pa.string()))
+            else:
+                array = pa.array([_text(value) for value in values], type=pa.string())
+        if data_type is None or array.type == data_type:
+            return array
+        try:
+            return array.cast(data_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            raise ValueError("Column " + name + ": values of type " + str(array.type) +
+                             " don't fit its type " + str(data_type) +
+                             ", set the column's type with types (" + str(e) + ")")
+
+    def _temporal_array(self, pa, name, values, data_type, date_only):
+        if pa.types.is_list(data_type):
+            values = [None if value is None else [_fhir_datetime(v, date_only) for v in value]
+                      for value in values]
+        else:
+            values = [_fhir_datetime(value, date_only) for value in values]
+        try:
+            return pa.array(values, type=data_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError("Column " + name + ": values that aren't FHIR dates don't fit its type " +
+                             str(data_type) + " (" + str(e) + ")")
+
+
+def _temporal(pa, data_type):
+    """the timestamp or date type of a column (resp. of its list values),
+    None for other types"""
+    if data_type is not None and pa.types.is_list(data_type):
+        data_type = data_type.value_type
+    if data_type is not None and (pa.types.is_timestamp(data_type) or pa.types.is_date(data_type)):
+        return data_type
+    return None
+
+
+def _fhir_datetime(value, date_only=False):
+    """converts a FHIR date, dateTime or instant string to a datetime.date
+    (date_only) or a datetime.datetime (in UTC if it has an offset, else as
+    written); other values are returned unchanged"""
+    match = _DATETIME.match(value) if isinstance(value, str) else None
+    if match is None:
+        return value
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    try:
+        if date_only:
+            return datetime.date(int(year), int(month or 1), int(day or 1))
+        stamp = datetime.datetime(int(year), int(month or 1), int(day or 1),
+                                  int(hour or 0), int(minute or 0), int(second or 0),
+                                  int((fraction or "")[:6].ljust(6, "0")))
+    except ValueError:
+        return value
+    if offset is not None and offset != "Z":
+        sign = -1 if offset[0] == "-" else 1
+        stamp -= sign * datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6]))
+
+    return stamp
+
+
+def _scalar(value):
+    if isinstance(value, (dict, list)):
+        return serialization.dumps(value).decode("utf-8")
+    return value
+
+
+def _text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return serialization.dumps(value).decode("utf-8")
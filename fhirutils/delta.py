@@ -0,0 +1,124 @@
+"""Change detection for the delta synchronisation of Connector.sync().
+
+A delta sync searches every requested resource type on the source with
+_lastUpdated=gt<watermark> and maps the changed resources to the records
+(encounters) they belong to:
+- a changed Encounter belongs to its own record
+- a changed resource that refers to a requested encounter belongs to that
+  encounter's record
+- any other changed resource that refers to a patient (incl. changed
+  Patients) belongs to the records of all the patient's requested encounters
+- changed Medications are uploaded on their own, they refer to nothing
+The affected records are transferred again completely (with PUT), so the
+resources the changed ones refer to are transferred as well. Deletions are
+not detected by _lastUpdated searches.
+"""
+
+import datetime
+from email.utils import parsedate_to_datetime
+
+# references of a resource to other resources are all values of "reference"
+_REFERENCE = "reference"
+
+
+def references(data):
+    """yields every reference string in a resource (at any depth)"""
+    stack = [data]
+    while stack:
+        d = stack.pop()
+        if isinstance(d, dict):
+            for key, value in d.items():
+                if key == _REFERENCE and isinstance(value, str):
+                    yield value
+                elif isinstance(value, (dict, list)):
+                    stack.append(value)
+        elif isinstance(d, list):
+            stack.extend(d)
+
+
+def referenced_id(reference, resource_type):
+    """returns the id of a (relative or absolute) reference to a resource of
+    resource_type, None for other references"""
+    marker = resource_type + "/"
+    if reference is None or marker not in reference:
+        return None
+    head, _, tail = reference.rpartition(marker)
+    if head and not head.endswith("/"):
+        # e.g. "MedicationEncounter/..." isn't a reference to an Encounter
+        return None
+    ref_id = tail.split("/_history/", 1)[0]
+
+    return ref_id or None
+
+
+def format_instant(moment):
+    """returns a datetime as FHIR instant in UTC, e.g. 2024-01-31T22:00:00Z"""
+    return moment.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def server_time(req):
+    """returns the Date header of a response as aware datetime, the local
+    time if the header is missing or invalid"""
+    try:
+        return parsedate_to_datetime(req.headers["Date"])
+    except (KeyError, TypeError, ValueError):
+        return datetime.datetime.now(datetime.timezone.utc)
+
+
+class DeltaScan():
+    """Collects the changes of a delta sync, see module docstring.
+    Attributes
+    --------------
+    encounters : set
+        ids of changed Encounters and of encounters changed resources refer to
+    patients : set
+        ids of changed Patients and of patients changed resources refer to
+        (if they refer to no encounter in scope)
+    medications : list
+        entries ({"resource": ...}) of changed Medications
+    changed : dict
+        resource type -> number of changed resources
+    Methods
+    --------------
+    add(resource, scope)
+        books a changed resource
+    affected(enc_no_lst, encounter_index)
+        returns the encounters of enc_no_lst whose records changed
+    """
+
+    def __init__(self):
+        self.encounters = set()
+        self.patients = set()
+        self.medications = []
+        self.changed = {}
+
+    def add(self, resource, scope):
+        """scope: the set of requested encounter ids"""
+        resource_type = resource.get("resourceType")
+        self.changed[resource_type] = self.changed.get(resource_type, 0) + 1
+        if resource_type == "Encounter":
+            self.encounters.add(resource.get("id"))
+            return
+        if resource_type == "Patient":
+            self.patients.add(resource.get("id"))
+            return
+        if resource_type == "Medication":
+            self.medications.append({"resource": resource})
+            return
+
+        patients = set()
+        in_scope = False
+        for reference in references(resource):
+            enc = referenced_id(reference, "Encounter")
+            if enc is not None and enc in scope:
+                self.encounters.add(enc)
+                in_scope = True
+            pat = referenced_id(reference, "Patient")
+            if pat is not None:
+                patients.add(pat)
+        if not in_scope:
+            self.patients.update(patients)
+
+    def affected(self, enc_no_lst, encounter_index):
+        return [enc for enc in enc_no_lst
+                if enc in self.encounters or encounter_index.get(enc) in self.patients]
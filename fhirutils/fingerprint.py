@@ -0,0 +1,213 @@
+"""Content fingerprints of uploaded resources.
+
+A fingerprint is the SHA-256 of a resource's canonical json: keys sorted,
+no whitespace, meta left out (the destination sets its own versionId and
+lastUpdated). The standard library's json is used for it, so fingerprints
+don't change if orjson is installed.
+
+BundleUploader drops the entries whose fingerprint equals the one stored
+for their resourceType/id by a previous successful upload to the same
+destination; after an upload the fingerprints of the accepted entries are
+stored. With verify=True the destination is asked as well (see
+FingerprintIndex).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from .utils import next_link, id_chunks
+from . import serialization
+
+
+def fingerprint(resource):
+    """returns the fingerprint of a resource as hex string"""
+    canonical = {key: value for key, value in resource.items() if key != "meta"}
+    data = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def resource_key(entry):
+    """returns "resourceType/id" of an entry's resource, None without id"""
+    resource = entry.get("resource") or {}
+    if not resource.get("resourceType") or not resource.get("id"):
+        return None
+    return resource["resourceType"] + "/" + resource["id"]
+
+
+class FingerprintIndex():
+    """Local index of the fingerprints of the resources uploaded to a
+    destination, see module docstring. The index is kept in a sqlite
+    database; one instance can be shared by threads, worker processes open
+    connections of their own.
+    Attributes
+    --------------
+    path : str
+        a raw string representing the database file incl. path
+    destination : str
+        the destination's FHIR-base, indexes of several destinations can be
+        kept in one database
+    verify : bool
+        if True, resources that are unchanged according to the index or
+        aren't in it yet are looked up on the destination (in batches of
+        batch_size ids per resource type) and only skipped if the
+        destination's copy has the same fingerprint. This finds resources
+        that were changed or deleted on the destination and fills the index
+        from data that is already there. Servers that add elements (e.g. a
+        generated narrative) never match, their resources are uploaded.
+        Without verify, changes and deletions on the destination aren't
+        noticed; clear() makes the next run upload everything again.
+    batch_size : int
+        ids per verification search
+    skipped : int
+        entries dropped as unchanged
+    stored : int
+        fingerprints stored after uploads
+    Methods
+    --------------
+    changed(entries, transport)
+        returns the entries that have to be uploaded
+    lookup(keys)
+        returns the stored fingerprints of resource keys
+    store_entries(entries)
+        stores the fingerprints of uploaded entries
+    clear(), close()
+    """
+
+    def __init__(self, path, destination, verify=False, batch_size=100):
+        self.path = path
+        self.destination = destination
+        self.verify = verify
+        self.batch_size = batch_size
+        self.skipped = 0
+        self.stored = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # every process opens its own connection
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state.pop("_inherited", None)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @property
+    def lock(self):
+        if self._pid != os.getpid():
+            # a forked worker process (e.g. a process pool) inherits the
+            # parent's connection and lock, sqlite connections must not be
+            # used (or closed) after a fork: start over, keep them untouched
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._inherited, self._conn = self._conn, None
+        return self._lock
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS fingerprints ("
+                    "destination TEXT NOT NULL, "
+                    "key TEXT NOT NULL, "
+                    "fingerprint TEXT NOT NULL, "
+                    "updated REAL NOT NULL, "
+                    "PRIMARY KEY (destination, key)) WITHOUT ROWID")
+        return self._conn
+
+    def lookup(self, keys):
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.conn.execute(
+                    "SELECT key, fingerprint FROM fingerprints WHERE destination = ? "
+                    "AND key IN (" + ",".join("?" * len(chunk)) + ")",
+                    [self.destination] + chunk)
+                found.update(rows)
+
+        return found
+
+    def changed(self, entries, transport=None):
+        """returns the entries whose resource differs from the stored (with
+        verify: the destination's) version; transport is needed for verify"""
+        fingerprints = {}
+        for entry in entries:
+            key = resource_key(entry)
+            if key is not None and key not in fingerprints:
+                fingerprints[key] = fingerprint(entry["resource"])
+        stored = self.lookup(fingerprints)
+        unchanged = {key for key, value in fingerprints.items() if stored.get(key) == value}
+        if self.verify:
+            candidates = [key for key in fingerprints if key in unchanged or key not in stored]
+            remote = self.fetch(candidates, transport)
+            unchanged = {key for key in candidates if remote.get(key) == fingerprints[key]}
+            self._store([(key, fingerprints[key]) for key in unchanged if key not in stored])
+        kept = [entry for entry in entries if resource_key(entry) not in unchanged]
+        with self.lock:
+            self.skipped += len(entries) - len(kept)
+
+        return kept
+
+    def fetch(self, keys, transport):
+        """returns the fingerprints of the destination's copies of keys
+        (resource keys missing on the destination are left out)"""
+        ids = {}
+        for key in keys:
+            resource_type, _, resource_id = key.partition("/")
+            ids.setdefault(resource_type, []).append(resource_id)
+        found = {}
+        for resource_type, type_ids in ids.items():
+            for chunk in id_chunks(type_ids, self.batch_size):
+                search_url = self.destination + resource_type + "?_id=" + ",".join(chunk) + \
+                    "&_count=" + str(len(chunk))
+                while search_url is not None:
+                    req = transport.get(search_url)
+                    if not req.ok:
+                        # not verified, the resources are uploaded
+                        break
+                    json_data = serialization.loads_response(req)
+                    for entry in json_data.get("entry", []):
+                        key = resource_key(entry)
+                        if key is not None:
+                            found[key] = fingerprint(entry["resource"])
+                    search_url = next_link(json_data)
+
+        return found
+
+    def store_entries(self, entries):
+        self._store([(key, fingerprint(entry["resource"]))
+                     for entry, key in ((entry, resource_key(entry)) for entry in entries)
+                     if key is not None])
+
+    def _store(self, pairs):
+        if not pairs:
+            return
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                                  ((self.destination, key, value, now) for key, value in pairs))
+            self.stored += len(pairs)
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM fingerprints WHERE destination = ?", (self.destination,))
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
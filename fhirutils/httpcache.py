@@ -0,0 +1,265 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import requests
+from . import serialization
+
+
+# headers that describe the transferred body, not the cached one
+_HOP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+
+class HTTPCache():
+    """Persistent cache of GET responses, used by Transport.
+    Responses are stored in a sqlite database keyed by their normalized url
+    (see normalize_url()) together with their ETag and Last-Modified headers.
+    A cached response is revalidated with If-None-Match/If-Modified-Since; if
+    the server answers 304 Not Modified the cached body is returned, so an
+    unchanged search costs a request but no payload. Responses without
+    validators are only stored if fresh_for > 0.
+    Attributes
+    --------------
+    path : str
+        a raw string representing the database file incl. path
+    max_bytes : int
+        maximum summed size of the cached bodies, least recently used
+        responses are evicted first
+    ttl : float
+        seconds after its download resp. last revalidation after which a
+        response is dropped and downloaded again completely, None for no limit
+    fresh_for : float
+        seconds after its download resp. last revalidation during which a
+        response is returned without a request (0: always revalidate)
+    hits : int
+        responses returned without a request
+    revalidated : int
+        responses confirmed by a 304
+    misses : int
+        responses that were downloaded
+    clock : callable
+        returns the current time in seconds since the epoch, time.time by
+        default
+    Methods
+    --------------
+    lookup(url)
+        returns the cache entry of url or None
+    request_headers(entry)
+        returns the conditional headers that revalidate entry
+    response(entry, req)
+        returns the cached response of entry
+    store(url, req)
+        stores a downloaded response if it can be cached
+    hit(url), revalidate(url, headers)
+        mark an entry as used resp. confirmed by a 304
+    clear(), close()
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 ** 2, ttl=7 * 24 * 3600, fresh_for=0, clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.fresh_for = fresh_for
+        self.clock = clock
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = os.getpid()
+        self._bytes = None
+
+    def __getstate__(self):
+        # every process opens its own connection
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state.pop("_inherited", None)
+        state["_bytes"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @property
+    def lock(self):
+        if self._pid != os.getpid():
+            # a forked worker process (e.g. a process pool) inherits the
+            # parent's connection and lock, sqlite connections must not be
+            # used (or closed) after a fork: start over, keep them untouched
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._inherited, self._conn = self._conn, None
+        return self._lock
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, "
+                    "headers TEXT NOT NULL, "
+                    "body BLOB NOT NULL, "
+                    "etag TEXT, "
+                    "last_modified TEXT, "
+                    "stored REAL NOT NULL, "
+                    "accessed REAL NOT NULL, "
+                    "size INTEGER NOT NULL)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self._conn
+
+    def lookup(self, url):
+        """returns the entry of url as dict (headers, body, etag,
+        last_modified, stored, fresh) or None; expired entries are dropped"""
+        key = normalize_url(url)
+        now = self.clock()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT headers, body, etag, last_modified, stored FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[4] > self.ttl:
+                self._delete(key)
+                return None
+        headers, body, etag, last_modified, stored = row
+        return {"key": key,
+                "headers": serialization.loads(headers),
+                "body": bytes(body),
+                "etag": etag,
+                "last_modified": last_modified,
+                "fresh": now - stored < self.fresh_for}
+
+    def request_headers(self, entry):
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def response(self, entry, req=None):
+        """returns a requests.Response with the cached status, headers and
+        body; req (the 304 response, if revalidated) provides url, request
+        and updated headers"""
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response._content = entry["body"]
+        response.headers.update(entry["headers"])
+        response.encoding = None
+        if req is not None:
+            response.headers.update({k: v for k, v in req.headers.items() if k.lower() not in _HOP_HEADERS})
+            response.url = req.url
+            response.request = req.request
+            response.elapsed = req.elapsed
+            response.connection = req.connection
+        return response
+
+    def store(self, url, req):
+        """counts a downloaded response of a GET of url as miss and stores it
+        unless it isn't a 200, must not be cached (Cache-Control: no-store)
+        or can neither be revalidated nor served fresh; returns True if it
+        was stored"""
+        with self.lock:
+            self.misses += 1
+        cache_control = req.headers.get("Cache-Control", "").lower()
+        etag = req.headers.get("ETag")
+        last_modified = req.headers.get("Last-Modified")
+        if (
+            req.status_code != 200 or "no-store" in cache_control or
+            (etag is None and last_modified is None and not self.fresh_for)
+        ):
+            return False
+        body = req.content
+        if self.max_bytes is not None and len(body) > self.max_bytes:
+            return False
+        headers = {k: v for k, v in req.headers.items() if k.lower() not in _HOP_HEADERS}
+        key = normalize_url(url)
+        now = self.clock()
+        with self.lock:
+            conn = self.conn
+            old = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (key, serialization.dumps(headers).decode("utf-8"), body,
+                              etag, last_modified, now, now, len(body)))
+            self._bytes += len(body) - (old[0] if old else 0)
+            self._evict()
+        return True
+
+    def hit(self, url):
+        """marks the entry of url as used without revalidation"""
+        with self.lock, self.conn:
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (self.clock(), normalize_url(url)))
+
+    def revalidate(self, url, headers):
+        """marks the entry of url as confirmed by a 304 with headers, its
+        ttl and fresh_for start again"""
+        now = self.clock()
+        with self.lock, self.conn:
+            self.revalidated += 1
+            self.conn.execute(
+                "UPDATE responses SET accessed = ?, stored = ?, "
+                "etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) WHERE key = ?",
+                (now, now, headers.get("ETag"), headers.get("Last-Modified"), normalize_url(url)))
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+            self._bytes = 0
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _delete(self, key):
+        row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return
+        with self.conn:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._bytes -= row[0]
+
+    def _evict(self):
+        if self.max_bytes is None or self._bytes <= self.max_bytes:
+            return
+        # other processes may share the database, count again before evicting
+        self._bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        excess = self._bytes - self.max_bytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            keys.append((key,))
+            excess -= size
+            self._bytes -= size
+            if excess <= 0:
+                break
+        with self.conn:
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+
+
+def normalize_url(url):
+    """returns the cache key of url: scheme and host in lower case, default
+    port and fragment removed, query parameters sorted by name (the order of
+    repeated parameters is kept)"""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rpartition(":")[2]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rpartition(":")[0]
+    query = sorted(parse_qsl(parts.query, keep_blank_values=True), key=lambda param: param[0])
+
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(query, safe=":,/"), ""))
@@ -1,11 +1,19 @@
-import requests
-import json
-import time
 import datetime
-from utils import Utils
-import csv
-from timeit import default_timer as timer
-import numpy as np
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import requests
+from .utils import Utils, Progress, LogWriter, compile_path, next_link, id_chunks
+from .transport import Transport
+from .cache import LRUCache
+from .syncstate import SyncState
+from .upload import BundleUploader
+from .stages import Stage, StagedPipeline
+from .delta import DeltaScan, format_instant, server_time
+from .bundleio import BundleWriter
+from .rules import RulePipeline
+from .planner import QueryPlanner, MEDICATION_REFERENCES, search_url
+from . import serialization
 
 
 class Loader():
@@ -21,16 +29,84 @@ class Loader():
         a raw string representing the logfile's name incl. path
     verbose : int
         integer, sets the verbosity level (0: low, 1: high verbosity [default])
+    transport : Transport
+        shared HTTP layer, a new one is created if not given. Phase timings
+        are recorded in its metrics (Loader.metrics).
+    medication_cache : LRUCache
+        Medication entries by id, shared across encounters (and Loaders) so
+        that repeatedly referenced medications are downloaded only once.
+        A new cache (10000 items, 64 MB) is created if not given.
+    med_batch_size : int
+        maximum number of medication ids resolved by one _id search, default 50
+    patient_cache_size : int
+        maximum number of (patient, resource type) results kept in
+        patient_cache, default 64. Resources loaded by patient id (see
+        config file) are downloaded once and reused for every encounter of
+        the patient; registered patients are evicted after their last encounter.
+    pipeline : RulePipeline
+        validation/rewrite rules applied to every downloaded entry, default:
+        drop unresolvable medication references, add missing transaction
+        verbs (see rules.py)
+    enc_batch_size : int
+        maximum number of encounter ids validated by one _id search, default 100
+    include : bool or str
+        if True, searches are combined via _include where possible (e.g. the
+        Medications of MedicationStatements), see planner.py. "auto" uses
+        the includes listed in the server's CapabilityStatement. Default
+        False: one search per requested resource.
+    revinclude : bool
+        if True (and include is set), searches on the encounter are combined
+        with the Encounter search via _revinclude
+    errorstatus : bool
+        set by errors that leave a record incomplete (failed downloads,
+        invalid encounters, unknown patients)
+    warningstatus : bool
+        set if a requested resource isn't found, e.g. an encounter without
+        MedicationStatements; the record is complete nonetheless
+    encounter_index : dict
+        encounter id -> patient id, filled by resolveEncounters() and
+        registerPatient(); getRecord() skips the patient lookup for these
+    valid_encounters : set
+        encounter ids known to exist on the server, getRecord() skips their
+        validation
     Methods
     --------------
-    get Record(enc_no, req_resources, savepath, destinationfile, config_path, profile, form)
+    get Record(enc_no, req_resources, savepath, destinationfile, config_path, profile, form, pretty, output, compress)
         entry method, returns bundle of resources connotated with encounter-no
     writeLogMsg(msg)
         writes a stringinto logfile
     getPatientNumber(self, enc_no, res_dict, form)
         returns the patient id that belongs to the encounter id
+    resolveEncounters(enc_no_lst, form)
+        validates encounters and resolves their patients in batches,
+        returns the invalid encounter ids
+    groupByPatient(enc_no_lst, config_path, profile, form)
+        groups encounters by patient
+    registerPatient(pat_no, enc_no_lst), releasePatient(pat_no, req_resources)
+        track the pending encounters of a patient, see patient_cache_size
+    getPlan(res_dict, profile, req_resources)
+        returns the planned searches of a record, see planner.py
+    explain(enc_no, req_resources, config_path, profile, form, count)
+        dry run, returns the planned requests of a record
+    runStep(step, enc_id, pat_id, form, count, sink)
+        runs a planned search
+    searchResources(resource, search_url, form, sink)
+        downloads and validates the entries of a FHIR search (all pages)
+    extractEntries(resource, json_data, entries, med_ids)
+        validates the entries of a searchset page, collects medication ids
+    collectStep(step, result, found, med_id_lst, writer), includedMedications(found, medications)
+        sort the results of planned searches by resource type
+    pageSink(step, found, med_id_lst, writer)
+        returns a callback that writes a search's pages as they arrive
+    assembleRecord(enc_id, plan, found, medications, writer)
+        returns a record's entries in the requested order
+    saveBundle(bundle, savepath, destinationfile, pretty)
+        writes a bundle to savepath
+    openWriter(savepath, destinationfile, output, compress, pretty, form)
+        returns a BundleWriter that streams a record to savepath
     getMedicationResources(med_id_lst, form):
-        returns a list of medication resources matching the medication id list
+        returns a list of medication resources matching the medication id list,
+        served from medication_cache or downloaded in batches
     printRequestsMessage(req, search_url)
         checks http response code from given requests-obj, print to screen/log
     checkValidEncounter(enc_no)
@@ -43,16 +119,42 @@ class Loader():
                 self,
                 fhirbase=None,
                 logpath=None,
-                verbose=1
+                verbose=1,
+                transport=None,
+                medication_cache=None,
+                med_batch_size=50,
+                patient_cache_size=64,
+                pipeline=None,
+                enc_batch_size=100,
+                include=False,
+                revinclude=False
                 ):
         self.logpath = logpath
+        self.log = LogWriter.get(logpath) if logpath is not None else None
         self.fhirbase = fhirbase
         self.errorstatus = False
+        self.warningstatus = False
         self.verbose = verbose
-        self.utils = Utils()
-        if self.logpath is not None:
-            with open(self.logpath, "w") as _:
-                pass
+        self.transport = transport if transport is not None else Transport()
+        self.metrics = self.transport.metrics
+        self.utils = Utils(transport=self.transport)
+        if medication_cache is None:
+            medication_cache = LRUCache(max_items=10000, max_bytes=64 * 1024 ** 2)
+        self.medication_cache = medication_cache
+        self.med_batch_size = med_batch_size
+        self.patient_cache = LRUCache(max_items=patient_cache_size)
+        if pipeline is None:
+            pipeline = RulePipeline()
+        if pipeline.log is None and self.log is not None:
+            pipeline.log = self.writeLogmsg
+        self.pipeline = pipeline
+        self.pending_patients = {}
+        self.encounter_index = {}
+        self.enc_batch_size = enc_batch_size
+        self.valid_encounters = set()
+        self.include = include
+        self.revinclude = revinclude
+        self._plans = {}
 
     def getRecord(self,
                   enc_no,
@@ -62,7 +164,10 @@ class Loader():
                   savepath=None,
                   destinationfile=None,
                   count=100,
-                  form="json"):
+                  form="json",
+                  pretty=False,
+                  output=None,
+                  compress=False):
         """entry method, returns bundle of resources connotated with encounter-no
         Parameters
         --------------
@@ -81,142 +186,441 @@ class Loader():
             FHIR profile that is loaded from config file
             determines the resources' references
         form : string
-            sets FHIR represantation: json or xml (not implemented yet)
+            sets FHIR represantation: json or xml (XML responses are converted
+            to json one entry at a time, see xmlio.py)
         count : integer
             matches FHIR-search's _count=, default 100
+        pretty : bool
+            if True the saved bundle is indented, else compact (default)
+        output : string
+            if set (and savepath), the entries are written to disk as they
+            arrive instead of being collected in a bundle (see bundleio.py):
+            "json" (one bundle file) or "ndjson" (destinationfile is a
+            directory with one file per resource type)
+        compress : bool
+            if True the streamed file(s) are gzip-compressed
         Return
         --------------
-        bundle as a json object
+        bundle as a json object, None if the encounter is invalid;
+        the path of the saved bundle instead if output is set
         """
 
         enc_no = [enc_no]
         res_dict = self.loadConfig(config_path, profile)
+        plan = self.getPlan(res_dict, profile, req_resources)
 
-        format_dict = {
-                "json": "&_format=json&_count=" + str(count),
-                "xml": "&_format=xml&_count=" + str(count)
-            }
+        if enc_no[0] not in self.valid_encounters:
+            with self.metrics.timer("validate_encounter"):
+                valid = self.checkValidEncounter(enc_no)
+            if not valid:
+                self.invalidEncounter(enc_no[0])
+                return None
 
-        if not self.checkValidEncounter(enc_no):
-            print(
-                "Encounter identifier validation failed, \
-                check server connection and encounter identifier. Aborting...")
-            exit()
+        pat_no = None
+        if enc_no[0] in self.encounter_index:
+            pat_no = [self.encounter_index[enc_no[0]]]
+        elif plan.needs_patient:
+            with self.metrics.timer("patient_lookup"):
+                pat_no = self.getPatientNumber(enc_no, res_dict, form)
+        pat_id = pat_no[0] if pat_no is not None else None
 
-        pat_no = self.getPatientNumber(enc_no, res_dict, form)
+        writer = None
+        if savepath is not None and output is not None:
+            writer = self.openWriter(savepath, destinationfile, output, compress, pretty, form)
+        try:
+            found = {}
+            med_id_lst = []
+            for step in plan.steps:
+                sink = self.pageSink(step, found, med_id_lst, writer)
+                self.collectStep(step, self.runStep(step, enc_no[0], pat_id, form, count, sink),
+                                 found, med_id_lst, writer)
+            for resource, step in plan.fallbacks.items():
+                if not found.get(resource):
+                    sink = self.pageSink(step, found, med_id_lst, writer)
+                    self.collectStep(step, self.runStep(step, enc_no[0], pat_id, form, count, sink),
+                                     found, med_id_lst, writer)
 
-        for v in res_dict.values():
-            if v[1][0] == "encounter_id":
-                v[1][0] = enc_no[0]
-            elif v[1][0] == "patient_id":
-                v[1][0] = pat_no[0]
+            medications = []
+            if plan.medications:
+                with self.metrics.timer("medication"):
+                    included = self.includedMedications(found, medications)
+                    medications.extend(self.getMedicationResources(
+                        [med for med in med_id_lst if med not in included], form))
 
-        res_lst = []
-        med_id_lst = []
+            res_lst = self.assembleRecord(enc_no[0], plan, found, medications, writer)
+        finally:
+            if writer is not None:
+                writer.close()
 
-        for resource in req_resources:
-            if resource == "Medication":
-                med_res = self.getMedicationResources(med_id_lst)
-                res_lst.extend(med_res)
+        if pat_no is not None:
+            self.releasePatient(pat_id, req_resources)
+
+        if writer is not None:
+            self.printSaved(writer.path)
+            return writer.path
+
+        with self.metrics.timer("bundle"):
+            bundle = self.utils.create_bundle(res_lst=res_lst, btype="transaction", form=form)
+
+        if savepath is not None:
+            self.saveBundle(bundle, savepath, destinationfile, pretty)
+
+        return bundle
+
+    def getPlan(self, res_dict, profile, req_resources):
+        """returns the Plan of a record (see planner.py), planned once per
+        profile and requested resources"""
+        key = (profile, tuple(req_resources))
+        plan = self._plans.get(key)
+        if plan is None:
+            if self.include == "auto":
+                planner = QueryPlanner.from_capability_statement(res_dict,
+                                                                 self.getCapabilityStatement(),
+                                                                 revinclude=self.revinclude)
             else:
-                search_url = self.fhirbase + \
-                            resource + \
-                            res_dict[resource][0] + \
-                            str(res_dict[resource][1][0]) + \
-                            format_dict[form]
+                planner = QueryPlanner(res_dict, include=self.include, revinclude=self.revinclude)
+            plan = planner.plan(req_resources)
+            self._plans[key] = plan
+
+        return plan
+
+    def getCapabilityStatement(self):
+        """returns the server's CapabilityStatement or None"""
+        search_url = self.fhirbase + "metadata"
+        if self.verbose > 0:
+            print(search_url)
+        req = self.transport.get(search_url)
+        if not req.ok:
+            self.writeLogmsg("Warning: No CapabilityStatement (" + str(req.status_code) +
+                             "), searches are not combined.")
+            return None
+        try:
+            return serialization.loads_response(req)
+        except ValueError:
+            return None
+
+    def explain(self, enc_no, req_resources, config_path, profile, form="json", count=100):
+        """dry run of getRecord(): returns the planned requests of the
+        encounter's record as a list of lines, without downloading anything
+        (except the CapabilityStatement if include is "auto")"""
+        res_dict = self.loadConfig(config_path, profile)
+        plan = self.getPlan(res_dict, profile, req_resources)
+
+        return plan.explain(self.fhirbase, enc_no, self.encounter_index.get(enc_no), form, count)
+
+    def runStep(self, step, enc_id, pat_id, form="json", count=100, sink=None):
+        """runs a planned search, returns (entries, medication ids) or None.
+        Searches by patient id are the same for every encounter of a
+        patient, their results are cached in patient_cache (unless they are
+        passed to sink page by page, see searchResources()). Without a
+        patient id they aren't run, the record is incomplete then."""
+        patient_scoped = step.code == "patient_id"
+        if patient_scoped and pat_id is None:
+            self.unresolvedPatient(enc_id, step.resource)
+            return None
+        if patient_scoped:
+            result = self.patient_cache.get((pat_id, step.resource))
+            if result is not None:
+                return result
+        url = search_url(self.fhirbase, step, enc_id, pat_id, form, count)
+        with self.metrics.timer("search." + step.resource):
+            result = self.searchResources(step.resource, url, form, sink)
+        if result is not None and patient_scoped and sink is None:
+            self.patient_cache.put((pat_id, step.resource), result)
+
+        return result
+
+    def searchResources(self, resource, search_url, form="json", sink=None):
+        """downloads and validates the entries found by search_url (all
+        pages), returns (entries, referenced medication ids) or None on errors.
+        If sink is given, it is called with the entries of every page
+        instead, the returned entries are empty."""
+        entries = []
+        med_ids = []
+        while search_url is not None:
+            if self.verbose > 0:
+                print(search_url)
+            req = self.transport.get(search_url)
+            if not self.printRequestsMessage(req, search_url):
+                return None
+            json_data = serialization.loads_response(req)
+            self.extractEntries(resource, json_data, entries, med_ids)
+            if sink is not None:
+                sink(entries)
+                entries = []
+            search_url = next_link(json_data)
+
+        return entries, med_ids
+
+    def extractEntries(self, resource, json_data, entries, med_ids):
+        """runs the entries of a searchset page through the pipeline and
+        appends them to entries, the ids of referenced medications to med_ids"""
+        page = self.pipeline.process(json_data.get("entry", []))
+        entries.extend(page)
+        resource_type = compile_path("resource.resourceType")
+        med_reference = compile_path("resource.medicationReference.reference")
+        for item in page:
+            if resource_type.first(item) not in MEDICATION_REFERENCES:
+                continue
+            med_id = med_reference.first(item)
+            if med_id is None or "Medication/" not in med_id:
+                continue
+            med_id = med_id.split("Medication/", 1)[1]
+            if med_id not in med_ids and "?" not in med_id:
+                med_ids.append(med_id)
+
+    def collectStep(self, step, result, found, med_id_lst, writer=None):
+        """sorts the entries of a planned search (incl. included resources)
+        into found (resource type -> entries), collects medication ids.
+        Resource types of a failed search are left out of found. With a
+        writer the entries are written at once and found only counts them
+        (except Medications, they are collected as before)."""
+        if result is None:
+            return
+        entries, med_ids = result
+        for resource in step.provides:
+            found.setdefault(resource, [] if writer is None or resource == "Medication" else 0)
+        resource_type = compile_path("resource.resourceType")
+        for item in entries:
+            resource = resource_type.first(item)
+            if resource not in step.provides:
+                continue
+            if writer is None or resource == "Medication":
+                found[resource].append(item)
+            else:
+                writer.write(item)
+                found[resource] += 1
+        for med_id in med_ids:
+            if med_id not in med_id_lst:
+                med_id_lst.append(med_id)
+
+    def pageSink(self, step, found, med_id_lst, writer):
+        """returns a sink for searchResources() that writes the pages of a
+        planned search as they arrive (None without writer)"""
+        if writer is None:
+            return None
+
+        def sink(page):
+            self.collectStep(step, (page, ()), found, med_id_lst, writer)
+
+        return sink
+
+    def includedMedications(self, found, medications):
+        """moves the included Medications of found to medications (once per
+        id) and medication_cache, returns their ids"""
+        included = set()
+        resource_id = compile_path("resource.id")
+        for item in found.pop("Medication", []):
+            med = resource_id.first(item)
+            if med in included:
+                continue
+            included.add(med)
+            self.medication_cache.put(med, item)
+            medications.append(item)
+
+        return included
+
+    def assembleRecord(self, enc_id, plan, found, medications, writer=None):
+        """returns the entries of a record in the order of the requested
+        resources, warns about requested resources that weren't found.
+        With a writer (see collectStep()) the medications are written and
+        nothing is returned."""
+        res_lst = []
+        for resource in plan.resources:
+            if resource == "Medication":
+                if writer is not None:
+                    writer.write_all(medications)
+                else:
+                    res_lst.extend(medications)
+                continue
+            if resource in found and not found[resource]:
+                msg = "Warning: Encounter ID " + \
+                    enc_id + \
+                    " -> Requested resource (" + \
+                    resource + \
+                    "): No resource found"
+                self.warningstatus = True
+                if self.logpath is not None:
+                    self.writeLogmsg(msg)
+            if writer is None:
+                res_lst.extend(found.get(resource, []))
+
+        return res_lst
+
+    def saveBundle(self, bundle, savepath, destinationfile, pretty=False):
+        path_str = savepath + "/" + destinationfile
+        serialization.dump(bundle, path_str, pretty=pretty)
+        self.printSaved(path_str)
+
+    def openWriter(self, savepath, destinationfile, output="json", compress=False, pretty=False, form="json"):
+        path_str = savepath + "/" + destinationfile
+        header = self.utils.create_bundle(res_lst=None, btype="transaction", form=form)
+
+        return BundleWriter(path_str, output=output, compress=compress, bundle=header, pretty=pretty)
+
+    def printSaved(self, path_str):
+        print("-----------------------------------------------")
+        print("Bundle created and saved to " + path_str + ".")
+        if self.errorstatus or self.warningstatus:
+            print("Errors have occured. Please check the log, if enabled.")
+
+    def unresolvedPatient(self, enc_id, resource):
+        msg = "Warning: Encounter ID " + \
+            enc_id + \
+            " -> Requested resource (" + \
+            resource + \
+            "): Patient unknown, not searched"
+        self.errorstatus = True
+        print(msg)
+        self.writeLogmsg(msg)
+
+    def invalidEncounter(self, enc_id):
+        msg = "Encounter identifier validation failed: Encounter ID " + enc_id
+        self.errorstatus = True
+        print(msg)
+        self.writeLogmsg(msg)
+
+    def resolveEncounters(self, enc_no_lst, form="json"):
+        """validates the encounters and resolves their patients (the
+        encounter's subject) with comma-separated _id searches of up to
+        enc_batch_size encounters. Fills valid_encounters and encounter_index,
+        returns the list of encounter ids that don't exist on the server.
+        Encounters of failed searches are neither valid nor invalid, they
+        are validated one by one by getRecord()."""
+        todo = [enc for enc in dict.fromkeys(enc_no_lst) if enc not in self.valid_encounters]
+        invalid = []
+        for chunk in id_chunks(todo, self.enc_batch_size):
+            found = set()
+            search_url = self.encounterBatchUrl(chunk)
+            while search_url is not None:
                 if self.verbose > 0:
                     print(search_url)
-                req = requests.get(search_url)
-                self.printRequestsMessage(req, search_url)
-                downloads = str(req.content, encoding='cp1252')
-
-                if form == "json":
-                    json_data = json.loads(downloads)
-                    try:
-                        for item in json_data["entry"]:
-                            if self.validate_resolve(item) is not None:
-                                item = self.validate_resolve(item)
-                                res_lst.append(item)
-                            if (
-                                resource == "MedicationAdministration" or
-                                resource == "MedicationStatement" or
-                                resource == "MedicationRequest"
-                            ):
-                                try:
-                                    med_id = item["resource"]["medicationReference"]["reference"]
-                                    med_id = med_id.split("Medication/", 1)[1]
-                                    if med_id not in med_id_lst and "?" not in med_id:
-                                        med_id_lst.append(med_id)
-                                except KeyError:
-                                    pass
-                    except KeyError:
-                        msg = "Warning: Encounter ID " + \
-                            enc_no[0] + \
-                            " -> Requested resource (" + \
-                            resource + \
-                            "): No resource found"
-                        self.errorstatus = True
-                        if self.logpath is not None:
-                            self.writeLogmsg(msg)
-
-        bundle = self.utils.create_bundle(res_lst=res_lst, btype="transaction", form=form)
+                req = self.transport.get(search_url)
+                if not self.printRequestsMessage(req, search_url):
+                    found = None
+                    break
+                json_data = serialization.loads_response(req)
+                self.indexEncounters(json_data, found)
+                search_url = next_link(json_data)
 
-        if savepath is not None:
-            path_str = savepath + "/" + destinationfile
-            with open(path_str, "w", encoding="utf-8") as f:
-                json.dump(bundle, f, ensure_ascii=False, indent=4)
-                print("-----------------------------------------------")
-                print("Bundle created and saved to " + path_str + ".")
-                if self.errorstatus:
-                    print("Errors have occured. Please check the log, if enabled.")
+            if found is not None:
+                invalid.extend(enc for enc in chunk if enc not in found)
 
-        return bundle
+        return invalid
+
+    def encounterBatchUrl(self, chunk):
+        return self.fhirbase + "Encounter?_id=" + ",".join(chunk) + \
+            "&_elements=subject&_count=" + str(len(chunk))
+
+    def indexEncounters(self, json_data, found):
+        """books the encounters of a searchset page as valid and their
+        subjects in encounter_index, adds their ids to found"""
+        encounter_id = compile_path("resource.id")
+        subject = compile_path("resource.subject.reference")
+        for item in json_data.get("entry", []):
+            if compile_path("resource.resourceType").first(item) != "Encounter":
+                continue
+            enc = encounter_id.first(item)
+            found.add(enc)
+            self.valid_encounters.add(enc)
+            pat = patient_id(subject.first(item))
+            if pat is not None:
+                self.encounter_index.setdefault(enc, pat)
+
+    def groupByPatient(self, enc_no_lst, config_path, profile, form="json"):
+        """resolves the patient of every encounter (from encounter_index if
+        known), returns a dict patient id -> list of encounter ids
+        (encounters whose patient can't be resolved under None). Register
+        the groups via registerPatient() before loading their records."""
+        res_dict = self.loadConfig(config_path, profile)
+        groups = {}
+        for enc in enc_no_lst:
+            if enc in self.encounter_index:
+                pat_no = [self.encounter_index[enc]]
+            else:
+                pat_no = self.getPatientNumber([enc], res_dict, form)
+            groups.setdefault(pat_no[0] if pat_no else None, []).append(enc)
+
+        return groups
+
+    def registerPatient(self, pat_no, enc_no_lst):
+        """announces the encounters of a patient, its patient-scoped
+        resources are kept in patient_cache until the last one is processed"""
+        self.pending_patients[pat_no] = self.pending_patients.get(pat_no, 0) + len(enc_no_lst)
+        for enc in enc_no_lst:
+            self.encounter_index[enc] = pat_no
+
+    def releasePatient(self, pat_no, req_resources):
+        """called after an encounter of pat_no is processed, evicts the
+        patient's cached resources after its last registered encounter"""
+        if pat_no not in self.pending_patients:
+            return
+        self.pending_patients[pat_no] -= 1
+        if self.pending_patients[pat_no] <= 0:
+            del self.pending_patients[pat_no]
+            for resource in req_resources:
+                self.patient_cache.pop((pat_no, resource))
 
     def writeLogmsg(self, msg):
-        with open(self.logpath, "a") as f:
-            current_time = time.strftime("%m/%d/%Y, %H:%M:%S")
-            msg = current_time + " " + msg + "\n"
-            f.writelines(msg)
+        if self.log is not None:
+            self.log.write(msg)
 
     def getPatientNumber(self, enc_no, res_dict, form="json"):
         pat_no = None
         search_url = self.fhirbase + "Patient" + res_dict["Patient"][0] + enc_no[0]
-        print(search_url)
-        req = requests.get(search_url)
-        downloads = str(req.content, encoding='cp1252')
-        if form == "json":
-            json_data = json.loads(downloads)
-            try:
-                for item in json_data["entry"]:
-                    pat_no = item["resource"]["id"]
-                return [pat_no]
-            except KeyError:
-                msg = "Warning: Encounter ID " + \
-                    enc_no[0] + \
-                    " -> Requested resource (Patient): No resource found"
-                print(msg)
-                self.errorstatus = True
-                self.writeLogmsg(msg)
+        if self.verbose > 0:
+            print(search_url)
+        req = self.transport.get(search_url)
+        if not req.ok:
+            self.printRequestsMessage(req, search_url)
+            return None
+        json_data = serialization.loads_response(req)
+        try:
+            for item in json_data["entry"]:
+                pat_no = item["resource"]["id"]
+            return [pat_no]
+        except KeyError:
+            msg = "Warning: Encounter ID " + \
+                enc_no[0] + \
+                " -> Requested resource (Patient): No resource found"
+            print(msg)
+            self.warningstatus = True
+            self.writeLogmsg(msg)
 
     def getMedicationResources(self, med_id_lst, form="json"):
         res_lst = []
+        missing = []
         for med in med_id_lst:
-            search_url = self.fhirbase + "Medication?_id=" + med
-            if self.verbose > 0:
-                print(search_url)
-            req = requests.get(search_url)
-            self.printRequestsMessage(req, search_url)
-            downloads = str(req.content, encoding='cp1252')
-            if form == "json":
-                json_data = json.loads(downloads)
-                try:
-                    for item in json_data["entry"]:
-                        res_lst.append(item)
-                except KeyError:
+            item = self.medication_cache.get(med)
+            if item is None:
+                missing.append(med)
+            else:
+                res_lst.append(item)
+
+        for chunk in id_chunks(missing, self.med_batch_size):
+            found = set()
+            search_url = self.fhirbase + "Medication?_id=" + ",".join(chunk) + \
+                "&_count=" + str(len(chunk))
+            while search_url is not None:
+                if self.verbose > 0:
+                    print(search_url)
+                req = self.transport.get(search_url)
+                if not self.printRequestsMessage(req, search_url):
+                    break
+                json_data = serialization.loads_response(req)
+                for item in self.pipeline.process(json_data.get("entry", [])):
+                    med = compile_path("resource.id").first(item)
+                    self.medication_cache.put(med, item)
+                    found.add(med)
+                    res_lst.append(item)
+                search_url = next_link(json_data)
+
+            for med in chunk:
+                if med not in found:
                     msg = "Warning: Medication ID " + \
                         med + \
                         " -> Requested resource (Medication): No resource found"
-                    self.errorstatus = True
+                    self.warningstatus = True
                     if self.logpath is not None:
                         self.writeLogmsg(msg)
 
@@ -237,14 +641,12 @@ class Loader():
 
     def checkValidEncounter(self, enc_no):
         search_url = self.fhirbase + "Encounter?_id=" + enc_no[0]
-        req = requests.get(search_url)
+        req = self.transport.get(search_url)
         errormsg = "Encounter identifier validation failed."
         if not self.printRequestsMessage(req, search_url):
             self.writeLogmsg(errormsg)
             return False
-        self.printRequestsMessage(req, search_url)
-        downloads = str(req.content, encoding='cp1252')
-        json_data = json.loads(downloads)
+        json_data = serialization.loads_response(req)
         if json_data["total"] > 0:
             return True
         else:
@@ -253,8 +655,7 @@ class Loader():
 
     def loadConfig(self, config_path, profile):
         res_dct = {}
-        with open(config_path, "r") as f:
-            json_data = json.load(f)
+        json_data = serialization.load(config_path)
 
         for _ in json_data[profile]:
             res_dct[_["resourceType"]] = [_["loadingSuffix"], [_["loadingCode"]]]
@@ -263,7 +664,8 @@ class Loader():
 
     def validate_resolve(self, res):
         """
-        checks if certain FHIR rules are violated and tries to resolve them
+        checks if certain FHIR rules are violated and tries to resolve them,
+        applies the Loader's RulePipeline to a single entry
 
         Parameters:
         -------------
@@ -274,67 +676,151 @@ class Loader():
         a (in case corrected) resource as dict
         """
 
-        to_check = self.utils.get(i="", s=res, t="resource", f="json")["value"][0]
-
-        # checks for a certain non-resolvable medication reference occuring in
-        # ID Berlin's MedicationStatements with non-standardised medication prescriptions.
-        # If found: delete resource and return None object
-        try:
-            if "Medication/?" == to_check["resource"]["medicationReference"]["reference"]:
-                msg = "Warning: MedicationStatement deleted due to non-resolvable reference ?."
-                self.writeLogmsg(msg)
-                return None
-        except KeyError:
-            pass
-
-        # checks if there is a transaction verb. If not: add one
-        if "request" not in to_check:
-            res_type = self.utils.get(i="resource.resourceType",
-                                      s=to_check,
-                                      t="resource",
-                                      f="json")["value"][0]
-            res_id = self.utils.get(i="resource.id", s=to_check, t="resource", f="json")["value"][0]
-            to_check["request"] = {
-                "method": "PUT",
-                "url": res_type + "/" + res_id
-            }
-
-        return to_check
+        return self.pipeline.apply(res)
 
 
 class Connector():
+    """A class that transfers patients' records from one FHIR server to another.
+    Every record is downloaded via Loader and uploaded as a transaction bundle.
+    Attributes
+    --------------
+    fhirbase_source : str
+        a raw string representing the source's FHIR-base incl. trailing "/"
+    fhirbase_destination : str
+        a raw string representing the destination's FHIR-base incl. trailing "/"
+    enc_no_lst : list of strings
+        encounter ids that are to be transferred
+    incr : bool
+        if True, encounters already existing on the destination are omitted
+    statepath : str
+        a raw string representing the sync state database (sqlite) incl. path.
+        If given, every transferred encounter is checkpointed there and
+        incremental runs look encounters up in it instead of scanning the
+        destination (which is done only once per destination). An interrupted
+        run resumes where it stopped if restarted with incr=True.
+    logpath : str
+        a raw string representing the logfile's name incl. path
+    verbose : int
+        integer, sets the verbosity level (0: low, 1: high verbosity [default])
+    transport : Transport
+        shared HTTP layer for source and destination, a new one is created if
+        not given. Thread pool workers share it, process pool workers get a
+        copy with the same settings. Its metrics (Connector.metrics) collect
+        the run's timers and request statistics; process pool workers
+        collect metrics of their own, which are not exported.
+    medication_cache : LRUCache
+        run-wide cache of Medication entries, see Loader
+    pipeline : RulePipeline
+        validation/rewrite rules, see Loader. Thread pool workers share it
+        (and its counters), process pool workers count on their own.
+    debug_path : str
+        if given, every downloaded bundle is written to this file before
+        its upload (for debugging, the file is overwritten every time)
+    include, revinclude
+        combine searches via _include/_revinclude, see Loader
+    stages : StagedPipeline
+        the stages of the last connect() with pool="staged" (throughput,
+        utilization and queue depths: stages.snapshot()), else None
+    fingerprints : FingerprintIndex
+        if given, resources that are unchanged since their last upload to
+        the destination are left out of the transactions (see
+        fhirutils/fingerprint.py). Thread pool workers share it, process
+        pool workers open the database on their own.
+    Methods
+    --------------
+    connect(req_resources, config_path, profile, method, count, form, workers, pool)
+        entry method, transfers every encounter in enc_no_lst
+    upload_record(enc_no, req_resources, config_path, profile, method, count, form)
+        downloads a single encounter's record and uploads it to the destination
+    download_record(enc_no, req_resources, config_path, profile, count, form)
+        downloads a single encounter's record as transaction bundle
+    sync(req_resources, config_path, profile, method, count, form, overlap)
+        delta synchronisation, transfers only the records that changed since
+        the last sync
+    resolve_encounters(progress, failed, form)
+        validates enc_no_lst in batches, reports the invalid encounters
+    report_upload(enc_no, results)
+        prints/logs the failed transactions of an uploaded record
+    report_error(enc_no, error)
+        prints/logs a request of a record that failed after its retries
+    """
+
     def __init__(self,
                  fhirbase_source=None,
                  fhirbase_destination=None,
                  enc_no_lst=None,
                  incr=False,
                  logpath=None,
-                 verbose=1):
+                 verbose=1,
+                 transport=None,
+                 medication_cache=None,
+                 statepath=None,
+                 pipeline=None,
+                 debug_path=None,
+                 include=False,
+                 revinclude=False,
+                 fingerprints=None):
         self.logpath = logpath
+        self.log = LogWriter.get(logpath) if logpath is not None else None
         self.fhirbase_source = fhirbase_source
         self.fhirbase_destination = fhirbase_destination
         self.errorstatus = False
         self.verbose = verbose
-        self.utils = Utils()
+        self.transport = transport if transport is not None else Transport()
+        self.metrics = self.transport.metrics
+        self.utils = Utils(transport=self.transport)
+        self.debug_path = debug_path
+        self.stages = None
+        self.fingerprints = fingerprints
+        self.invalid_encounters = []
+        # enc_no_lst before the incr filter, see sync()
+        self._requested = enc_no_lst
+
+        # everything a worker needs to build a Connector of its own
+        self._options = {
+            "fhirbase_source": fhirbase_source,
+            "fhirbase_destination": fhirbase_destination,
+            "logpath": logpath,
+            "verbose": verbose,
+            "transport": self.transport,
+            "debug_path": debug_path,
+            "include": include,
+            "revinclude": revinclude,
+            "fingerprints": fingerprints
+        }
+
+        self.syncstate = None
+        if statepath is not None:
+            self.syncstate = SyncState(statepath, self.fhirbase_destination)
 
         if incr:
             print("Matching encounter IDs for incremental upload ...")
             fhir_search = self.fhirbase_destination + "Encounter?_summary=true"
-            destination_encounters = self.get_encounters_list(fhir_search=fhir_search)
-            self.enc_no_lst = []
-            for item in enc_no_lst:
-                if item not in destination_encounters:
-                    self.enc_no_lst.append(item)
+            if self.syncstate is None:
+                destination_encounters = self.scan_destination(fhir_search) or set()
+                self.enc_no_lst = [item for item in enc_no_lst if item not in destination_encounters]
+            else:
+                if not self.syncstate.is_seeded():
+                    destination_encounters = self.scan_destination(fhir_search)
+                    # an incomplete scan must not be stored as the destination's state
+                    if destination_encounters is not None:
+                        self.syncstate.seed(destination_encounters)
+                self.enc_no_lst = self.syncstate.pending(enc_no_lst)
             dif = len(enc_no_lst) - len(self.enc_no_lst)
             print("Done. Skip " + str(dif) + " encounters.")
         else:
             self.enc_no_lst = enc_no_lst
 
-        self.loader = Loader(fhirbase=self.fhirbase_source, logpath=self.logpath)
-
-        if self.logpath is not None:
-            with open(self.logpath, "w") as _:
-                pass
+        self.loader = Loader(fhirbase=self.fhirbase_source,
+                             logpath=self.logpath,
+                             verbose=self.verbose,
+                             transport=self.transport,
+                             medication_cache=medication_cache,
+                             pipeline=pipeline,
+                             include=include,
+                             revinclude=revinclude)
+        self._options["medication_cache"] = self.loader.medication_cache
+        self._options["pipeline"] = self.loader.pipeline
 
     def connect(self,
                 req_resources,
@@ -342,27 +828,387 @@ class Connector():
                 profile,
                 method="PUT",
                 count=100,
-                form="json"):
-
-        time_lst = []
-
-        for i, enc in enumerate(self.enc_no_lst):
-            time_start = timer()
-            self.upload_record(enc,
-                               req_resources,
-                               config_path,
-                               profile,
-                               method=method,
-                               count=count,
-                               form=form)
-            time_end = timer()
-            time_delta = time_end - time_start
-            time_lst.append(time_delta)
-            time_array = np.array(time_lst)
-            time_mean = np.mean(time_array)
-            eta = (len(self.enc_no_lst) - i) * time_mean
-            eta = str(datetime.timedelta(seconds=eta))
-            print("Estimated time: " + eta)
+                form="json",
+                workers=1,
+                pool="thread",
+                max_entries=None,
+                max_bytes=None,
+                compress=False,
+                upload_workers=1,
+                metrics_path=None,
+                metrics_format="json",
+                metrics_interval=None,
+                stage_workers=None,
+                queue_size=None):
+        """entry method, transfers every encounter in enc_no_lst
+        Parameters
+        --------------
+        req_resources : list of strings
+            contains the the resources' description that are to be transferred
+        config_path : raw string
+            path to config file
+        profile : string
+            FHIR profile that is loaded from config file
+        method : string
+            http-request method used for the upload, "PUT" or "POST"
+        count : integer
+            matches FHIR-search's _count=, default 100
+        form : string
+            sets FHIR represantation: json or xml (XML responses are converted
+            to json one entry at a time, see xmlio.py)
+        workers : integer
+            number of encounters that are transferred in parallel, default 1
+        pool : string
+            "thread" (default) or "process", the kind of worker pool used if
+            workers > 1. Every worker has its own Loader, error state and
+            logfile (logpath with the worker's name appended).
+            "staged" transfers the records in three stages with threads of
+            their own, connected by bounded queues: download (the records of
+            workers patients at a time), transform (serialization and
+            chunking of the bundles) and upload. Records are downloaded
+            while previous ones are uploaded; if the destination is slower
+            the downloads wait for room in the queues.
+        stage_workers : dict
+            with pool="staged": number of threads of the stages "download",
+            "transform" and "upload", default workers, 1 and workers
+        queue_size : integer
+            with pool="staged": maximum number of records waiting in front of
+            a stage, default twice the stage's threads
+        max_entries, max_bytes, compress, upload_workers
+            upload options, see upload_record()
+        metrics_path : raw string
+            if given, the run's metrics (see Metrics) are written to this file
+            at the end of the run
+        metrics_format : string
+            "json" (default) or "prometheus" (textfile collector format)
+        metrics_interval : float
+            if given, the metrics are also written every metrics_interval seconds
+        Return
+        --------------
+        list of encounter ids whose transfer reported errors
+        """
+
+        args = (req_resources, config_path, profile)
+        kwargs = {"method": method,
+                  "count": count,
+                  "form": form,
+                  "max_entries": max_entries,
+                  "max_bytes": max_bytes,
+                  "compress": compress,
+                  "upload_workers": upload_workers}
+        progress = Progress(len(self.enc_no_lst))
+        failed = []
+
+        enc_no_lst = self.resolve_encounters(progress, failed, form)
+        groups = self.group_encounters(req_resources, config_path, profile, form, enc_no_lst)
+
+        if metrics_path is not None and metrics_interval is not None:
+            self.metrics.start_export(metrics_path, metrics_format, metrics_interval)
+        try:
+            if pool == "staged":
+                self.transfer_staged(groups, args, kwargs, workers, stage_workers, queue_size, progress, failed)
+            elif workers <= 1:
+                for pat, encs in groups:
+                    if pat is not None:
+                        self.loader.registerPatient(pat, encs)
+                    for enc in encs:
+                        error = self.transfer(enc, *args, **kwargs)
+                        self.finish(enc, error, progress, failed)
+            else:
+                self.transfer_parallel(groups, args, kwargs, workers, pool, progress, failed)
+        finally:
+            if self.syncstate is not None:
+                self.syncstate.commit()
+            if self.log is not None:
+                self.log.flush()
+            if metrics_path is not None:
+                self.metrics.stop_export()
+                self.metrics.export(metrics_path, metrics_format)
+
+        if self.verbose > 0:
+            print("Rules: " + self.loader.pipeline.summary())
+            if pool == "staged":
+                print("Stages: " + self.stages.summary())
+            if self.fingerprints is not None:
+                print("Unchanged resources skipped: " + str(self.fingerprints.skipped))
+
+        return failed
+
+    def sync(self,
+             req_resources,
+             config_path,
+             profile,
+             method="PUT",
+             count=100,
+             form="json",
+             overlap=300,
+             **kwargs):
+        """delta synchronisation of the encounters in enc_no_lst (all of
+        them, also with incr=True), requires statepath. Every requested
+        resource type is searched on the source with
+        _lastUpdated=gt<watermark> of the last sync; only the records the
+        changed resources belong to (see delta.py) and the encounters that
+        weren't transferred yet are transferred, changed Medications are
+        uploaded on their own. The first sync of a profile (or of a newly
+        requested resource type) transfers every encounter.
+        The watermarks are the source's time at the start of the sync minus
+        overlap seconds (for resources committed while the sync started);
+        they are stored only if no transfer failed, so failed changes are
+        found again by the next sync. If the changes can't be searched
+        completely nothing is transferred, the watermarks are kept and every
+        encounter is returned as failed.
+        Parameters
+        --------------
+        req_resources, config_path, profile, count, form
+            see connect()
+        method : string
+            "PUT" (required, records are overwritten by id)
+        overlap : integer
+            seconds subtracted from the new watermarks, default 300
+        kwargs
+            further options of connect(), e.g. workers and pool
+        Return
+        --------------
+        list of encounter ids whose transfer reported errors
+        """
+
+        watermarks = self._sync_start(req_resources, config_path, profile, method)
+        new_mark, scan = self._scan_changes(watermarks, count, form, overlap)
+        if new_mark is None:
+            return list(self._requested)
+        if scan is not None and scan.patients:
+            # the patients of the encounters, to find the records of changed patients
+            self.loader.resolveEncounters(self._requested, form)
+        self.enc_no_lst = self._sync_encounters(scan)
+
+        failed = self.connect(req_resources, config_path, profile, method=method, count=count, form=form, **kwargs)
+        medications_ok = scan is None or not scan.medications or \
+            self.upload_medications(scan.medications, kwargs)
+        self._sync_finish(profile, watermarks, new_mark, failed, medications_ok)
+
+        return failed
+
+    def _sync_start(self, req_resources, config_path, profile, method):
+        """checks the options of a delta sync, returns the watermarks of the
+        requested resource types (None if there is none yet)"""
+        if self.syncstate is None:
+            raise ValueError("A delta sync requires a statepath")
+        if method != "PUT":
+            raise ValueError("A delta sync requires method PUT, POST would duplicate the resources")
+        res_dict = self.loader.loadConfig(config_path, profile)
+
+        return {r: self.syncstate.watermark(profile, r)
+                for r in dict.fromkeys(req_resources) if r in res_dict or r == "Medication"}
+
+    def _scan_changes(self, watermarks, count=100, form="json", overlap=300):
+        """returns the new watermark (the source's time minus overlap) and
+        the DeltaScan of the resources changed since watermarks, None if a
+        watermark is missing; (None, None) if the scan failed"""
+        try:
+            req = self.transport.get(self.fhirbase_source + "Encounter?_summary=count&_format=" + form)
+            new_mark = format_instant(server_time(req) - datetime.timedelta(seconds=overlap))
+            if not all(watermarks.values()):
+                return new_mark, None
+
+            scan = DeltaScan()
+            scope = set(self._requested)
+            with self.metrics.timer("delta_scan"):
+                for resource_type, mark in watermarks.items():
+                    fhir_search = self.fhirbase_source + resource_type + "?_lastUpdated=gt" + mark + \
+                        "&_format=" + form + "&_count=" + str(count)
+                    for resource in self.utils.iter_link_search(fhir_search, prefetch=True):
+                        scan.add(resource, scope)
+        except requests.RequestException as e:
+            # a partial scan would miss changes, nothing is transferred
+            msg = "Delta sync: the search for changes failed, the watermarks are kept: " + str(e)
+            self.errorstatus = True
+            print(msg)
+            if self.logpath is not None:
+                self.writeLogmsg(msg)
+            return None, None
+
+        return new_mark, scan
+
+    def _sync_encounters(self, scan):
+        """returns the encounters a delta sync transfers: the ones scan
+        affects and the ones not transferred yet, every one without scan"""
+        if scan is None:
+            print("Delta sync: no watermark yet, transferring every encounter")
+            return list(self._requested)
+        affected = set(scan.affected(self._requested, self.loader.encounter_index))
+        affected.update(self.syncstate.pending(self._requested))
+        enc_no_lst = [enc for enc in self._requested if enc in affected]
+        changed = ", ".join(r + ": " + str(n) for r, n in scan.changed.items()) or "none"
+        print("Delta sync: changed resources " + changed + ", " + str(len(enc_no_lst)) + " encounters to transfer")
+
+        return enc_no_lst
+
+    def _sync_finish(self, profile, watermarks, new_mark, failed, medications_ok):
+        """stores the new watermarks unless a transfer failed"""
+        if not medications_ok:
+            # the Medications are searched again by the next sync
+            watermarks.pop("Medication", None)
+        invalid = set(self.invalid_encounters)
+        if any(enc not in invalid for enc in failed):
+            print("Errors have occured, the watermarks are kept.")
+            return
+        self.syncstate.set_watermarks(profile, {r: new_mark for r in watermarks})
+
+    def upload_medications(self, entries, kwargs):
+        """uploads changed Medications as transaction(s), returns True if
+        every transaction succeeded"""
+        bundle = self.utils.create_bundle(res_lst=self.loader.pipeline.process(entries), btype="transaction")
+        uploader = BundleUploader(self.transport,
+                                  self.fhirbase_destination,
+                                  method="PUT",
+                                  max_entries=kwargs.get("max_entries"),
+                                  max_bytes=kwargs.get("max_bytes"),
+                                  compress=kwargs.get("compress", False),
+                                  fingerprints=self.fingerprints)
+        with self.metrics.timer("upload"):
+            results = uploader.upload(bundle)
+        for result in results:
+            if not result.ok:
+                msg = "Upload Error: changed Medications, transaction " + str(result.index + 1) + \
+                    "/" + str(len(results)) + ". Status code: " + str(result.status) + " " + result.message
+                print(msg)
+                self.writeLogmsg(msg)
+
+        return all(result.ok for result in results)
+
+    def resolve_encounters(self, progress, failed, form="json"):
+        """validates enc_no_lst and resolves the encounters' patients in
+        batches (see Loader.resolveEncounters). Invalid encounters are
+        reported in one summary and booked as failed, returns the others."""
+        with self.metrics.timer("validate_encounter"):
+            invalid = self.loader.resolveEncounters(self.enc_no_lst, form)
+        self.invalid_encounters = invalid
+        self.report_invalid(invalid, progress, failed)
+        invalid = set(invalid)
+
+        return [enc for enc in self.enc_no_lst if enc not in invalid]
+
+    def report_invalid(self, invalid, progress, failed):
+        if not invalid:
+            return
+        msg = "Encounter identifier validation failed for " + str(len(invalid)) + \
+            " of " + str(len(self.enc_no_lst)) + " encounters: " + ", ".join(invalid)
+        print(msg)
+        self.writeLogmsg(msg)
+        for enc in invalid:
+            failed.append(enc)
+            if self.syncstate is not None:
+                self.syncstate.checkpoint(enc, failed=True)
+            progress.update(failed=True)
+
+    def group_encounters(self, req_resources, config_path, profile, form="json", enc_no_lst=None):
+        """returns enc_no_lst as a list of (patient id, encounter ids).
+        If the profile loads requested resources by patient id, encounters are
+        grouped by patient, so that the patient's resources are downloaded
+        only once. Otherwise every encounter is a group of its own (with its
+        patient id if already known)."""
+        if enc_no_lst is None:
+            enc_no_lst = self.enc_no_lst
+        res_dict = self.loader.loadConfig(config_path, profile)
+        if not any(res_dict[r][1][0] == "patient_id" for r in req_resources if r in res_dict):
+            return [(self.loader.encounter_index.get(enc), [enc]) for enc in enc_no_lst]
+
+        groups = self.loader.groupByPatient(enc_no_lst, config_path, profile, form)
+        unresolved = groups.pop(None, [])
+
+        return list(groups.items()) + [(None, [enc]) for enc in unresolved]
+
+    def transfer_parallel(self, groups, args, kwargs, workers, pool, progress, failed):
+        """transfers the groups of encounters with a pool of workers, all
+        encounters of a group are transferred by the same worker"""
+        if pool == "thread":
+            executor = ThreadPoolExecutor(max_workers=workers,
+                                          thread_name_prefix="worker",
+                                          initializer=_init_worker,
+                                          initargs=(self._options,))
+        elif pool == "process":
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           initializer=_init_worker,
+                                           initargs=(self._options,))
+        else:
+            raise ValueError("Unknown pool type: " + str(pool))
+
+        with executor:
+            futures = [executor.submit(_transfer, pat, encs, args, kwargs)
+                       for pat, encs in groups]
+            for future in as_completed(futures):
+                for enc, error in future.result():
+                    if error and self.logpath is not None:
+                        self.writeLogmsg("Transfer Error: Encounter ID " + enc)
+                    self.finish(enc, error, progress, failed)
+
+    def transfer_staged(self, groups, args, kwargs, workers, stage_workers, queue_size, progress, failed):
+        """transfers the groups of encounters with a StagedPipeline (see
+        connect()), all encounters of a group are downloaded by the same
+        thread"""
+        threads = {"download": max(workers, 1), "transform": 1, "upload": max(workers, 1)}
+        threads.update(stage_workers or {})
+        download_options = {k: kwargs[k] for k in ("count", "form")}
+        uploader = BundleUploader(self.transport,
+                                  self.fhirbase_destination,
+                                  method=kwargs["method"],
+                                  max_entries=kwargs["max_entries"],
+                                  max_bytes=kwargs["max_bytes"],
+                                  compress=kwargs["compress"],
+                                  workers=kwargs["upload_workers"],
+                                  fingerprints=self.fingerprints)
+
+        def download(group):
+            return _download_group(group, args, download_options)
+
+        def transform(record):
+            enc, bundle, error = record
+            if bundle is None:
+                return [(enc, None, None, error)]
+            if self.debug_path is not None:
+                serialization.dump(bundle, self.debug_path)
+            return [(enc, bundle, uploader.prepare(bundle), error)]
+
+        def upload(record):
+            return [_upload_record(record, uploader)]
+
+        def init():
+            _init_worker(self._options)
+
+        self.stages = StagedPipeline([
+            Stage("download", download, threads["download"], queue_size, init),
+            Stage("transform", transform, threads["transform"], queue_size),
+            Stage("upload", upload, threads["upload"], queue_size, init)
+        ], metrics=self.metrics)
+        for enc, error in self.stages.run(groups):
+            if error and self.logpath is not None:
+                self.writeLogmsg("Transfer Error: Encounter ID " + enc)
+            self.finish(enc, error, progress, failed)
+
+    def finish(self, enc_no, error, progress, failed):
+        """books a finished transfer: progress, failed list and checkpoint;
+        error is the transfer's errorstatus, warnings (requested resources
+        that weren't found) don't fail it"""
+        if error:
+            failed.append(enc_no)
+        if self.syncstate is not None:
+            self.syncstate.checkpoint(enc_no, failed=error)
+        status = progress.update(failed=error)
+        if self.verbose > 0:
+            print(status)
+
+    def transfer(self, enc_no, *args, **kwargs):
+        """transfers a single encounter, returns True if errors occured; a
+        request that fails after its retries (e.g. a timeout) fails only
+        this encounter"""
+        self.errorstatus = False
+        self.loader.errorstatus = False
+        try:
+            self.upload_record(enc_no, *args, **kwargs)
+        except requests.RequestException as e:
+            self.report_error(enc_no, e)
+
+        return self.errorstatus or self.loader.errorstatus
 
     def upload_record(self,
                       enc_no,
@@ -371,77 +1217,184 @@ class Connector():
                       profile,
                       method="PUT",
                       count=100,
-                      form="json"):
+                      form="json",
+                      max_entries=None,
+                      max_bytes=None,
+                      compress=False,
+                      upload_workers=1):
+        """downloads a single encounter's record and uploads it to the destination
+        Parameters
+        --------------
+        enc_no, req_resources, config_path, profile, method, count, form
+            see connect()
+        max_entries : integer
+            maximum number of entries per uploaded transaction, None for no limit
+        max_bytes : integer
+            maximum size of an uploaded transaction in bytes, None for no limit
+        compress : bool
+            if True transactions are sent gzip-compressed
+        upload_workers : integer
+            number of transactions that are uploaded in parallel where their
+            dependencies allow it
+        Return
+        --------------
+        list of ChunkResult, one for every uploaded transaction
+        """
 
-        bundle = self.loader.getRecord(enc_no,
-                                       req_resources,
-                                       config_path,
-                                       profile,
-                                       count=count,
-                                       form=form)
+        bundle = self.download_record(enc_no, req_resources, config_path, profile, count=count, form=form)
+        if bundle is None:
+            return []
 
-        with open("testbundle.json", "w") as f:
-            json.dump(bundle, f)
+        if self.debug_path is not None:
+            serialization.dump(bundle, self.debug_path)
 
-        req = None
-        if method == "PUT":
-            req = requests.put(self.fhirbase_destination, json=bundle)
-            print(req.reqtext)
-        elif method == "POST":
-            req = requests.post(self.fhirbase_destination, json=bundle)
+        uploader = BundleUploader(self.transport,
+                                  self.fhirbase_destination,
+                                  method=method,
+                                  max_entries=max_entries,
+                                  max_bytes=max_bytes,
+                                  compress=compress,
+                                  workers=upload_workers,
+                                  fingerprints=self.fingerprints)
+        with self.metrics.timer("upload"):
+            results = uploader.upload(bundle)
 
-        if req.ok:
-            print("Upload completed...")
-        elif req.ok is False:
-            msg = "Upload Error. Status code: " + str(req.status_code)
+        self.report_upload(enc_no, results)
+
+        return results
+
+    def download_record(self, enc_no, req_resources, config_path, profile, count=100, form="json"):
+        """downloads a single encounter's record, returns the transaction
+        bundle or None if the encounter is invalid"""
+        with self.metrics.timer("download"):
+            return self.loader.getRecord(enc_no,
+                                         req_resources,
+                                         config_path,
+                                         profile,
+                                         count=count,
+                                         form=form)
+
+    def report_upload(self, enc_no, results):
+        """prints/logs the failed transactions of an uploaded record"""
+        for result in results:
+            if result.ok:
+                continue
+            msg = "Upload Error: Encounter ID " + enc_no + \
+                  ", transaction " + str(result.index + 1) + "/" + str(len(results)) + \
+                  " (" + str(len(result.entries)) + " entries). Status code: " + \
+                  str(result.status) + " " + result.message
+            self.errorstatus = True
             print(msg)
+            if self.logpath is not None:
+                self.writeLogmsg(msg)
+        if all(result.ok for result in results) and self.verbose > 0:
+            print("Upload completed...")
+
+    def report_error(self, enc_no, error):
+        """prints/logs a request of a record that failed after its retries"""
+        msg = "Transfer Error: Encounter ID " + enc_no + ": " + type(error).__name__ + " " + str(error)
+        self.errorstatus = True
+        print(msg)
+        if self.logpath is not None:
             self.writeLogmsg(msg)
-            content = json.loads(req.content)
-            errormsg = self.utils.get(i="issue.0.details.text",
-                                      s=content,
-                                      t="resource",
-                                      f="json")["value"]
-            self.writeLogmsg(errormsg)
 
     def writeLogmsg(self, msg):
-        with open(self.logpath, "a") as f:
-            current_time = time.strftime("%m/%d/%Y, %H:%M:%S")
-            msg = current_time + " " + msg + "\n"
-            f.writelines(msg)
+        if self.log is not None:
+            self.log.write(msg)
+
+    def scan_destination(self, fhir_search):
+        """returns the ids of the encounters already in the destination, None
+        if the scan fails (the error is reported)"""
+        try:
+            return self.get_encounters_list(fhir_search=fhir_search)
+        except requests.RequestException as e:
+            msg = "Destination scan failed: " + str(e)
+            self.errorstatus = True
+            print(msg)
+            if self.logpath is not None:
+                self.writeLogmsg(msg)
+            return None
 
     def get_encounters_list(self, fhir_search=None):
-        resources = self.utils.link_search(fhir_search=fhir_search)
-        encounters = self.utils.get(i="X.id", s=resources, t="resource", f="json")
-
-        return encounters["value"].values
-
-
-if __name__ == "__main__":
-    logpath = r"log_test.txt"
-    fhirbase_source = r"http://10.50.8.14:8080/fhir/_/"  # set fhirbase of source server
-    fhirbase_destination = r"http://10.50.8.8:8083/"  # set fhirbase of destination server
-    req_resources = ["Encounter", "Patient", "MedicationStatement", "Medication"]
-    config_path = r"config.json"
-    profile = "ID Logik"
-    count = 10000
-    method = "POST"
-
-    encounters = []
-    with open("encounters.csv", "r") as f:  # a csv-file with encounter IDs. 1 encounter ID = 1 line
-        csv_reader = csv.reader(f)
-        _enc = [x[0] for x in csv_reader]
-        for e in _enc:
-            if e not in encounters:
-                encounters.append(e)
-
-    connector = Connector(fhirbase_source=fhirbase_source,
-                          fhirbase_destination=fhirbase_destination,
-                          enc_no_lst=encounters,
-                          incr=False,
-                          logpath=logpath)
-
-    connector.connect(req_resources,
-                      config_path,
-                      profile,
-                      method=method,
-                      count=count)
+        """returns the set of ids of every resource found by fhir_search,
+        the search is streamed page by page; raises requests.HTTPError if a
+        page can't be downloaded"""
+        resources = self.utils.iter_link_search(fhir_search, prefetch=True)
+
+        return {compile_path("id").first(resource) for resource in resources}
+
+
+def patient_id(reference):
+    """returns the id of a (relative or absolute) Patient reference,
+    None for other references"""
+    if reference is None or "Patient/" not in reference:
+        return None
+    pat = reference.rsplit("Patient/", 1)[1].split("/_history/", 1)[0]
+
+    return pat or None
+
+
+# Connector of the current pool worker, see Connector.connect()
+_worker = threading.local()
+
+
+def _init_worker(options):
+    """pool initializer, builds a Connector for the calling worker so that
+    every worker has its own Loader, error state and logfile"""
+    options = dict(options)
+    if options["logpath"] is not None:
+        name = threading.current_thread().name
+        if name == "MainThread":
+            name = "worker-" + str(os.getpid())
+        root, ext = os.path.splitext(options["logpath"])
+        options["logpath"] = root + "." + name + ext
+    _worker.connector = Connector(**options)
+
+
+def _transfer(pat_no, enc_no_lst, args, kwargs):
+    connector = _worker.connector
+    # the encounters were validated by Connector.resolve_encounters()
+    connector.loader.valid_encounters.update(enc_no_lst)
+    if pat_no is not None:
+        connector.loader.registerPatient(pat_no, enc_no_lst)
+
+    return [(enc, connector.transfer(enc, *args, **kwargs)) for enc in enc_no_lst]
+
+
+def _download_group(group, args, options):
+    """download stage of Connector.transfer_staged(), yields (encounter id,
+    bundle, error) for every encounter of a (patient id, encounter ids) group;
+    a request that fails after its retries fails only its encounter"""
+    pat_no, enc_no_lst = group
+    connector = _worker.connector
+    connector.loader.valid_encounters.update(enc_no_lst)
+    if pat_no is not None:
+        connector.loader.registerPatient(pat_no, enc_no_lst)
+    for enc in enc_no_lst:
+        connector.loader.errorstatus = False
+        try:
+            bundle = connector.download_record(enc, *args, **options)
+        except requests.RequestException as e:
+            connector.report_error(enc, e)
+            yield enc, None, True
+            continue
+        yield enc, bundle, connector.loader.errorstatus
+
+
+def _upload_record(record, uploader):
+    """upload stage of Connector.transfer_staged(), returns (encounter id,
+    error)"""
+    enc, bundle, chunks, error = record
+    if bundle is None:
+        return enc, error
+    connector = _worker.connector
+    connector.errorstatus = False
+    try:
+        with connector.metrics.timer("upload"):
+            results = uploader.upload(bundle, chunks)
+    except requests.RequestException as e:
+        connector.report_error(enc, e)
+        return enc, True
+    connector.report_upload(enc, results)
+
+    return enc, error or connector.errorstatus
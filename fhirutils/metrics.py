@@ -0,0 +1,222 @@
+import json
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Series():
+    """count, sum and the most recent samples of a measured value"""
+
+    __slots__ = ("count", "total", "samples")
+
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=max_samples)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def quantiles(self):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "quantiles": {str(q): v for q, v in self.quantiles().items()}
+        }
+
+
+class Metrics():
+    """Thread-safe instrumentation of a transfer run.
+    Collects per-phase timers (e.g. validate_encounter, patient_lookup,
+    search.<resourceType>, medication, bundle, upload) and per server and
+    resource type the number of requests, a status histogram, the bytes
+    downloaded and uploaded and the request latencies. Latency percentiles
+    are computed over the most recent max_samples values of a series.
+    Attributes
+    --------------
+    max_samples : int
+        number of samples kept per series for the percentiles
+    Methods
+    --------------
+    timer(phase)
+        context manager that measures the duration of a phase
+    observe(phase, seconds)
+        records the duration of a phase
+    record_request(server, resource_type, status, seconds, bytes_down, bytes_up)
+        records a http request, status is the http status code or "error"
+    gauge(name, value)
+        sets the current value of a gauge, e.g. a queue's depth
+    snapshot()
+        returns all metrics as dict
+    to_json(), to_prometheus()
+        returns all metrics as json resp. Prometheus text format
+    export(path, fmt)
+        writes the metrics to path, fmt is "json" or "prometheus"
+    start_export(path, fmt, interval), stop_export()
+        export periodically in a background thread
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.phases = {}
+        self.requests = {}
+        self.statuses = {}
+        self.bytes_down = {}
+        self.bytes_up = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+        self._exporter = None
+        self._stop = None
+
+    def __getstate__(self):
+        # process pool workers get empty metrics of their own
+        state = self.__dict__.copy()
+        state.update(phases={}, requests={}, statuses={}, bytes_down={}, bytes_up={},
+                     gauges={}, _exporter=None, _stop=None)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, phase):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.observe(phase, timer() - start)
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            series = self.phases.get(phase)
+            if series is None:
+                series = self.phases[phase] = Series(self.max_samples)
+            series.add(seconds)
+
+    def record_request(self, server, resource_type, status, seconds, bytes_down=0, bytes_up=0):
+        key = (server, resource_type)
+        with self._lock:
+            series = self.requests.get(key)
+            if series is None:
+                series = self.requests[key] = Series(self.max_samples)
+            series.add(seconds)
+            status_key = (server, resource_type, str(status))
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+            self.bytes_down[key] = self.bytes_down.get(key, 0) + bytes_down
+            self.bytes_up[key] = self.bytes_up.get(key, 0) + bytes_up
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "phases": {phase: series.snapshot() for phase, series in self.phases.items()},
+                "gauges": dict(self.gauges),
+                "requests": [
+                    {
+                        "server": server,
+                        "resource_type": resource_type,
+                        "latency": series.snapshot(),
+                        "bytes_downloaded": self.bytes_down.get((server, resource_type), 0),
+                        "bytes_uploaded": self.bytes_up.get((server, resource_type), 0),
+                        "status": {status: n for (s, r, status), n in self.statuses.items()
+                                   if s == server and r == resource_type}
+                    }
+                    for (server, resource_type), series in self.requests.items()
+                ]
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = ["# TYPE fhirutils_phase_seconds summary"]
+        for phase, s in snapshot["phases"].items():
+            labels = 'phase="{0}"'.format(_escape(phase))
+            lines.extend(_summary_lines("fhirutils_phase_seconds", labels, s))
+        lines.append("# TYPE fhirutils_gauge gauge")
+        for name, value in snapshot["gauges"].items():
+            lines.append('fhirutils_gauge{{name="{0}"}} {1}'.format(_escape(name), value))
+        lines.append("# TYPE fhirutils_request_seconds summary")
+        for r in snapshot["requests"]:
+            lines.extend(_summary_lines("fhirutils_request_seconds", _request_labels(r), r["latency"]))
+        lines.append("# TYPE fhirutils_requests_total counter")
+        for r in snapshot["requests"]:
+            for status, n in r["status"].items():
+                lines.append('fhirutils_requests_total{{{0},status="{1}"}} {2}'.format(
+                    _request_labels(r), _escape(status), n))
+        lines.append("# TYPE fhirutils_downloaded_bytes_total counter")
+        for r in snapshot["requests"]:
+            lines.append("fhirutils_downloaded_bytes_total{{{0}}} {1}".format(
+                _request_labels(r), r["bytes_downloaded"]))
+        lines.append("# TYPE fhirutils_uploaded_bytes_total counter")
+        for r in snapshot["requests"]:
+            lines.append("fhirutils_uploaded_bytes_total{{{0}}} {1}".format(
+                _request_labels(r), r["bytes_uploaded"]))
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, fmt="json"):
+        if fmt == "json":
+            text = self.to_json()
+        elif fmt == "prometheus":
+            text = self.to_prometheus()
+        else:
+            raise ValueError("Unknown metrics format: " + str(fmt))
+        # write to a temporary file first, readers never see half a file
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def start_export(self, path, fmt="json", interval=60):
+        self.stop_export()
+        self._stop = threading.Event()
+
+        def run(stop):
+            while not stop.wait(interval):
+                self.export(path, fmt)
+
+        self._exporter = threading.Thread(target=run, args=(self._stop,), daemon=True)
+        self._exporter.start()
+
+    def stop_export(self):
+        if self._exporter is not None:
+            self._stop.set()
+            self._exporter.join()
+            self._exporter = None
+            self._stop = None
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _request_labels(r):
+    return 'server="{0}",resource_type="{1}"'.format(_escape(r["server"]), _escape(r["resource_type"]))
+
+
+def _summary_lines(name, labels, s):
+    lines = ['{0}{{{1},quantile="{2}"}} {3}'.format(name, labels, q, v)
+             for q, v in s["quantiles"].items()]
+    lines.append("{0}_sum{{{1}}} {2}".format(name, labels, s["sum"]))
+    lines.append("{0}_count{{{1}}} {2}".format(name, labels, s["count"]))
+    return lines
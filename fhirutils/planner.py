@@ -0,0 +1,209 @@
+from collections import namedtuple
+
+
+# search parameter of resources that refer to a Medication, used for
+# _include=<resource>:<parameter>
+MEDICATION_REFERENCES = {
+    "MedicationStatement": "medication",
+    "MedicationAdministration": "medication",
+    "MedicationRequest": "medication"
+}
+
+# a search of a record: resource type, suffix and loading code from the
+# config file (code is "encounter_id" or "patient_id"), extra (parameter,
+# value) pairs like ("_include", "Encounter:subject") and the resource types
+# the search returns
+Step = namedtuple("Step", "resource suffix code params provides")
+
+
+class Plan():
+    """The searches that load a record, see QueryPlanner.
+    Attributes
+    --------------
+    resources : list of str
+        the requested resource types in the order of the bundle
+    steps : list of Step
+        independent searches, run in this order (or concurrently)
+    fallbacks : dict
+        resource type -> Step, searches for resources that are expected from
+        an _include/_revinclude; run if the combined search returned none
+    medications : bool
+        if True, referenced medications that were not included are
+        downloaded in batches after the searches
+    needs_patient : bool
+        if True, a search is loaded by patient id, which has to be looked up
+    Methods
+    --------------
+    explain(fhirbase, enc_id, pat_id, form, count)
+        returns the planned requests of a record as a list of lines
+    """
+
+    def __init__(self, resources, steps, fallbacks, medications):
+        self.resources = resources
+        self.steps = steps
+        self.fallbacks = fallbacks
+        self.medications = medications
+        self.needs_patient = any(step.code == "patient_id"
+                                 for step in steps + list(fallbacks.values()))
+
+    def explain(self, fhirbase="", enc_id=None, pat_id=None, form="json", count=100):
+        enc_id = enc_id if enc_id is not None else "{encounter_id}"
+        pat_id = pat_id if pat_id is not None else "{patient_id}"
+        lines = []
+        if self.needs_patient:
+            lines.append("patient lookup of encounter " + enc_id + " (unless resolved in bulk)")
+        for i, step in enumerate(self.steps):
+            lines.append(str(i + 1) + ". " + search_url(fhirbase, step, enc_id, pat_id, form, count) +
+                         " -> " + ", ".join(step.provides))
+        for resource, step in self.fallbacks.items():
+            lines.append("   if no " + resource + " is included: " +
+                         search_url(fhirbase, step, enc_id, pat_id, form, count))
+        if self.medications:
+            lines.append(str(len(self.steps) + 1) + ". " + fhirbase +
+                         "Medication?_id={ids} for referenced medications that are neither "
+                         "cached nor included")
+
+        return lines
+
+
+class QueryPlanner():
+    """Compiles a profile of the config file and the requested resources into
+    the searches of a record.
+    Without includes every requested resource is loaded by its configured
+    search and medications are downloaded in batches afterwards (the
+    requested order doesn't matter). With include=True searches are combined
+    where possible:
+    - Encounter?_id=X&_include=Encounter:subject also returns the Patient if
+      both are loaded by encounter id
+    - MedicationStatement?...&_include=MedicationStatement:medication (also
+      MedicationAdministration and MedicationRequest) returns the referenced
+      Medications
+    With revinclude=True, resources loaded by a reference search on the
+    encounter (e.g. MedicationStatement?encounter=X) are returned by the
+    Encounter search via _revinclude as well. Not every server pages
+    revincluded resources, so this is off by default.
+    Combined searches are only planned for includes the server supports
+    according to capabilities, if given. Resources that are expected from an
+    include but missing are loaded by their own search (see Plan.fallbacks).
+    Attributes
+    --------------
+    res_dict : dict
+        resource type -> [suffix, [loading code]], see Loader.loadConfig()
+    include : bool
+        if True, _include is used
+    revinclude : bool
+        if True, _revinclude is used (requires include)
+    capabilities : dict
+        resource type -> {"searchInclude": [...], "searchRevInclude": [...]}
+        as in a CapabilityStatement, None if unknown (every include is
+        assumed to be supported)
+    Methods
+    --------------
+    plan(req_resources)
+        returns the Plan of a record
+    supports(resource, value, kind)
+        checks capabilities for an include
+    from_capability_statement(res_dict, statement, include, revinclude)
+        builds a planner that uses only the includes the server supports
+    """
+
+    def __init__(self, res_dict, include=False, revinclude=False, capabilities=None):
+        self.res_dict = res_dict
+        self.include = include
+        self.revinclude = revinclude and include
+        self.capabilities = capabilities
+
+    @classmethod
+    def from_capability_statement(cls, res_dict, statement, include=True, revinclude=False):
+        capabilities = {}
+        for rest in (statement or {}).get("rest", []):
+            for resource in rest.get("resource", []):
+                capabilities[resource.get("type")] = {
+                    "searchInclude": resource.get("searchInclude", []),
+                    "searchRevInclude": resource.get("searchRevInclude", [])
+                }
+
+        return cls(res_dict, include=include, revinclude=revinclude, capabilities=capabilities)
+
+    def supports(self, resource, value, kind="searchInclude"):
+        if self.capabilities is None:
+            return True
+        allowed = self.capabilities.get(resource, {}).get(kind, [])
+        return value in allowed or "*" in allowed
+
+    def plan(self, req_resources):
+        resources = list(dict.fromkeys(req_resources))
+        medications = "Medication" in resources
+        searches = {}
+        for resource in resources:
+            if resource == "Medication":
+                continue
+            if resource not in self.res_dict:
+                raise ValueError("No search configured for " + resource + " in the profile")
+            suffix, (code,) = self.res_dict[resource]
+            searches[resource] = Step(resource, suffix, code, (), (resource,))
+
+        fallbacks = {}
+        encounter = searches.get("Encounter")
+        if self.include and encounter is not None and self._by_id(encounter):
+            patient = searches.get("Patient")
+            if (
+                patient is not None and patient.code == "encounter_id" and
+                self.supports("Encounter", "Encounter:subject")
+            ):
+                encounter = self._add(encounter, ("_include", "Encounter:subject"), "Patient")
+                fallbacks["Patient"] = searches.pop("Patient")
+
+            if self.revinclude:
+                for resource, step in list(searches.items()):
+                    param = self._reference_param(step)
+                    value = resource + ":" + str(param)
+                    if (
+                        param is None or
+                        not self.supports("Encounter", value, "searchRevInclude")
+                    ):
+                        continue
+                    encounter = self._add(encounter, ("_revinclude", value), resource)
+                    fallbacks[resource] = searches.pop(resource)
+                    if medications and resource in MEDICATION_REFERENCES:
+                        value = resource + ":" + MEDICATION_REFERENCES[resource]
+                        if self.supports(resource, value):
+                            encounter = self._add(encounter, ("_include:iterate", value), "Medication")
+            searches["Encounter"] = encounter
+
+        if self.include and medications:
+            for resource, step in searches.items():
+                value = resource + ":" + MEDICATION_REFERENCES.get(resource, "")
+                if resource in MEDICATION_REFERENCES and self.supports(resource, value):
+                    searches[resource] = self._add(step, ("_include", value), "Medication")
+
+        # the Encounter search first, it may return further resources
+        steps = sorted(searches.values(), key=lambda step: step.resource != "Encounter")
+
+        return Plan(resources, steps, fallbacks, medications)
+
+    def _by_id(self, step):
+        return step.suffix == "?_id=" and step.code == "encounter_id"
+
+    def _reference_param(self, step):
+        """returns the search parameter of a plain reference search on the
+        encounter (e.g. "encounter" of "?encounter="), None otherwise"""
+        if step.code != "encounter_id" or not step.suffix.startswith("?") or not step.suffix.endswith("="):
+            return None
+        param = step.suffix[1:-1]
+        if not param or param.startswith("_") or any(c in param for c in ":&.="):
+            return None
+        return param
+
+    def _add(self, step, param, provides):
+        return step._replace(params=step.params + (param,),
+                             provides=tuple(dict.fromkeys(step.provides + (provides,))))
+
+
+def search_url(fhirbase, step, enc_id, pat_id, form="json", count=100):
+    """returns the url of a planned search for an encounter resp. patient"""
+    code = enc_id if step.code == "encounter_id" else pat_id if step.code == "patient_id" else step.code
+
+    return fhirbase + step.resource + step.suffix + str(code) + \
+        "".join("&" + key + "=" + value for key, value in step.params) + \
+        "&_format=" + form + "&_count=" + str(count)
@@ -0,0 +1,313 @@
+"""Adaptive rate limiting and concurrency control per FHIR server.
+
+A RateLimiter keeps one HostLimiter per server (host[:port]). Transport
+asks it for a slot before every request and reports the outcome afterwards:
+- the number of concurrent requests is limited by an AIMD controller: the
+  limit grows by one after a limit's worth of fast, successful responses
+  (additive increase) and is cut by backoff on 429 and 5xx responses,
+  connection errors and when the smoothed latency exceeds
+  latency_tolerance times its baseline (multiplicative decrease, at most
+  once per smoothed latency so that one burst of errors counts once).
+  The limit at the last overload is kept as ceiling: the limit grows back
+  to just below it and probes one above it only every probe_interval
+  seconds, because an overload costs a pause (see below), not only a
+  retried request
+- optionally the request rate is capped by a token bucket (max_rate)
+- 429 and 503 responses pause the whole server, for Retry-After seconds if
+  the server sends it, else for an exponential backoff; Transport then
+  sends the request again (see retry_statuses)
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+
+class HostLimiter():
+    """Concurrency limit, rate limit and pause of one server, see module
+    docstring.
+    Attributes
+    --------------
+    limit : float
+        current concurrency limit, requests wait for a slot while
+        in_flight >= int(limit)
+    min_concurrency, max_concurrency : int
+        bounds of limit
+    max_rate : float
+        maximum requests per second, None for no limit
+    in_flight : int
+        requests sent and not answered yet
+    latency : float
+        smoothed latency (exponentially weighted moving average) in seconds
+    baseline : float
+        the lowest smoothed latency seen, rises slowly with latency
+    ceiling : float
+        the limit at the last overload, None before the first
+    paused_until : float
+        clock() until which no request is sent
+    throttled : int
+        number of 429/503 responses
+    decreases : int
+        number of times the limit was cut
+    clock : callable
+        returns the current time in seconds, time.monotonic by default
+    """
+
+    def __init__(self, min_concurrency, max_concurrency, initial_concurrency, max_rate, clock=time.monotonic):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(initial_concurrency)
+        self.max_rate = max_rate
+        self.in_flight = 0
+        self.latency = None
+        self.baseline = None
+        self.ceiling = None
+        self.paused_until = 0.0
+        self.throttled = 0
+        self.decreases = 0
+        self.consecutive = 0
+        self.last_decrease = 0.0
+        self.last_probe = 0.0
+        self.tokens = 1.0
+        self.clock = clock
+        self.refilled = clock()
+        self.cond = threading.Condition()
+
+    def snapshot(self):
+        return {"limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "latency": self.latency,
+                "baseline": self.baseline,
+                "ceiling": self.ceiling,
+                "max_rate": self.max_rate,
+                "paused": max(0.0, self.paused_until - self.clock()),
+                "throttled": self.throttled,
+                "decreases": self.decreases}
+
+
+class RateLimiter():
+    """Adaptive per-server limits of Transport, see module docstring.
+    One instance may be shared by several transports (and threads).
+    Attributes
+    --------------
+    max_concurrency : int
+        default upper bound of a server's concurrency limit
+    min_concurrency : int
+        lower bound of a server's concurrency limit
+    initial_concurrency : int
+        concurrency limit of a server before any feedback, default
+        max_concurrency // 2 (at least min_concurrency)
+    max_rate : float
+        default maximum requests per second of a server, None for no limit
+    hosts : dict
+        per-server settings: FHIR-base url (or host[:port]) -> dict with
+        any of max_concurrency, min_concurrency, initial_concurrency and
+        max_rate, e.g. different caps for the source and the destination
+    backoff : float
+        factor the concurrency limit is multiplied with on overload
+    latency_tolerance : float
+        smoothed latency above latency_tolerance * baseline counts as
+        overload, None to adapt to errors only
+    probe_interval : float
+        seconds between attempts to raise the limit above the ceiling
+    max_retries : int
+        how often a throttled request is sent again
+    max_wait : float
+        maximum pause in seconds (also caps Retry-After)
+    retry_statuses : dict
+        http status -> methods whose throttled requests are sent again;
+        a 503 to a POST is not retried, the server may have processed it
+    clock : callable
+        returns the current time in seconds, time.monotonic by default
+    Methods
+    --------------
+    host(url)
+        returns the HostLimiter of a url's server
+    slot(url)
+        context manager, waits for a slot (and token) of the url's server
+    feedback(url, status, latency, headers)
+        reports the outcome of a request, returns the pause in seconds if it
+        was throttled, else None
+    should_retry(method, status, attempt)
+        whether a throttled request is sent again
+    snapshot()
+        returns the state of every server
+    """
+
+    def __init__(self,
+                 max_concurrency=10,
+                 min_concurrency=1,
+                 initial_concurrency=None,
+                 max_rate=None,
+                 hosts=None,
+                 backoff=0.5,
+                 latency_tolerance=4.0,
+                 probe_interval=10.0,
+                 max_retries=5,
+                 max_wait=300.0,
+                 retry_statuses=None,
+                 clock=time.monotonic):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.max_rate = max_rate
+        self.hosts = {host_key(key): value for key, value in (hosts or {}).items()}
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.probe_interval = probe_interval
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.retry_statuses = retry_statuses if retry_statuses is not None else {
+            429: {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "POST"},
+            503: {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+        }
+        self.clock = clock
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # worker processes start with fresh limiters
+        state = self.__dict__.copy()
+        state["_limiters"] = {}
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def host(self, url):
+        key = host_key(url)
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                options = self.hosts.get(key, {})
+                max_concurrency = options.get("max_concurrency", self.max_concurrency)
+                min_concurrency = min(options.get("min_concurrency", self.min_concurrency), max_concurrency)
+                initial = options.get("initial_concurrency", self.initial_concurrency)
+                if initial is None:
+                    initial = max(min_concurrency, max_concurrency // 2)
+                limiter = HostLimiter(min_concurrency, max_concurrency,
+                                      min(max(initial, min_concurrency), max_concurrency),
+                                      options.get("max_rate", self.max_rate), self.clock)
+                self._limiters[key] = limiter
+        return limiter
+
+    @contextmanager
+    def slot(self, url):
+        limiter = self.host(url)
+        self._acquire(limiter)
+        try:
+            yield limiter
+        finally:
+            with limiter.cond:
+                limiter.in_flight -= 1
+                limiter.cond.notify_all()
+
+    def _acquire(self, limiter):
+        with limiter.cond:
+            while True:
+                wait = self._reserve(limiter)
+                if wait is None:
+                    return
+                limiter.cond.wait(wait)
+
+    def _reserve(self, limiter):
+        # takes a slot (and token) if there is one and returns None, else
+        # the seconds to wait; the caller holds limiter.cond
+        now = self.clock()
+        if now < limiter.paused_until:
+            return limiter.paused_until - now
+        if limiter.in_flight >= int(limiter.limit):
+            return 1.0
+        if limiter.max_rate:
+            limiter.tokens = min(1.0, limiter.tokens + (now - limiter.refilled) * limiter.max_rate)
+            limiter.refilled = now
+            if limiter.tokens < 1.0:
+                return (1.0 - limiter.tokens) / limiter.max_rate
+            limiter.tokens -= 1.0
+        limiter.in_flight += 1
+        return None
+
+    def feedback(self, url, status, latency, headers=None):
+        """status None stands for a connection error or timeout"""
+        limiter = self.host(url)
+        throttled = status in self.retry_statuses
+        overloaded = status is None or throttled or status >= 500
+        with limiter.cond:
+            now = self.clock()
+            if not overloaded:
+                limiter.latency = latency if limiter.latency is None else 0.8 * limiter.latency + 0.2 * latency
+                if limiter.baseline is None or limiter.latency < limiter.baseline:
+                    limiter.baseline = limiter.latency
+                else:
+                    limiter.baseline += (limiter.latency - limiter.baseline) * 0.01
+            slow = (self.latency_tolerance is not None and limiter.baseline and
+                    limiter.latency > self.latency_tolerance * limiter.baseline)
+            pause = None
+            if overloaded or slow:
+                # errors of requests that were sent before the last cut
+                # don't cut the limit again
+                if now - limiter.last_decrease > (limiter.latency or 0.0):
+                    limiter.ceiling = limiter.limit
+                    limiter.limit = max(limiter.min_concurrency, limiter.limit * self.backoff)
+                    limiter.last_decrease = now
+                    limiter.decreases += 1
+            elif limiter.in_flight >= int(limiter.limit) - 1:
+                # only grow a limit that is used
+                grown = min(limiter.max_concurrency, limiter.limit + 1.0 / limiter.limit)
+                if limiter.ceiling is None or int(grown) < int(limiter.ceiling):
+                    limiter.limit = grown
+                elif now - max(limiter.last_decrease, limiter.last_probe) > self.probe_interval:
+                    limiter.ceiling += 1
+                    limiter.last_probe = now
+                    limiter.limit = grown
+            if throttled:
+                limiter.throttled += 1
+                limiter.consecutive += 1
+                pause = retry_after(headers)
+                if pause is None:
+                    pause = 0.5 * 2 ** min(limiter.consecutive - 1, 8)
+                pause = min(pause, self.max_wait)
+                limiter.paused_until = max(limiter.paused_until, now + pause)
+            elif not overloaded:
+                limiter.consecutive = 0
+            limiter.cond.notify_all()
+
+        return pause
+
+    def should_retry(self, method, status, attempt):
+        return attempt < self.max_retries and method.upper() in self.retry_statuses.get(status, ())
+
+    def snapshot(self):
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {key: limiter.snapshot() for key, limiter in limiters.items()}
+
+
+def host_key(url):
+    """returns "host[:port]" of a url, or the argument if it has no scheme"""
+    if "://" not in url:
+        return url.lower()
+    return urlsplit(url).netloc.lower()
+
+
+def retry_after(headers, now=None):
+    """returns the seconds of a Retry-After header (delay or http date) or
+    None if there is none; an http date is compared with now (seconds since
+    the epoch, default time.time())"""
+    if not headers:
+        return None
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - (time.time() if now is None else now))
+    except (TypeError, ValueError):
+        return None
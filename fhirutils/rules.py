@@ -0,0 +1,132 @@
+import threading
+from .utils import compile_path
+
+
+# results of Rule.apply()
+KEEP = "keep"
+DROP = "drop"
+REWRITE = "rewrite"
+
+
+class Rule():
+    """Base class of a validation/rewrite rule for bundle entries.
+    apply() gets a bundle entry (dict with "resource"), may change it in place
+    and returns KEEP, DROP or REWRITE (changed and kept). If message is set,
+    it is logged for every dropped entry.
+    """
+
+    name = "rule"
+    message = None
+
+    def apply(self, entry):
+        return KEEP
+
+
+class DropUnresolvableMedication(Rule):
+    """Drops entries with the non-resolvable medication reference "Medication/?"
+    occuring in ID Berlin's MedicationStatements with non-standardised
+    medication prescriptions."""
+
+    name = "drop_unresolvable_medication"
+    message = "Warning: MedicationStatement deleted due to non-resolvable reference ?."
+
+    def apply(self, entry):
+        if compile_path("resource.medicationReference.reference").first(entry) == "Medication/?":
+            return DROP
+        return KEEP
+
+
+class AddTransactionRequest(Rule):
+    """Adds a transaction verb (request) to entries that have none."""
+
+    name = "add_transaction_request"
+
+    def __init__(self, method="PUT"):
+        self.method = method
+
+    def apply(self, entry):
+        if "request" in entry:
+            return KEEP
+        resource = entry.get("resource") or {}
+        entry["request"] = {
+            "method": self.method,
+            "url": str(resource.get("resourceType")) + "/" + str(resource.get("id"))
+        }
+        return REWRITE
+
+
+def default_rules():
+    return [DropUnresolvableMedication(), AddTransactionRequest()]
+
+
+class RulePipeline():
+    """Applies a list of rules to bundle entries in a single pass.
+    Entries are changed in place, dropped entries are left out of the
+    returned list. The pipeline counts per rule how many entries it dropped
+    or rewrote; it can be shared by several threads.
+    Attributes
+    --------------
+    rules : list of Rule
+        rules in the order they are applied, default: default_rules()
+    log : callable
+        called with a rule's message for every entry the rule drops
+    counters : dict
+        rule name -> {"dropped": int, "rewritten": int}
+    Methods
+    --------------
+    process(entries)
+        applies the rules to a page/batch of entries, returns the kept ones
+    apply(entry)
+        applies the rules to a single entry, returns it or None if dropped
+    summary()
+        returns the counters as a printable string
+    """
+
+    def __init__(self, rules=None, log=None):
+        self.rules = rules if rules is not None else default_rules()
+        self.log = log
+        self.counters = {rule.name: {"dropped": 0, "rewritten": 0} for rule in self.rules}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the log belongs to the sending process, process pool workers log on their own
+        state = self.__dict__.copy()
+        state["log"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def process(self, entries):
+        kept = []
+        dropped = [0] * len(self.rules)
+        rewritten = [0] * len(self.rules)
+        for entry in entries:
+            for i, rule in enumerate(self.rules):
+                result = rule.apply(entry)
+                if result == DROP:
+                    dropped[i] += 1
+                    if rule.message is not None and self.log is not None:
+                        self.log(rule.message)
+                    break
+                if result == REWRITE:
+                    rewritten[i] += 1
+            else:
+                kept.append(entry)
+
+        with self._lock:
+            for i, rule in enumerate(self.rules):
+                self.counters[rule.name]["dropped"] += dropped[i]
+                self.counters[rule.name]["rewritten"] += rewritten[i]
+
+        return kept
+
+    def apply(self, entry):
+        kept = self.process([entry])
+        return kept[0] if kept else None
+
+    def summary(self):
+        return ", ".join("{0}: {1} dropped, {2} rewritten".format(name, c["dropped"], c["rewritten"])
+                         for name, c in self.counters.items())
@@ -0,0 +1,76 @@
+"""json (de)serialization of FHIR resources.
+
+Uses orjson if it is installed, the standard library's json otherwise.
+Responses are parsed directly from their bytes; the charset is taken from
+the Content-Type header and defaults to UTF-8 (the FHIR default). XML
+responses (by their Content-Type) are converted to the json representation,
+see xmlio.py.
+"""
+
+import json
+from . import xmlio
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+_UTF8 = ("utf-8", "utf8")
+_BOM = b"\xef\xbb\xbf"
+
+
+def loads(data, encoding=None):
+    """parses json from str or bytes, bytes are decoded with encoding
+    (default: UTF-8, a byte order mark is skipped)"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        if encoding is not None and encoding.lower() not in _UTF8:
+            data = bytes(data).decode(encoding)
+        elif data[:3] == _BOM:
+            data = memoryview(data)[3:]
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+def loads_response(req):
+    """parses the body of a requests response, json or XML"""
+    content_type = req.headers.get("Content-Type")
+    if xmlio.is_xml(content_type):
+        return xmlio.loads(req.content)
+    return loads(req.content, charset_of(content_type))
+
+
+def charset_of(content_type):
+    """returns the charset parameter of a Content-Type header or None"""
+    if not content_type:
+        return None
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "charset":
+            return value.strip().strip('"') or None
+    return None
+
+
+def dumps(obj, pretty=False):
+    """serializes obj to UTF-8 encoded json bytes, compact unless pretty"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dump(obj, path, pretty=False):
+    """writes obj as json to the file path"""
+    with open(path, "wb") as f:
+        f.write(dumps(obj, pretty=pretty))
+
+
+def load(path):
+    """reads json from the file path"""
+    with open(path, "rb") as f:
+        return loads(f.read())
@@ -0,0 +1,230 @@
+import queue
+import threading
+from timeit import default_timer as timer
+
+
+# end of a queue's items, every worker of a stage gets one
+_DONE = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+class Stage():
+    """A step of a StagedPipeline.
+    Attributes
+    --------------
+    name : str
+        name of the stage, also the prefix of its worker threads' names
+    func : callable
+        called with an item of the stage's input queue, returns (or yields)
+        the items for the next stage
+    workers : int
+        number of worker threads
+    queue_size : int
+        maximum number of items waiting in the stage's input queue,
+        default 2 * workers
+    initializer : callable
+        called once in every worker thread before its first item
+    processed : int
+        number of items processed
+    busy : float
+        seconds the workers spent in func (waiting for room in the next
+        stage's queue is not counted)
+    max_depth : int
+        maximum number of items that waited in the input queue
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=None, initializer=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size if queue_size is not None else 2 * workers
+        self.initializer = initializer
+        self.processed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.queue = None
+        self._lock = threading.Lock()
+
+
+class StagedPipeline():
+    """Runs items through a sequence of stages, every stage with worker
+    threads of its own. The stages are connected by bounded queues: a stage
+    whose next stage is slower blocks until there is room again, so no more
+    than the queues' sizes of items are held between the stages, and the
+    stages work on different items at the same time (e.g. downloading the
+    next record while the previous one is uploaded).
+    Attributes
+    --------------
+    stages : list of Stage
+        the stages in processing order
+    metrics : Metrics
+        if given, the busy time per item is recorded as phase
+        "stage.<name>" and the queue depths as gauges "queue_depth.<name>"
+    Methods
+    --------------
+    run(items)
+        yields the items of the last stage as they are finished
+    snapshot()
+        returns throughput, utilization and queue depths per stage
+    summary()
+        returns the snapshot as a line of text
+    """
+
+    def __init__(self, stages, metrics=None):
+        self.stages = stages
+        self.metrics = metrics
+        self.start = None
+        self.end = None
+        self._stop = threading.Event()
+        self._error = None
+        self._remaining = {}
+        self._lock = threading.Lock()
+
+    def run(self, items):
+        self.start = timer()
+        self.end = None
+        self._stop.clear()
+        self._error = None
+        for stage in self.stages:
+            stage.queue = queue.Queue(maxsize=stage.queue_size)
+            self._remaining[stage.name] = stage.workers
+        results = queue.Queue(maxsize=self.stages[-1].queue_size)
+
+        threads = [threading.Thread(target=self._feed, args=(items,), name="feeder", daemon=True)]
+        for i, stage in enumerate(self.stages):
+            following = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            target = following.queue if following is not None else results
+            threads.extend(threading.Thread(target=self._work,
+                                            args=(stage, target, following),
+                                            name=stage.name + "_" + str(n),
+                                            daemon=True)
+                           for n in range(stage.workers))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(results)
+                if item is _DONE:
+                    break
+                yield item
+        except _Stopped:
+            pass
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self.end = timer()
+        if self._error is not None:
+            raise self._error
+
+    def snapshot(self):
+        elapsed = 0.0
+        if self.start is not None:
+            elapsed = (self.end if self.end is not None else timer()) - self.start
+        return [
+            {
+                "stage": stage.name,
+                "workers": stage.workers,
+                "processed": stage.processed,
+                "items_per_second": stage.processed / elapsed if elapsed > 0 else 0.0,
+                "busy_seconds": stage.busy,
+                "utilization": stage.busy / (elapsed * stage.workers) if elapsed > 0 else 0.0,
+                "queue_depth": stage.queue.qsize() if stage.queue is not None else 0,
+                "max_queue_depth": stage.max_depth,
+                "queue_size": stage.queue_size
+            }
+            for stage in self.stages
+        ]
+
+    def summary(self):
+        return ", ".join("{0}: {1} items, {2:.2f}/s, {3:.0%} busy, queue max {4}/{5}".format(
+            s["stage"], s["processed"], s["items_per_second"], s["utilization"],
+            s["max_queue_depth"], s["queue_size"]) for s in self.snapshot())
+
+    def _feed(self, items):
+        first = self.stages[0]
+        try:
+            for item in items:
+                self._put(first, first.queue, item)
+            for _ in range(first.workers):
+                self._put(None, first.queue, _DONE)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _work(self, stage, target, following):
+        try:
+            if stage.initializer is not None:
+                stage.initializer()
+            while True:
+                item = self._get(stage.queue)
+                if item is _DONE:
+                    break
+                if self.metrics is not None:
+                    self.metrics.gauge("queue_depth." + stage.name, stage.queue.qsize())
+                self._process(stage, item, target, following)
+            with self._lock:
+                self._remaining[stage.name] -= 1
+                last = self._remaining[stage.name] == 0
+            if last:
+                for _ in range(following.workers if following is not None else 1):
+                    self._put(None, target, _DONE)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _process(self, stage, item, target, following):
+        start = timer()
+        outputs = iter(stage.func(item) or ())
+        busy = timer() - start
+        while True:
+            start = timer()
+            try:
+                output = next(outputs)
+            except StopIteration:
+                busy += timer() - start
+                break
+            busy += timer() - start
+            self._put(following, target, output)
+        with stage._lock:
+            stage.processed += 1
+            stage.busy += busy
+        if self.metrics is not None:
+            self.metrics.observe("stage." + stage.name, busy)
+
+    def _put(self, stage, target, item):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                target.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        if stage is not None and item is not _DONE:
+            depth = target.qsize()
+            with stage._lock:
+                stage.max_depth = max(stage.max_depth, depth)
+            if self.metrics is not None:
+                self.metrics.gauge("queue_depth." + stage.name, depth)
+
+    def _get(self, source):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
@@ -0,0 +1,136 @@
+import sqlite3
+import time
+
+
+class SyncState():
+    """Local, persistent record of the encounters transferred to a destination.
+    The state is kept in a sqlite database, so lookups are indexed and the
+    record survives interrupted runs. Encounters that were found on the
+    destination by a scan are stored as well, so the destination has to be
+    scanned only once.
+    Attributes
+    --------------
+    path : str
+        a raw string representing the database file incl. path
+    destination : str
+        the destination's FHIR-base, states of several destinations can be
+        kept in one database
+    commit_every : int
+        number of checkpoints after which the state is written to disk
+    Methods
+    --------------
+    is_seeded()
+        True if the destination's encounters have been scanned before
+    seed(enc_ids)
+        records encounters found on the destination
+    pending(enc_no_lst)
+        returns the encounters that are neither transferred nor present
+    checkpoint(enc_no, failed)
+        records the result of an encounter's transfer; failed only for
+        errors (failed downloads or uploads), a record with warnings only
+        (e.g. no resources of a requested type) is transferred
+    watermark(profile, resource_type)
+        returns the _lastUpdated watermark of a delta sync or None
+    set_watermarks(profile, watermarks)
+        stores the watermarks of a successful delta sync
+    commit()
+        writes pending checkpoints to disk
+    close()
+        commits and closes the database
+    """
+
+    TRANSFERRED = "transferred"
+    PRESENT = "present"
+    FAILED = "failed"
+
+    def __init__(self, path, destination, commit_every=100):
+        self.path = path
+        self.destination = destination
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS encounters ("
+                "destination TEXT NOT NULL, "
+                "enc_id TEXT NOT NULL, "
+                "status TEXT NOT NULL, "
+                "updated TEXT NOT NULL, "
+                "PRIMARY KEY (destination, enc_id)) WITHOUT ROWID")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS scans ("
+                "destination TEXT PRIMARY KEY, "
+                "scanned TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks ("
+                "destination TEXT NOT NULL, "
+                "profile TEXT NOT NULL, "
+                "resource_type TEXT NOT NULL, "
+                "watermark TEXT NOT NULL, "
+                "updated TEXT NOT NULL, "
+                "PRIMARY KEY (destination, profile, resource_type)) WITHOUT ROWID")
+
+    def is_seeded(self):
+        row = self.conn.execute("SELECT 1 FROM scans WHERE destination = ?",
+                                (self.destination,)).fetchone()
+        return row is not None
+
+    def seed(self, enc_ids):
+        now = _now()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO encounters VALUES (?, ?, ?, ?)",
+                ((self.destination, enc, self.PRESENT, now) for enc in enc_ids))
+            self.conn.execute("INSERT OR REPLACE INTO scans VALUES (?, ?)",
+                              (self.destination, now))
+
+    def pending(self, enc_no_lst):
+        done = set()
+        for i in range(0, len(enc_no_lst), 500):
+            chunk = enc_no_lst[i:i + 500]
+            rows = self.conn.execute(
+                "SELECT enc_id FROM encounters WHERE destination = ? AND status != ? "
+                "AND enc_id IN (" + ",".join("?" * len(chunk)) + ")",
+                [self.destination, self.FAILED] + list(chunk))
+            done.update(row[0] for row in rows)
+
+        return [enc for enc in enc_no_lst if enc not in done]
+
+    def checkpoint(self, enc_no, failed=False):
+        self.conn.execute("INSERT OR REPLACE INTO encounters VALUES (?, ?, ?, ?)",
+                          (self.destination,
+                           enc_no,
+                           self.FAILED if failed else self.TRANSFERRED,
+                           _now()))
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def watermark(self, profile, resource_type):
+        row = self.conn.execute(
+            "SELECT watermark FROM watermarks WHERE destination = ? AND profile = ? AND resource_type = ?",
+            (self.destination, profile, resource_type)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_watermarks(self, profile, watermarks):
+        """watermarks: resource type -> _lastUpdated value, e.g.
+        "2024-01-31T22:00:00Z"; the pending checkpoints are committed with them"""
+        now = _now()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?, ?)",
+                ((self.destination, profile, resource_type, mark, now)
+                 for resource_type, mark in watermarks.items()))
+        self._uncommitted = 0
+
+    def commit(self):
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def _now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime())
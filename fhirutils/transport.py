@@ -0,0 +1,209 @@
+import os
+import threading
+from timeit import default_timer as timer
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .metrics import Metrics
+
+
+class Transport():
+    """Shared HTTP layer of Utils, Loader and Connector.
+    Keeps one keep-alive connection pool per FHIR server (scheme + host), sets
+    default timeouts and retries requests with exponential backoff on
+    connection errors and 5xx responses. One instance can be passed to
+    several objects (and used from several threads) to share the pools.
+    Attributes
+    --------------
+    timeout : float or tuple
+        default timeout in seconds, either one value or (connect, read)
+    retries : int
+        maximum number of retries per request
+    backoff_factor : float
+        backoff between retries: backoff_factor * 2 ** (retry - 1) seconds
+    pool_size : int
+        maximum number of kept-alive connections per FHIR server
+    status_forcelist : tuple of int
+        http status codes that are retried
+    headers : dict
+        headers sent with every request
+    metrics : Metrics
+        records count, status, latency and bytes of every request per server
+        and resource type, a new one is created if not given
+    cache : HTTPCache
+        optional persistent cache of GET responses (fhirutils/httpcache.py),
+        cached responses are revalidated with conditional requests; a 304 is
+        recorded in metrics, a response served without request is not
+    limiter : RateLimiter
+        optional adaptive per-server concurrency and rate limits
+        (fhirutils/ratelimit.py); with a limiter 429 and 503 responses are
+        retried by the limiter (honouring Retry-After) instead of the
+        connection pool, so that every attempt adapts the limits
+    Methods
+    --------------
+    request(method, url, **kwargs)
+        sends a request via the pooled session of the url's server
+    get(url, **kwargs), put(url, **kwargs), post(url, **kwargs)
+        shortcuts for request()
+    close()
+        closes all pooled connections
+    """
+
+    def __init__(self,
+                 timeout=(10, 300),
+                 retries=3,
+                 backoff_factor=0.5,
+                 pool_size=10,
+                 status_forcelist=(500, 502, 503, 504),
+                 headers=None,
+                 metrics=None,
+                 cache=None,
+                 limiter=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.status_forcelist = status_forcelist
+        self.headers = headers if headers is not None else {}
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.cache = cache
+        self.limiter = limiter
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # sessions and locks can't be sent to worker processes,
+        # they are rebuilt on first use
+        state = self.__dict__.copy()
+        state["_sessions"] = {}
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @property
+    def lock(self):
+        if self._pid != os.getpid():
+            # a forked worker process inherits the parent's pooled sockets,
+            # requests of both processes on one socket would get mixed up
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._sessions = {}
+        return self._lock
+
+    def session(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self.lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._new_session()
+                self._sessions[key] = session
+        return session
+
+    def _new_session(self):
+        status_forcelist = self.status_forcelist
+        if self.limiter is not None:
+            status_forcelist = tuple(s for s in status_forcelist if s not in self.limiter.retry_statuses)
+        retry = Retry(total=self.retries,
+                      backoff_factor=self.backoff_factor,
+                      status_forcelist=status_forcelist,
+                      respect_retry_after_header=self.limiter is None,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(self.headers)
+        return session
+
+    def request(self, method, url, **kwargs):
+        if self.cache is not None and method == "GET" and not kwargs.get("stream"):
+            return self._cached_get(url, **kwargs)
+        return self._send(method, url, **kwargs)
+
+    def _cached_get(self, url, **kwargs):
+        entry = self.cache.lookup(url)
+        if entry is not None:
+            if entry["fresh"]:
+                self.cache.hit(url)
+                return self.cache.response(entry)
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, **self.cache.request_headers(entry))
+        req = self._send("GET", url, **kwargs)
+        if entry is not None and req.status_code == 304:
+            self.cache.revalidate(url, req.headers)
+            return self.cache.response(entry, req)
+        self.cache.store(url, req)
+        return req
+
+    def _send(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if self.limiter is None:
+            return self._attempt(method, url, **kwargs)
+        attempt = 0
+        while True:
+            with self.limiter.slot(url) as host:
+                start = timer()
+                try:
+                    req = self._attempt(method, url, **kwargs)
+                except requests.RequestException:
+                    self.limiter.feedback(url, None, timer() - start)
+                    raise
+                self.limiter.feedback(url, req.status_code, timer() - start, req.headers)
+            self.metrics.gauge("concurrency_limit." + urlsplit(url).netloc, int(host.limit))
+            if not self.limiter.should_retry(method, req.status_code, attempt):
+                return req
+            # the limiter pauses the server, the next slot waits for it
+            attempt += 1
+            req.close()
+
+    def _attempt(self, method, url, **kwargs):
+        parts = urlsplit(url)
+        resource_type = resource_type_of(parts.path)
+        start = timer()
+        try:
+            req = self.session(url).request(method, url, **kwargs)
+        except requests.RequestException:
+            self.metrics.record_request(parts.netloc, resource_type, "error", timer() - start)
+            raise
+        body = req.request.body
+        self.metrics.record_request(parts.netloc,
+                                    resource_type,
+                                    req.status_code,
+                                    timer() - start,
+                                    bytes_down=len(req.content),
+                                    bytes_up=len(body) if body else 0)
+        return req
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+        if self.cache is not None:
+            self.cache.close()
+
+
+def resource_type_of(path):
+    """returns the resource type a request path refers to, e.g. "Patient" for
+    "/fhir/Patient/123", or "Bundle" for requests to the FHIR-base"""
+    for segment in reversed(path.split("/")):
+        if segment[:1].isupper() and segment.isalpha():
+            return segment
+    return "Bundle"
@@ -0,0 +1,222 @@
+import gzip
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from .utils import compile_path
+from . import serialization
+
+
+# resource types other resources refer to, in the order they are uploaded
+# before everything else (e.g. MedicationStatements)
+DEPENDENCY_ORDER = ("Patient", "Encounter", "Medication")
+
+# result of a chunk's upload; ok is None if the chunk was skipped because
+# a chunk of a previous tier failed
+ChunkResult = namedtuple("ChunkResult", "index tier entries ok status message")
+
+
+def dependency_tier(entry):
+    """returns the upload tier of a bundle entry, an entry only refers to
+    resources of lower tiers"""
+    try:
+        return DEPENDENCY_ORDER.index(compile_path("resource.resourceType").first(entry))
+    except ValueError:
+        return len(DEPENDENCY_ORDER)
+
+
+def encode_entries(entries):
+    """serializes every entry once, returns a list of (entry, bytes) pairs"""
+    return [(entry, serialization.dumps(entry)) for entry in entries]
+
+
+def chunk_entries(encoded, max_entries=None, max_bytes=None):
+    """splits (entry, bytes) pairs into chunks of at most max_entries entries
+    and max_bytes serialized bytes, yields lists of pairs"""
+    chunk = []
+    size = 0
+    for pair in encoded:
+        if chunk and (
+            (max_entries is not None and len(chunk) >= max_entries) or
+            (max_bytes is not None and size + len(pair[1]) + 1 > max_bytes)
+        ):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(pair)
+        size += len(pair[1]) + 1
+    if chunk:
+        yield chunk
+
+
+class BundleUploader():
+    """Uploads transaction bundles in size-bounded chunks.
+    A bundle within max_entries and max_bytes is sent as one transaction.
+    Larger bundles are grouped by dependency_tier() and every tier is split
+    into chunks that are sent as transactions of their own. Tiers are
+    uploaded one after another, the chunks of a tier in parallel. Chunks
+    that fail with 429, a 5xx or a connection error are retried on their own
+    (5xx statuses the transport already retries are not sent again), other
+    errors (e.g. 4xx validation errors) fail at once; if a chunk fails
+    finally, the chunks of the following tiers are skipped because they
+    would refer to missing resources.
+    Attributes
+    --------------
+    transport : Transport
+        the HTTP layer used for the upload
+    fhirbase : str
+        the destination's FHIR-base
+    method : str
+        http-request method, "PUT" or "POST"
+    max_entries : int
+        maximum number of entries per transaction, None for no limit
+    max_bytes : int
+        maximum size of a transaction's body in bytes (uncompressed),
+        None for no limit
+    compress : bool
+        if True request bodies are sent gzip-compressed
+    workers : int
+        number of chunks of a tier that are uploaded in parallel
+    retries : int
+        number of times a chunk that failed with 429, a 5xx or a connection
+        error is sent again
+    fingerprints : FingerprintIndex
+        if given, entries whose resources are unchanged since their last
+        upload are dropped by prepare() and the fingerprints of successfully
+        uploaded entries are stored (fhirutils/fingerprint.py)
+    Methods
+    --------------
+    prepare(bundle)
+        serializes and splits a bundle into chunks (done by upload() if
+        not given), so that it can be done ahead of the upload
+    upload(bundle, chunks)
+        uploads a bundle, returns a list of ChunkResult
+    retry(bundle, results)
+        uploads only the chunks of results that failed or were skipped
+    """
+
+    def __init__(self,
+                 transport,
+                 fhirbase,
+                 method="POST",
+                 max_entries=None,
+                 max_bytes=None,
+                 compress=False,
+                 workers=1,
+                 retries=1,
+                 fingerprints=None):
+        self.transport = transport
+        self.fhirbase = fhirbase
+        self.method = method
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.workers = workers
+        self.retries = retries
+        self.fingerprints = fingerprints
+
+    def prepare(self, bundle):
+        """serializes the entries of bundle and splits them into chunks,
+        returns a list of (tier, [(entry, bytes), ...]), an empty list if
+        fingerprints dropped every entry"""
+        entries = bundle.get("entry") or []
+        if self.fingerprints is not None:
+            entries = self.fingerprints.changed(entries, self.transport)
+            if not entries:
+                return []
+        encoded = encode_entries(entries)
+        if self._fits(encoded):
+            return [(0, encoded)]
+        tiers = {}
+        for pair in encoded:
+            tiers.setdefault(dependency_tier(pair[0]), []).append(pair)
+
+        return [(tier, chunk)
+                for tier in sorted(tiers)
+                for chunk in chunk_entries(tiers[tier], self.max_entries, self.max_bytes)]
+
+    def upload(self, bundle, chunks=None):
+        if chunks is None:
+            chunks = self.prepare(bundle)
+
+        return self._upload_chunks(bundle, chunks)
+
+    def retry(self, bundle, results):
+        failed = [result for result in results if not result.ok]
+        chunks = [(result.tier, encode_entries(result.entries)) for result in failed]
+        retried = iter(self._upload_chunks(bundle, chunks))
+
+        return [result if result.ok else next(retried)._replace(index=result.index)
+                for result in results]
+
+    def _fits(self, encoded):
+        return (
+            (self.max_entries is None or len(encoded) <= self.max_entries) and
+            (self.max_bytes is None or sum(len(pair[1]) + 1 for pair in encoded) <= self.max_bytes)
+        )
+
+    def _retryable(self, status):
+        """429 and 5xx may succeed when sent again, unless the transport has
+        retried them already (its connection pool retries the statuses of
+        its status_forcelist for every method but POST)"""
+        if status != 429 and status < 500:
+            return False
+        return self.method == "POST" or not getattr(self.transport, "retries", 0) or \
+            status not in getattr(self.transport, "status_forcelist", ())
+
+    def _upload_chunks(self, bundle, chunks):
+        # every chunk is sent with the bundle's own header (type, id, meta)
+        header = {k: v for k, v in bundle.items() if k != "entry"}
+        prefix = serialization.dumps(header)
+        prefix = prefix[:-1] + (b',"entry":[' if header else b'"entry":[')
+
+        def send(i):
+            tier, chunk = chunks[i]
+            body = prefix + b",".join(pair[1] for pair in chunk) + b"]}"
+            return self._send(i, tier, [pair[0] for pair in chunk], body)
+
+        results = []
+        failed = False
+        for tier in sorted({tier for tier, _ in chunks}):
+            indices = [i for i, (t, _) in enumerate(chunks) if t == tier]
+            if failed:
+                results.extend(ChunkResult(i, tier, [pair[0] for pair in chunks[i][1]], None, None,
+                                           "skipped, a chunk of a previous tier failed")
+                               for i in indices)
+            elif self.workers > 1 and len(indices) > 1:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    results.extend(executor.map(send, indices))
+            else:
+                results.extend(send(i) for i in indices)
+            failed = failed or any(result.ok is False for result in results)
+
+        return results
+
+    def _send(self, index, tier, entries, body):
+        headers = {"Content-Type": "application/fhir+json; charset=utf-8"}
+        if self.compress:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        req = None
+        for _ in range(self.retries + 1):
+            try:
+                req = self.transport.request(self.method, self.fhirbase, data=body, headers=headers)
+            except requests.RequestException as e:
+                # e.g. a dropped connection after the transport's retries
+                req, error = None, e
+                continue
+            if req.ok:
+                if self.fingerprints is not None:
+                    self.fingerprints.store_entries(entries)
+                return ChunkResult(index, tier, entries, True, req.status_code, "")
+            if not self._retryable(req.status_code):
+                break
+
+        if req is None:
+            return ChunkResult(index, tier, entries, False, None, type(error).__name__ + " " + str(error))
+        try:
+            content = serialization.loads_response(req)
+            message = compile_path("issue.0.details.text").first(content) or \
+                compile_path("issue.0.diagnostics").first(content, "")
+        except ValueError:
+            message = ""
+        return ChunkResult(index, tier, entries, False, req.status_code, str(message))
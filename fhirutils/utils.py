@@ -1,25 +1,154 @@
-import pandas as pd
-import requests
-import json
+import atexit
+import functools
+import os
 import random
 import string
+import threading
 import time
+import datetime
+from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor
+from .transport import Transport
+from . import serialization
+from . import xmlio
+
+
+# marks a list in a json path whose entries are all browsed
+WILDCARD = "X"
+
+# returned by CompiledPath.first() if nothing is found
+_MISSING = object()
+
+
+class CompiledPath():
+    """A json path that is parsed once and can then be applied to any number of
+    resources without further parsing or copying, see compile_path().
+    A path is a dot-separated sequence of keys and list indices, e.g.
+    "entry.0.resource.id". Any number of list steps can be WILDCARD ("X"),
+    every entry of the list is browsed then.
+    """
+
+    __slots__ = ("expression", "steps", "wildcard")
+
+    def __init__(self, expression):
+        self.expression = expression
+        steps = []
+        for item in expression.split(".") if expression else ():
+            if item == WILDCARD:
+                steps.append(WILDCARD)
+                continue
+            try:
+                steps.append(int(item))
+            except ValueError:
+                steps.append(item)
+        self.steps = tuple(steps)
+        self.wildcard = WILDCARD in self.steps
+
+    def first(self, data, default=None):
+        """returns the first matching value or default"""
+        if not self.wildcard:
+            d = data
+            for step in self.steps:
+                if isinstance(step, int):
+                    if not isinstance(d, list) or not -len(d) <= step < len(d):
+                        return default
+                elif not isinstance(d, dict) or step not in d:
+                    return default
+                d = d[step]
+            return d
+        for value in self._walk(data, 0, None):
+            return value
+        return default
+
+    def values(self, data):
+        """generator of every matching value"""
+        if not self.wildcard:
+            value = self.first(data, _MISSING)
+            if value is not _MISSING:
+                yield value
+            return
+        yield from self._walk(data, 0, None)
+
+    def items(self, data):
+        """generator of (path, value) tuples for every matching value,
+        wildcards in path are replaced by the matching list indices"""
+        if not self.wildcard:
+            value = self.first(data, _MISSING)
+            if value is not _MISSING:
+                yield self.expression, value
+            return
+        for indices, value in self._walk(data, 0, ()):
+            it = iter(indices)
+            yield ".".join(str(next(it)) if step == WILDCARD else str(step)
+                           for step in self.steps), value
+
+    def _walk(self, d, pos, indices):
+        # indices is None if only values are wanted, else the tuple of list
+        # indices the wildcards matched so far
+        steps = self.steps
+        while pos < len(steps):
+            step = steps[pos]
+            pos += 1
+            if step == WILDCARD:
+                if not isinstance(d, list):
+                    return
+                for i, item in enumerate(d):
+                    yield from self._walk(item, pos, None if indices is None else indices + (i,))
+                return
+            if isinstance(step, int):
+                if not isinstance(d, list) or not -len(d) <= step < len(d):
+                    return
+            elif not isinstance(d, dict) or step not in d:
+                return
+            d = d[step]
+        yield d if indices is None else (indices, d)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_path(expression):
+    """returns the CompiledPath of a json path expression, cached"""
+    return CompiledPath(expression)
+
+
+def next_link(bundle):
+    """returns the url of a searchset bundle's next page or None"""
+    for link in bundle.get("link", []):
+        if link.get("relation") == "next":
+            return link.get("url")
+    return None
+
+
+def id_chunks(ids, max_ids, max_chars=1500):
+    """splits a list of resource ids into chunks for comma-separated _id
+    searches, bounded by the number of ids and the summed length of the ids
+    (to keep the search url short enough for servers and proxies)"""
+    chunk = []
+    chars = 0
+    for i in ids:
+        if chunk and (len(chunk) >= max_ids or chars + len(i) + 1 > max_chars):
+            yield chunk
+            chunk = []
+            chars = 0
+        chunk.append(i)
+        chars += len(i) + 1
+    if chunk:
+        yield chunk
 
 
 class Utils():
-    def __init__(self, logpath=None):
+    def __init__(self, logpath=None, transport=None):
         self.logpath = logpath
         self.errorstatus = False
+        self.transport = transport if transport is not None else Transport()
         if self.logpath is not None:
-            with open(self.logpath, "w") as _:
-                pass
+            LogWriter.get(self.logpath)
 
         self.format_dict = {
                 "json": "&_format=json",
                 "xml": "&_format=xml"
             }
 
-    def get(self, i=None, s=None, t="url", f="json"):
+    def get(self, i=None, s=None, t="url", f="json", as_frame=True):
         """
         returns a data item from a FHIR-resource/bundle by given json-path
 
@@ -27,100 +156,145 @@ class Utils():
             i: item via json path, e.g.: "entry.0.resource.status"
             s: source, can be a url, a local file or a bundle
             t: the source's type, "url" (default), "local" or "resource"
-            f: format of loaded resource/bundle, "json" (default) or "xml" (not yet implemented!)
+            f: format of loaded resource/bundle, "json" (default) or "xml"
+            as_frame: if True (default) a pandas.DataFrame is returned, else a list
 
         returns:
-            tuple: (path, result)
+            DataFrame with the columns "path" and "value" or list of tuples (path, value)
         """
 
         json_data = None
         if t == "url":
             search_url = s + self.format_dict[f]
             print(search_url)
-            req = requests.get(search_url)
-            downloads = str(req.content, encoding='cp1252')
-            if f == "json":
-                json_data = json.loads(downloads)
+            req = self.transport.get(search_url)
+            json_data = serialization.loads_response(req)
+
+        elif t == "local" and f == "xml":
+            return self.find_in_xml(i, s, as_frame=as_frame)
 
         elif t == "local":
-            with open(s, "r") as source:
-                json_data = json.loads(source.read())
+            json_data = serialization.load(s)
 
         elif t == "resource":
             json_data = s
 
-        result_value = self.find_by_path(i, json_data)
+        result_value = self.find_by_path(i, json_data, as_frame=as_frame)
 
         return result_value
 
-    def find_by_path(self, element, data):
-        path = element.split(".")
-        subpath = path.copy()
-        d = data
-        for item in path:
-            subpath.remove(item)
-            try:
-                item = int(item)
-            except ValueError:
-                pass
-            if item == "X":
-                ret_lst = []
-                length = len(d)
-                for i in range(length):
-                    if i < 0:
-                        i = 0
-                    keyerror = False
-                    sub_d = d.copy()
-                    sub_d = sub_d[i]
-                    for subitem in subpath:
-                        try:
-                            sub_d = sub_d[subitem]
-                        except KeyError:
-                            keyerror = True
-                    if not keyerror:
-                        path_copy = None
-                        for j in range(len(path)):
-                            if path[j] == "X":
-                                path_copy = path.copy()
-                                path_copy[j] = str(i)
-                                path_copy = ".".join(path_copy)
-                        ret_lst.append([path_copy, sub_d])
-
-                df = pd.DataFrame(ret_lst)
-                df.columns = ["path", "value"]
-                return df
+    def find_by_path(self, element, data, as_frame=True):
+        """
+        returns every item of data matching the json path element
 
-            try:
-                d = d[item]
-            except TypeError:
-                pass
-            except KeyError:
-                pass
+        args:
+            element: json path, e.g.: "entry.X.resource.id"
+            data: a resource/bundle as dict or list
+            as_frame: if True (default) a pandas.DataFrame with the columns
+                "path" and "value" is returned, else a list of (path, value) tuples
+
+        a path that runs into a missing key or an out-of-range index matches
+        nothing; without wildcard the DataFrame has a single row with the
+        value None then
+        """
+
+        return self.frame(element, list(compile_path(element).items(data)), as_frame)
 
-        df = pd.DataFrame([element, d]).T
-        df.columns = ["path", "value"]
+    def find_in_xml(self, element, path, as_frame=True):
+        """
+        find_by_path() for a FHIR XML file: a path into the entries of a
+        bundle ("entry.X..." or "entry.<n>...") is applied to one entry at a
+        time while the file is read, other paths to the converted file
+        """
+
+        steps = compile_path(element).steps
+        if len(steps) < 2 or steps[0] != "entry" or \
+                not (steps[1] == WILDCARD or (isinstance(steps[1], int) and steps[1] >= 0)):
+            return self.find_by_path(element, xmlio.load(path), as_frame=as_frame)
+
+        rest = compile_path(".".join(element.split(".")[2:]))
+        results = []
+        for n, entry in enumerate(xmlio.iter_entries(path)):
+            if steps[1] != WILDCARD and n != steps[1]:
+                continue
+            prefix = "entry." + str(n)
+            results.extend((prefix + "." + sub if sub else prefix, value) for sub, value in rest.items(entry))
+            if n == steps[1]:
+                break
 
-        return df
+        return self.frame(element, results, as_frame)
+
+    def frame(self, element, results, as_frame=True):
+        """returns the (path, value) tuples of element as list or DataFrame"""
+        if not as_frame:
+            return results
+
+        if not results and WILDCARD not in element.split("."):
+            results = [(element, None)]
+        # pandas is imported only if a DataFrame is asked for
+        import pandas as pd
+        return pd.DataFrame(results, columns=["path", "value"])
 
     def link_search(self, fhir_search, result=None):
         if result is None:
             result = []
-        req = requests.get(fhir_search)
-        bundle = str(req.content, encoding='cp1252')
-        json_data = json.loads(bundle)
-        encounters = self.get(i="entry.X.resource", s=json_data, t="resource", f="json")
-        result.extend(encounters["value"].values)
-
-        if "link" in json_data:
-            for link in json_data["link"]:
-                if link["relation"] == "next":
-                    url = link["url"]
-                    return self.link_search(fhir_search=url, result=result)
+        result.extend(self.iter_link_search(fhir_search))
 
         return result
 
+    def iter_link_search(self, fhir_search, prefetch=False):
+        """
+        yields the resources of a FHIR search page by page, following the
+        searchset bundles' "next" links. Only the current page (and, if
+        prefetching, the next one) is kept in memory.
+
+        args:
+            fhir_search: the search url
+            prefetch: if True the next page is downloaded in the background
+                while the resources of the current page are consumed
+
+        raises:
+            requests.HTTPError if a page can't be downloaded, the search is
+            incomplete then
+        """
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        pending = None
+        try:
+            json_data = self.load_page(fhir_search)
+            while True:
+                url = next_link(json_data)
+                pending = None
+                if executor is not None and url is not None:
+                    pending = executor.submit(self.load_page, url)
+                yield from compile_path("entry.X.resource").values(json_data)
+                if url is None:
+                    break
+                json_data = pending.result() if pending is not None else self.load_page(url)
+        finally:
+            if executor is not None:
+                # the consumer may stop early, the prefetched page isn't needed
+                # then (shutdown's cancel_futures requires Python 3.9)
+                if pending is not None:
+                    pending.cancel()
+                executor.shutdown(wait=False)
+
+    def load_page(self, url):
+        """downloads a single searchset page, returns it as dict; sets
+        errorstatus and raises requests.HTTPError if the server answers with
+        an error"""
+        req = self.transport.get(url)
+        if not req.ok:
+            self.errorstatus = True
+            if self.logpath is not None:
+                LogWriter.get(self.logpath).write(
+                    "Download Error: " + url + ". Status code: " + str(req.status_code))
+            req.raise_for_status()
+
+        return serialization.loads_response(req)
+
     def extract_resources_from_bundle(self, bundle):
-        return self.get(i="entry.X.resource", s=bundle, t="resource")["value"].values
+        return list(compile_path("entry.X.resource").values(bundle))
 
     def create_bundle(self, res_lst=None, btype="transaction", form="json"):
         bundle = None
@@ -132,7 +306,8 @@ class Utils():
                         timestring[-2:]
                     )
 
-        if form == "json":
+        # resources are kept in the json representation for both forms
+        if form in ("json", "xml"):
             bundle = {
                 "resourceType": "Bundle",
                 "type": btype,
@@ -144,11 +319,95 @@ class Utils():
         return bundle
 
 
-if __name__ == "__main__":
-    util = Utils()
-    s = r"https://mii-agiop-3p.life.uni-leipzig.de/fhir/MedicationStatement"
-    t = "url"
-    i = "entry.X.resource"
+class LogWriter():
+    """Buffered, thread-safe writer of a logfile.
+    The file is opened (and truncated) once; messages are prefixed with the
+    current time and written through a buffer that is flushed every
+    flush_every messages, at least every flush_interval seconds and on
+    close(). Use LogWriter.get(path) to share one writer per logfile.
+    """
+
+    _writers = {}
+    _writers_lock = threading.Lock()
+
+    def __init__(self, path, flush_every=100, flush_interval=5.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._file = open(path, "w", buffering=64 * 1024)
+        self._pending = 0
+        self._last_flush = timer()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path):
+        """returns the writer of path, creates (and truncates) it on first use"""
+        key = os.path.abspath(path)
+        with cls._writers_lock:
+            writer = cls._writers.get(key)
+            if writer is None or writer._file.closed:
+                writer = cls._writers[key] = cls(path)
+            return writer
+
+    def write(self, msg):
+        current_time = time.strftime("%m/%d/%Y, %H:%M:%S")
+        with self._lock:
+            self._file.write(current_time + " " + msg + "\n")
+            self._pending += 1
+            if self._pending >= self.flush_every or timer() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._file.flush()
+        self._pending = 0
+        self._last_flush = timer()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+@atexit.register
+def _close_logwriters():
+    for writer in list(LogWriter._writers.values()):
+        writer.close()
+
+
+class Progress():
+    """Aggregate progress of a transfer run.
+    The estimate is based on the wall time elapsed since the run started and
+    the number of finished encounters, so it stays correct no matter how many
+    encounters are transferred in parallel. Updates are thread-safe.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.start = timer()
+        self._lock = threading.Lock()
+
+    def update(self, failed=False):
+        with self._lock:
+            self.done += 1
+            if failed:
+                self.failed += 1
+            return self.status()
 
-    res_lst = util.link_search(s)
-    print(util.create_bundle(res_lst=res_lst, btype="searchset", form="json"))
+    def status(self):
+        elapsed = timer() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else 0.0
+        return "Progress: {0}/{1} encounters ({2} failed), {3:.2f} encounters/s, elapsed: {4}, estimated time: {5}".format(
+            self.done,
+            self.total,
+            self.failed,
+            rate,
+            datetime.timedelta(seconds=int(elapsed)),
+            datetime.timedelta(seconds=int(eta))
+        )
@@ -0,0 +1,285 @@
+"""FHIR XML input.
+
+Resources and bundles in FHIR's XML representation are converted to the
+json representation (dicts), so the rest of fhirutils handles them like
+json. The XML is read with an incremental parser (iterparse): the entries of
+a bundle are converted one at a time and their elements are released right
+after, so a large searchset is never held as element tree.
+
+XML doesn't tell whether an element repeats (is a json array) if it occurs
+only once. Elements that occur more than once are always arrays; single
+ones are arrays if their name is in REPEATING or their path in
+REPEATING_PATHS (as "Resource.element" or "parent.element", e.g.
+"Encounter.type" resp. "participant.type"), else single values. Both
+cover the datatypes, Bundle, CapabilityStatement and the resources of the
+profiles; extend them for other resources. Primitive values are strings
+except for booleans and numbers, which are recognized by their element's
+name (e.g. total, valueInteger, Quantity.value).
+"""
+
+import functools
+import io
+import re
+import xml.etree.ElementTree as ET
+
+FHIR_NS = "http://hl7.org/fhir"
+XHTML_NS = "http://www.w3.org/1999/xhtml"
+# namespaces of FHIR elements, some servers leave it out
+_FHIR = (FHIR_NS, None)
+
+# element names that are arrays wherever they occur
+REPEATING = {
+    "extension", "modifierExtension", "contained", "coding", "given", "prefix", "suffix", "line",
+    "telecom", "link", "entry", "issue", "tag", "security", "parameter", "part", "note",
+    "basedOn", "partOf", "instantiatesCanonical", "instantiatesUri", "reasonCode", "reasonReference",
+    "derivedFrom", "supportingInformation", "eventHistory", "detectedIssue", "insurance",
+    "dosageInstruction", "doseAndRate", "additionalInstruction", "event", "dayOfWeek", "timeOfDay", "when",
+    "participant", "diagnosis", "statusHistory", "classHistory", "episodeOfCare", "account",
+    "dietPreference", "specialCourtesy", "specialArrangement", "communication", "generalPractitioner",
+    "photo", "qualification", "component", "referenceRange", "hasMember", "interpretation", "stage",
+    "evidence", "complication", "complicationDetail", "followUp", "report", "focalDevice",
+    "usedReference", "usedCode", "ingredient"
+}
+
+# elements that are arrays in some places only: "Resource.element" or
+# "parent.element" (the last two steps of the element's path)
+REPEATING_PATHS = {
+    "meta.profile", "participant.type", "contact.relationship", "referenceRange.appliesTo",
+    "stage.assessment", "evidence.code", "evidence.detail",
+    "Encounter.type", "Encounter.location",
+    "Patient.name", "Patient.address", "Patient.contact", "Practitioner.name", "Practitioner.address",
+    "RelatedPerson.name", "RelatedPerson.address", "Organization.address", "Organization.contact",
+    "MedicationStatement.dosage", "MedicationStatement.statusReason",
+    "MedicationAdministration.statusReason", "MedicationAdministration.performer",
+    "MedicationAdministration.device", "MedicationAdministration.instantiates", "MedicationRequest.category",
+    "Observation.category", "Observation.focus", "Observation.performer",
+    "Condition.category", "Condition.bodySite", "Procedure.bodySite", "Procedure.performer",
+    "CapabilityStatement.format", "CapabilityStatement.patchFormat", "CapabilityStatement.instantiates",
+    "CapabilityStatement.imports", "CapabilityStatement.implementationGuide", "CapabilityStatement.rest",
+    "rest.resource", "rest.interaction", "rest.searchParam", "rest.operation", "rest.compartment",
+    "resource.interaction", "resource.searchParam", "resource.operation", "resource.searchInclude",
+    "resource.searchRevInclude", "resource.supportedProfile", "resource.referencePolicy", "security.service"
+}
+
+# a resource's identifier is an array except in these resources
+SINGLE_IDENTIFIER = {"Bundle", "Composition", "QuestionnaireResponse"}
+
+BOOLEANS = {
+    "active", "preferred", "userSelected", "experimental", "abstract", "immutable", "doNotPerform",
+    "inactive", "required", "repeats", "readOnly", "lockedDate", "mustSupport", "isModifier", "isSummary",
+    "readHistory", "updateCreate", "conditionalCreate", "conditionalUpdate", "cors"
+}
+
+INTEGERS = {
+    "total", "rank", "sequence", "count", "countMax", "frequency", "frequencyMax", "offset", "dimensions",
+    "numberOfRepeatsAllowed", "numberOfSeries", "numberOfInstances"
+}
+
+DECIMALS = {"duration", "durationMax", "period", "periodMax", "factor", "lowerLimit", "upperLimit"}
+
+# primitive elements, they may come without value if they have an id or
+# extensions (e.g. a data-absent-reason); a repeated one is recognized by a
+# sibling with value, choice elements by their type
+PRIMITIVES = {
+    "status", "gender", "family", "given", "prefix", "suffix", "line", "city", "district",
+    "state", "postalCode", "country", "use", "system", "version", "display", "value", "unit", "reference",
+    "start", "end", "date", "issued", "authoredOn", "recorded", "dateAsserted", "intent", "priority"
+}
+_PRIMITIVE_TYPES = ("String", "Boolean", "Integer", "Decimal", "Date", "DateTime", "Instant", "Time",
+                    "Uri", "Url", "Canonical", "Markdown", "PositiveInt", "UnsignedInt")
+
+# siblings that make "value" a Quantity's (or Money's) decimal
+_QUANTITY = {"unit", "code", "comparator", "currency"}
+
+_NUMBER = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?$")
+
+
+def is_xml(content_type):
+    """whether a Content-Type header denotes XML (application/fhir+xml,
+    application/xml, text/xml)"""
+    return content_type is not None and "xml" in content_type.split(";")[0].lower()
+
+
+def iter_entries(source, bundle=None):
+    """yields the entries of a FHIR XML bundle (a file name or binary file
+    object) one at a time, converted to dicts. The bundle's other elements
+    (type, total, link, ...) are put into the dict bundle as they are
+    parsed, links precede the entries in FHIR XML. A resource that isn't a
+    bundle is put into bundle as a whole, no entries are yielded."""
+    if bundle is None:
+        bundle = {}
+    depth = 0
+    root = None
+    header = {}
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if root is None:
+                root = elem
+                if _split(root.tag)[1] == "Bundle":
+                    bundle["resourceType"] = "Bundle"
+            continue
+        depth -= 1
+        if depth == 0:
+            if _split(root.tag)[1] != "Bundle":
+                bundle.update(_resource(root))
+            root.clear()
+            return
+        if depth > 1 or _split(root.tag)[1] != "Bundle":
+            continue
+        ns, name = _split(elem.tag)
+        if ns in _FHIR and name == "entry":
+            yield _value(elem, name, "Bundle.entry", {name})[0]
+        elif ns in _FHIR:
+            # header elements are few, convert them again as they repeat
+            header.setdefault(name, []).append(_value(elem, name, "Bundle." + name, {name}))
+            _add(bundle, name, header[name], _repeats(name, "Bundle." + name, 1))
+        # the converted elements are released
+        root.clear()
+
+
+def loads(data):
+    """converts a FHIR XML resource or bundle (bytes or str) to a dict"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return _load(io.BytesIO(data))
+
+
+def load(path):
+    """converts a FHIR XML file to a dict"""
+    return _load(path)
+
+
+def _load(source):
+    bundle = {}
+    entries = list(iter_entries(source, bundle))
+    if entries:
+        bundle["entry"] = entries
+    return bundle
+
+
+@functools.lru_cache(maxsize=4096)
+def _split(tag):
+    """returns (namespace, local name) of a tag"""
+    if tag[:1] == "{":
+        ns, _, name = tag[1:].partition("}")
+        return ns, name
+    return None, tag
+
+
+def _resource(elem):
+    resource_type = _split(elem.tag)[1]
+    data = {"resourceType": resource_type}
+    _fill(data, elem, resource_type)
+    return data
+
+
+def _fill(data, elem, path):
+    """converts the child elements of elem to the keys of data"""
+    children = {}
+    for child in elem:
+        if not isinstance(child.tag, str):
+            # comments and processing instructions
+            continue
+        ns, name = _split(child.tag)
+        if ns == XHTML_NS and name == "div":
+            data["div"] = _xhtml(child)
+        elif ns in _FHIR:
+            children.setdefault(name, []).append(child)
+    for name, elements in children.items():
+        child_path = path + "." + name
+        _add(data, name, [_value(child, name, child_path, children) for child in elements],
+             _repeats(name, child_path, path.count(".") + 1))
+
+
+def _add(data, name, converted, repeating):
+    """puts the converted (value, extra) pairs of the name elements into
+    data, extras (id and extensions of primitives) go to "_" + name"""
+    values = [value for value, _ in converted]
+    extras = [extra for _, extra in converted]
+    if repeating or len(converted) > 1:
+        data[name] = values
+        if any(extra is not None for extra in extras):
+            data["_" + name] = extras
+        return
+    if values[0] is not None:
+        data[name] = values[0]
+    if extras[0] is not None:
+        data["_" + name] = extras[0]
+
+
+@functools.lru_cache(maxsize=4096)
+def _repeats(name, path, depth):
+    if name in REPEATING or path in REPEATING_PATHS:
+        return True
+    steps = path.split(".")
+    if ".".join(steps[-2:]) in REPEATING_PATHS:
+        return True
+    return name == "identifier" and depth == 1 and steps[0] not in SINGLE_IDENTIFIER
+
+
+def _value(elem, name, path, siblings):
+    """returns (value, extra) of an element: a primitive value with its id
+    and extensions (or None), a contained resource or a complex element"""
+    value = elem.get("value")
+    if value is not None or _valueless_primitive(elem, name, siblings):
+        extra = {}
+        if elem.get("id") is not None:
+            extra["id"] = elem.get("id")
+        _fill(extra, elem, path)
+        return None if value is None else _primitive(name, value, siblings), extra or None
+    for child in elem:
+        if isinstance(child.tag, str):
+            ns, child_name = _split(child.tag)
+            if ns in _FHIR and child_name[:1].isupper():
+                # resource, contained, outcome, ...
+                return _resource(child), None
+            break
+    data = {}
+    for attr in ("id", "url"):
+        if elem.get(attr) is not None:
+            data[attr] = elem.get(attr)
+    _fill(data, elem, path)
+
+    return data, None
+
+
+def _valueless_primitive(elem, name, siblings):
+    """whether an element without value is a primitive with an id or
+    extensions only"""
+    if elem.get("id") is None and not len(elem):
+        return False
+    for child in elem:
+        if isinstance(child.tag, str):
+            ns, child_name = _split(child.tag)
+            if ns not in _FHIR or child_name != "extension":
+                return False
+    if name in PRIMITIVES or name in BOOLEANS or name in INTEGERS or name in DECIMALS or \
+            name.endswith(_PRIMITIVE_TYPES):
+        return True
+    return isinstance(siblings, dict) and any(e.get("value") is not None for e in siblings.get(name, ()))
+
+
+def _primitive(name, value, siblings):
+    if name in BOOLEANS or name.endswith("Boolean"):
+        if value in ("true", "false"):
+            return value == "true"
+    elif name in INTEGERS or name.endswith(("Integer", "UnsignedInt", "PositiveInt")):
+        if _NUMBER.match(value) and value.lstrip("-").isdigit():
+            return int(value)
+    elif name in DECIMALS or name.endswith("Decimal") or (name == "value" and not _QUANTITY.isdisjoint(siblings)):
+        if _NUMBER.match(value):
+            return int(value) if value.lstrip("-").isdigit() else float(value)
+    return value
+
+
+def _xhtml(elem):
+    """the narrative's div as string"""
+    tail, elem.tail = elem.tail, None
+    try:
+        return ET.tostring(elem, encoding="unicode", default_namespace=XHTML_NS)
+    except ValueError:
+        # elements without namespace
+        return ET.tostring(elem, encoding="unicode")
+    finally:
+        elem.tail = tail
@@ -1,3 +1,8 @@
 from setuptools import setup, find_packages
 
-setup(name="fhirutils", version="a0.1", packages=find_packages())
\ No newline at end of file
+setup(name="fhirutils",
+      version="a0.1",
+      packages=find_packages(),
+      install_requires=["requests"],
+      extras_require={"pandas": ["pandas"], "orjson": ["orjson"], "arrow": ["pyarrow"]},
+      entry_points={"console_scripts": ["fhirutils=fhirutils.cli:main"]})
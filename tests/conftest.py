@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the package of this checkout and the mock server of the benchmarks
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from mockserver import MockFHIRServer  # noqa: E402
+from fhirutils.transport import Transport  # noqa: E402
+
+CONFIG_PATH = os.path.join(ROOT, "config.json")
+
+
+@pytest.fixture
+def server():
+    """starts mock FHIR servers with the given resources, stops them after the test"""
+    servers = []
+
+    def start(resources=None, **options):
+        servers.append(MockFHIRServer(resources, **options).start())
+        return servers[-1]
+
+    yield start
+    for s in servers:
+        s.stop()
+
+
+def fail_pages(server, match, status=500):
+    """lets server answer every GET whose path contains match with status"""
+    get = server._get
+
+    def _get(path):
+        if match in path:
+            return status, {"resourceType": "OperationOutcome",
+                            "issue": [{"severity": "error", "code": "exception"}]}
+        return get(path)
+
+    server._get = _get
+    return lambda: setattr(server, "_get", get)
+
+
+class FlakyTransport(Transport):
+    """Transport whose requests to urls containing one of fail raise a
+    ConnectionError, as after exhausted retries"""
+
+    def __init__(self, fail=(), **kwargs):
+        super().__init__(**kwargs)
+        self.fail = list(fail)
+
+    def request(self, method, url, **kwargs):
+        if any(match in url for match in self.fail):
+            raise requests.ConnectionError("Connection aborted (injected): " + url)
+        return super().request(method, url, **kwargs)
@@ -0,0 +1,64 @@
+import asyncio
+
+import synthetic
+from conftest import CONFIG_PATH, FlakyTransport, fail_pages
+from fhirutils.aio import AsyncConnector
+from fhirutils.transport import Transport
+
+RESOURCES = ["Encounter", "Patient", "MedicationStatement", "Medication"]
+
+
+def _connect(source, destination, encounters):
+    connector = AsyncConnector(fhirbase_source=source.url,
+                               fhirbase_destination=destination.url,
+                               enc_no_lst=encounters,
+                               verbose=0,
+                               transport=Transport(retries=0))
+    try:
+        return asyncio.run(connector.connect(RESOURCES, CONFIG_PATH, "KDS", max_in_flight=10))
+    finally:
+        connector.close()
+
+
+def test_failed_patient_search_fails_every_record_of_the_patient(server):
+    # one patient, its records share the MedicationStatement?subject= search
+    resources = synthetic.generate(patients=1, encounters_per_patient=4, statements_per_encounter=2,
+                                   administrations_per_encounter=0, medications=5, unresolvable_rate=0)
+    encounters = synthetic.encounter_ids(resources)
+    source = server(resources, latency=0.05)
+    fail_pages(source, "MedicationStatement?subject=")
+
+    assert sorted(_connect(source, server(), encounters)) == sorted(encounters)
+
+
+def test_failed_medication_batch_fails_every_record_that_needs_it(server):
+    resources = synthetic.generate(patients=4, encounters_per_patient=1, statements_per_encounter=1,
+                                   administrations_per_encounter=0, medications=1, unresolvable_rate=0)
+    encounters = synthetic.encounter_ids(resources)
+    source = server(resources, latency=0.05)
+    fail_pages(source, "Medication?_id=")
+
+    assert sorted(_connect(source, server(), encounters)) == sorted(encounters)
+
+
+def test_connection_error_fails_only_the_affected_records(server):
+    resources = synthetic.generate(patients=3, encounters_per_patient=2, statements_per_encounter=2,
+                                   administrations_per_encounter=0, medications=5, unresolvable_rate=0)
+    encounters = synthetic.encounter_ids(resources)
+    source = server(resources, latency=0.02)
+    destination = server()
+    # the patient-scoped search shared by the records of pat-0, and a search
+    # of a single record of pat-1
+    transport = FlakyTransport(fail=["MedicationStatement?subject=pat-0", "Encounter?_id=enc-1-1&"], retries=0)
+    connector = AsyncConnector(fhirbase_source=source.url,
+                               fhirbase_destination=destination.url,
+                               enc_no_lst=encounters,
+                               verbose=0,
+                               transport=transport)
+    try:
+        failed = asyncio.run(connector.connect(RESOURCES, CONFIG_PATH, "KDS", max_in_flight=10))
+    finally:
+        connector.close()
+
+    assert sorted(failed) == ["enc-0-0", "enc-0-1", "enc-1-1"]
+    assert {"enc-1-0", "enc-2-0", "enc-2-1"} <= set(destination.store.resources["Encounter"])
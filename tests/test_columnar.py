@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+from fhirutils.columnar import ColumnarExtractor
+
+pa = pytest.importorskip("pyarrow")
+
+
+def _statements(doses):
+    return [{"resourceType": "MedicationStatement",
+             "id": "ms-" + str(n),
+             "dosage": [{"doseAndRate": [{"doseQuantity": {"value": dose}}]}]}
+            for n, dose in enumerate(doses)]
+
+
+def test_types_are_checked_across_batches():
+    extractor = ColumnarExtractor({"id": "resource.id",
+                                   "dose": "resource.dosage.0.doseAndRate.0.doseQuantity.value",
+                                   "doses": "resource.dosage.X.doseAndRate.X.doseQuantity.value"},
+                                  batch_size=2)
+    table = extractor.to_table(_statements([1, 2, 0.5]))
+    assert table.schema.field("dose").type == pa.float64()
+    assert table.column("dose").to_pylist() == [1.0, 2.0, 0.5]
+    assert table.column("doses").to_pylist() == [[1.0], [2.0], [0.5]]
+
+    extractor = ColumnarExtractor({"dose": "resource.dosage.0.doseAndRate.0.doseQuantity.value"},
+                                  batch_size=2)
+    with pytest.raises(ValueError, match="dose"):
+        extractor.to_table(_statements([1, 2, "n/a"]))
+
+    extractor = ColumnarExtractor({"dose": "resource.dosage.0.doseAndRate.0.doseQuantity.value"},
+                                  types={"dose": "string"}, batch_size=2)
+    assert extractor.to_table(_statements([1, 2, "n/a"])).column("dose").to_pylist() == ["1", "2", "n/a"]
+
+
+def test_fhir_datetimes_to_timestamps():
+    administrations = [{"resourceType": "MedicationAdministration", "id": "ma-0",
+                        "effectiveDateTime": "2021-07-17T12:00:00+01:00"},
+                       {"resourceType": "MedicationAdministration", "id": "ma-1",
+                        "effectiveDateTime": "2021-07-17T12:00:00.250Z"},
+                       {"resourceType": "MedicationAdministration", "id": "ma-2",
+                        "effectiveDateTime": "2021-07"},
+                       {"resourceType": "MedicationAdministration", "id": "ma-3"}]
+    extractor = ColumnarExtractor({"effective": "resource.effectiveDateTime",
+                                   "local": "resource.effectiveDateTime",
+                                   "day": "resource.effectiveDateTime"},
+                                  types={"effective": pa.timestamp("ms", tz="UTC"),
+                                         "local": "timestamp[ms]",
+                                         "day": "date32"},
+                                  batch_size=3)
+    table = extractor.to_table(administrations)
+    assert table.schema.field("effective").type == pa.timestamp("ms", tz="UTC")
+    utc = [None if t is None else t.replace(tzinfo=None) for t in table.column("effective").to_pylist()]
+    assert utc == table.column("local").to_pylist() == [datetime.datetime(2021, 7, 17, 11),
+                                                        datetime.datetime(2021, 7, 17, 12, 0, 0, 250000),
+                                                        datetime.datetime(2021, 7, 1),
+                                                        None]
+    assert table.column("day").to_pylist() == [datetime.date(2021, 7, 17),
+                                               datetime.date(2021, 7, 17),
+                                               datetime.date(2021, 7, 1),
+                                               None]
+
+    extractor = ColumnarExtractor({"effective": "resource.effectiveDateTime"},
+                                  types={"effective": pa.timestamp("ms", tz="UTC")})
+    with pytest.raises(ValueError, match="effective"):
+        extractor.to_table([{"resourceType": "MedicationAdministration", "effectiveDateTime": "unknown"}])
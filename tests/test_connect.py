@@ -0,0 +1,43 @@
+import pytest
+
+import synthetic
+from conftest import CONFIG_PATH, FlakyTransport
+from fhirutils.loader import Connector
+
+RESOURCES = ["Encounter", "Patient", "MedicationStatement", "Medication"]
+
+
+@pytest.mark.parametrize("workers, pool", [(1, "thread"), (4, "thread"), (2, "process"), (2, "staged")])
+def test_connection_error_fails_only_its_encounter(server, workers, pool):
+    resources = synthetic.generate(patients=3, encounters_per_patient=2, statements_per_encounter=2,
+                                   administrations_per_encounter=0, medications=5, unresolvable_rate=0)
+    encounters = synthetic.encounter_ids(resources)
+    source = server(resources)
+    destination = server()
+    connector = Connector(fhirbase_source=source.url,
+                          fhirbase_destination=destination.url,
+                          enc_no_lst=encounters,
+                          verbose=0,
+                          transport=FlakyTransport(fail=["encounter=" + encounters[1]], retries=0))
+
+    assert connector.connect(RESOURCES, CONFIG_PATH, "ID Logik", workers=workers, pool=pool) == [encounters[1]]
+    uploaded = set(destination.store.resources["Encounter"])
+    assert uploaded == set(encounters) - {encounters[1]}
+
+
+def test_connection_error_in_the_upload_stage_fails_only_its_encounter(server):
+    resources = synthetic.generate(patients=3, encounters_per_patient=2, statements_per_encounter=2,
+                                   administrations_per_encounter=0, medications=5, unresolvable_rate=0)
+    encounters = synthetic.encounter_ids(resources)
+    source = server(resources)
+    destination = server()
+    transport = FlakyTransport(retries=0)
+    connector = Connector(fhirbase_source=source.url,
+                          fhirbase_destination=destination.url,
+                          enc_no_lst=encounters,
+                          verbose=0,
+                          transport=transport)
+    # uploads go to the destination's base url, all of them fail
+    transport.fail.append(destination.url)
+
+    assert sorted(connector.connect(RESOURCES, CONFIG_PATH, "ID Logik", workers=2, pool="staged")) == sorted(encounters)
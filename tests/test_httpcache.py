@@ -0,0 +1,183 @@
+import requests
+import pytest
+
+import synthetic
+from fhirutils import serialization
+from fhirutils.httpcache import HTTPCache, normalize_url
+from fhirutils.transport import Transport
+
+
+class Clock():
+    """a clock that only moves when told to"""
+
+    def __init__(self, now=1626523200.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def _gets(server):
+    return server.stats()["requests"].get("GET", 0)
+
+
+def _response(body, **headers):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = body
+    response.headers.update({key.replace("_", "-"): value for key, value in headers.items()})
+    return response
+
+
+@pytest.fixture
+def cached(server, tmp_path):
+    """returns a mock server, a transport with a cache and the cache's clock;
+    the cache is built with the given options"""
+    transports = []
+
+    def start(**options):
+        fhir = server(synthetic.generate(patients=2, encounters_per_patient=1, seed=0))
+        clock = Clock()
+        transports.append(Transport(cache=HTTPCache(str(tmp_path / "cache.sqlite"), clock=clock, **options)))
+        return fhir, transports[-1], clock
+
+    yield start
+    for transport in transports:
+        transport.close()
+
+
+def test_revalidated_with_etag(cached):
+    fhir, transport, _ = cached()
+    url = fhir.url + "Encounter?_id=enc-0-0"
+
+    body = transport.get(url).content
+    sent = fhir.stats()["bytes_sent"]
+    assert _gets(fhir) == 1 and transport.cache.misses == 1
+
+    # a 304 costs a request but no payload
+    req = transport.get(url)
+    assert req.status_code == 200 and req.content == body
+    assert serialization.loads_response(req)["entry"][0]["resource"]["id"] == "enc-0-0"
+    assert _gets(fhir) == 2 and transport.cache.revalidated == 1
+    assert fhir.stats()["bytes_sent"] == sent
+
+    # a changed resource is downloaded again
+    encounter = dict(fhir.store.resources["Encounter"]["enc-0-0"], status="cancelled")
+    fhir.store.put(encounter)
+    req = transport.get(url)
+    assert serialization.loads_response(req)["entry"][0]["resource"]["status"] == "cancelled"
+    assert _gets(fhir) == 3 and transport.cache.misses == 2
+    assert transport.get(url).content == req.content
+    assert _gets(fhir) == 4 and transport.cache.revalidated == 2
+
+
+def test_fresh_responses_are_returned_without_a_request(cached):
+    fhir, transport, clock = cached(fresh_for=60)
+    url = fhir.url + "Encounter?_id=enc-0-0"
+
+    body = transport.get(url).content
+    clock.advance(59)
+    assert transport.get(url).content == body
+    assert _gets(fhir) == 1 and transport.cache.hits == 1
+
+    # a revalidation starts fresh_for again
+    clock.advance(2)
+    assert transport.get(url).content == body
+    assert _gets(fhir) == 2 and transport.cache.revalidated == 1
+    clock.advance(59)
+    transport.get(url)
+    assert _gets(fhir) == 2 and transport.cache.hits == 2
+
+
+def test_expired_responses_are_downloaded_again(cached):
+    fhir, transport, clock = cached(ttl=3600)
+    url = fhir.url + "Encounter?_id=enc-0-0"
+
+    transport.get(url)
+    sent = fhir.stats()["bytes_sent"]
+    clock.advance(3599)
+    transport.get(url)
+    assert _gets(fhir) == 2 and transport.cache.revalidated == 1
+    assert fhir.stats()["bytes_sent"] == sent
+
+    # the revalidation started the ttl again
+    clock.advance(3599)
+    transport.get(url)
+    assert transport.cache.revalidated == 2 and transport.cache.misses == 1
+    clock.advance(3601)
+    transport.get(url)
+    assert _gets(fhir) == 4 and transport.cache.misses == 2
+    assert fhir.stats()["bytes_sent"] == 2 * sent
+
+
+def test_normalized_urls_share_an_entry(cached):
+    fhir, transport, _ = cached()
+    read = "Encounter/enc-0-0?_pretty=false&_format=json&_elements=id,status"
+    host, port = fhir.url.split("/")[2].split(":")
+
+    transport.get(fhir.url + read)
+    transport.get("HTTP://" + host + ":" + port + "/Encounter/enc-0-0?_elements=id,status&_format=json&_pretty=false#x")
+    assert _gets(fhir) == 2 and transport.cache.misses == 1 and transport.cache.revalidated == 1
+
+    transport.get(fhir.url + "Encounter/enc-0-0?_pretty=true&_format=json&_elements=id,status")
+    assert transport.cache.misses == 2
+
+
+def test_normalize_url():
+    assert normalize_url("HTTPS://Fhir.Example.org:443/fhir/Encounter?b=2&a=1#top") == \
+        "https://fhir.example.org/fhir/Encounter?a=1&b=2"
+    assert normalize_url("http://fhir.example.org:80?b=2") == "http://fhir.example.org/?b=2"
+    assert normalize_url("http://fhir.example.org:8080/fhir/Encounter") == "http://fhir.example.org:8080/fhir/Encounter"
+    # the order of repeated parameters is kept, ":", "," and "/" aren't quoted
+    assert normalize_url("http://x/Encounter?date=lt2021&_id=a,b&date=ge2020&subject=Patient/p:1") == \
+        "http://x/Encounter?_id=a,b&date=lt2021&date=ge2020&subject=Patient/p:1"
+    assert normalize_url("http://x/Patient?name=") == "http://x/Patient?name="
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path):
+    clock = Clock()
+    cache = HTTPCache(str(tmp_path / "cache.sqlite"), max_bytes=250, clock=clock)
+    for name in "abc":
+        if name == "c":
+            # a is used again, b is the least recently used response now
+            cache.hit("http://x/a")
+        assert cache.store("http://x/" + name, _response(name.encode() * 100, ETag='"' + name + '"'))
+        clock.advance(1)
+    assert cache.lookup("http://x/b") is None
+    assert cache.lookup("http://x/a")["body"] == b"a" * 100
+    assert cache.lookup("http://x/c")["etag"] == '"c"'
+
+    # too large for the cache at all
+    assert not cache.store("http://x/d", _response(b"d" * 251, ETag='"d"'))
+    assert cache.lookup("http://x/a") is not None
+    cache.close()
+
+
+def test_what_is_stored(tmp_path):
+    cache = HTTPCache(str(tmp_path / "cache.sqlite"))
+    modified = "Sat, 17 Jul 2021 12:00:00 GMT"
+
+    assert cache.store("http://x/a", _response(b"a", Last_Modified=modified))
+    entry = cache.lookup("http://x/a")
+    assert cache.request_headers(entry) == {"If-Modified-Since": modified}
+    cache.revalidate("http://x/a", {"Last-Modified": "Sun, 18 Jul 2021 12:00:00 GMT", "ETag": '"a"'})
+    assert cache.request_headers(cache.lookup("http://x/a")) == \
+        {"If-None-Match": '"a"', "If-Modified-Since": "Sun, 18 Jul 2021 12:00:00 GMT"}
+
+    # without validators only if it may be served fresh
+    assert not cache.store("http://x/b", _response(b"b"))
+    assert not cache.store("http://x/c", _response(b"c", ETag='"c"', Cache_Control="no-store"))
+    error = _response(b"e", ETag='"e"')
+    error.status_code = 500
+    assert not cache.store("http://x/e", error)
+    assert cache.misses == 4
+    cache.close()
+
+    cache = HTTPCache(str(tmp_path / "cache.sqlite"), fresh_for=60)
+    assert cache.store("http://x/b", _response(b"b"))
+    assert cache.lookup("http://x/b")["fresh"]
+    assert cache.request_headers(cache.lookup("http://x/b")) == {}
+    cache.close()
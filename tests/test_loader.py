@@ -0,0 +1,68 @@
+import asyncio
+
+import synthetic
+from conftest import CONFIG_PATH
+from fhirutils.aio import AsyncConnector
+from fhirutils.loader import Loader
+
+RESOURCES = ["Encounter", "Patient", "MedicationStatement", "Medication"]
+
+
+def _without_subject(resources, encounters):
+    for resource in resources:
+        if resource["resourceType"] == "Encounter" and resource["id"] in encounters:
+            del resource["subject"]
+    return resources
+
+
+def _record_paths(server):
+    paths = []
+    get = server._get
+
+    def _get(path):
+        paths.append(path)
+        return get(path)
+
+    server._get = _get
+    return paths
+
+
+def test_patient_scoped_searches_need_the_patient(server):
+    resources = synthetic.generate(patients=2, encounters_per_patient=2, statements_per_encounter=2,
+                                   administrations_per_encounter=0, medications=5, unresolvable_rate=0)
+    unresolved = synthetic.encounter_ids(resources)[:2]
+    source = server(_without_subject(resources, unresolved))
+    paths = _record_paths(source)
+
+    loader = Loader(fhirbase=source.url, verbose=0)
+    for enc in unresolved:
+        loader.errorstatus = False
+        loader.getRecord(enc, RESOURCES, CONFIG_PATH, "KDS")
+        assert loader.errorstatus
+    assert not any("subject=None" in path for path in paths)
+    assert loader.patient_cache.get((None, "MedicationStatement")) is None
+
+    loader.errorstatus = False
+    bundle = loader.getRecord(synthetic.encounter_ids(resources)[2], RESOURCES, CONFIG_PATH, "KDS")
+    assert not loader.errorstatus
+    assert any(e["resource"]["resourceType"] == "MedicationStatement" for e in bundle["entry"])
+
+
+def test_async_records_without_patient_fail(server):
+    resources = synthetic.generate(patients=2, encounters_per_patient=2, statements_per_encounter=2,
+                                   administrations_per_encounter=0, medications=5, unresolvable_rate=0)
+    encounters = synthetic.encounter_ids(resources)
+    unresolved = encounters[:2]
+    source = server(_without_subject(resources, unresolved))
+    paths = _record_paths(source)
+
+    connector = AsyncConnector(fhirbase_source=source.url,
+                               fhirbase_destination=server().url,
+                               enc_no_lst=encounters,
+                               verbose=0)
+    try:
+        failed = asyncio.run(connector.connect(RESOURCES, CONFIG_PATH, "KDS"))
+    finally:
+        connector.close()
+    assert sorted(failed) == sorted(unresolved)
+    assert not any("subject=None" in path for path in paths)
@@ -0,0 +1,195 @@
+from contextlib import ExitStack
+from email.utils import formatdate
+
+import pytest
+
+from fhirutils.ratelimit import RateLimiter, host_key, retry_after
+
+URL = "http://fhir.example.org:8080/fhir/Encounter?_id=enc-0"
+
+
+class Clock():
+    """a clock that only moves when told to"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def _grow_to(limiter, limit, latency=0.1):
+    """reports fast responses until the limit reaches limit, returns their number"""
+    responses = 0
+    while int(limiter.host(URL).limit) < limit:
+        limiter.feedback(URL, 200, latency)
+        responses += 1
+        assert responses < 100
+    return responses
+
+
+def test_additive_increase_multiplicative_decrease():
+    clock = Clock()
+    limiter = RateLimiter(max_concurrency=8, clock=clock)
+    host = limiter.host(URL)
+    assert host.limit == 4
+
+    with ExitStack() as stack:
+        # a limit only grows while it is used
+        limiter.feedback(URL, 200, 0.1)
+        assert host.limit == 4
+        for _ in range(3):
+            stack.enter_context(limiter.slot(URL))
+        # grows by one after about a limit's worth of responses
+        assert _grow_to(limiter, 5) == 5
+        stack.enter_context(limiter.slot(URL))
+        assert _grow_to(limiter, 6) == 5
+
+        limit = host.limit
+        assert limiter.feedback(URL, 500, 0.1) is None
+        assert host.limit == limit / 2 and host.ceiling == limit and host.decreases == 1
+        # errors within one smoothed latency of the cut count once
+        limiter.feedback(URL, None, 5.0)
+        assert host.limit == limit / 2 and host.decreases == 1
+        clock.advance(1.0)
+        limiter.feedback(URL, None, 5.0)
+        assert host.limit == limit / 4 and host.decreases == 2
+
+        # never below min_concurrency
+        for _ in range(5):
+            clock.advance(1.0)
+            limiter.feedback(URL, 502, 0.1)
+        assert host.limit == 1
+
+
+def test_decrease_on_latency():
+    clock = Clock()
+    limiter = RateLimiter(max_concurrency=8, latency_tolerance=4.0, clock=clock)
+    host = limiter.host(URL)
+    for _ in range(10):
+        limiter.feedback(URL, 200, 0.1)
+    assert host.baseline == pytest.approx(0.1)
+
+    clock.advance(1.0)
+    limiter.feedback(URL, 200, 0.5)
+    assert host.decreases == 0
+    clock.advance(1.0)
+    limiter.feedback(URL, 200, 5.0)
+    assert host.decreases == 1 and host.limit == 2
+
+    limiter = RateLimiter(max_concurrency=8, latency_tolerance=None, clock=clock)
+    limiter.feedback(URL, 200, 0.1)
+    limiter.feedback(URL, 200, 5.0)
+    assert limiter.host(URL).decreases == 0
+
+
+def test_ceiling_is_probed_every_probe_interval():
+    clock = Clock()
+    limiter = RateLimiter(max_concurrency=10, probe_interval=10.0, clock=clock)
+    host = limiter.host(URL)
+
+    with ExitStack() as stack:
+        for _ in range(4):
+            stack.enter_context(limiter.slot(URL))
+        limiter.feedback(URL, 500, 0.1)
+        assert host.limit == 2.5 and host.ceiling == 5
+
+        # grows back to just below the ceiling and stays there
+        _grow_to(limiter, 4)
+        for _ in range(50):
+            clock.advance(0.1)
+            limiter.feedback(URL, 200, 0.1)
+        assert int(host.limit) == 4 and host.ceiling == 5
+
+        # one step above it once probe_interval has passed since the cut
+        clock.advance(5.1)
+        limiter.feedback(URL, 200, 0.1)
+        assert int(host.limit) == 5 and host.ceiling == 6
+        for _ in range(50):
+            limiter.feedback(URL, 200, 0.1)
+        assert int(host.limit) == 5
+
+        clock.advance(10.1)
+        limiter.feedback(URL, 200, 0.1)
+        assert int(host.limit) == 6 and host.ceiling == 7
+
+        # the next overload sets a new ceiling
+        limiter.feedback(URL, 503, 0.1)
+        assert host.ceiling == host.limit * 2 and int(host.ceiling) == 6
+
+
+def test_token_bucket():
+    clock = Clock()
+    limiter = RateLimiter(max_rate=1.0, hosts={"http://fhir.example.org:8080/fhir": {"max_rate": 4.0}},
+                          clock=clock)
+    host = limiter.host(URL)
+    assert host.max_rate == 4.0
+    assert limiter.host("http://other.example.org/fhir").max_rate == 1.0
+
+    with host.cond:
+        assert limiter._reserve(host) is None
+        host.in_flight -= 1
+        assert limiter._reserve(host) == pytest.approx(0.25)
+        clock.advance(0.1)
+        assert limiter._reserve(host) == pytest.approx(0.15)
+        clock.advance(0.15)
+        assert limiter._reserve(host) is None
+        host.in_flight -= 1
+        # unused time doesn't save up more than one token
+        clock.advance(10.0)
+        assert limiter._reserve(host) is None
+        host.in_flight -= 1
+        assert limiter._reserve(host) == pytest.approx(0.25)
+
+
+def test_throttled_responses_pause_the_server():
+    clock = Clock()
+    limiter = RateLimiter(max_wait=60.0, clock=clock)
+    host = limiter.host(URL)
+
+    assert limiter.feedback(URL, 429, 0.1, {"Retry-After": "3"}) == 3.0
+    assert host.paused_until == clock.now + 3.0
+    with host.cond:
+        assert limiter._reserve(host) == 3.0
+    # exponential backoff without Retry-After
+    assert limiter.feedback(URL, 503, 0.1) == 1.0
+    assert limiter.feedback(URL, 503, 0.1) == 2.0
+    assert limiter.feedback(URL, 429, 0.1, {"Retry-After": "3600"}) == 60.0
+    assert host.throttled == 4
+    limiter.feedback(URL, 200, 0.1)
+    assert limiter.feedback(URL, 503, 0.1) == 0.5
+    assert limiter.snapshot()["fhir.example.org:8080"]["paused"] == 60.0
+
+    clock.advance(60.0)
+    with host.cond:
+        assert limiter._reserve(host) is None
+
+
+def test_should_retry():
+    limiter = RateLimiter(max_retries=2)
+    assert limiter.should_retry("get", 429, 0)
+    assert limiter.should_retry("POST", 429, 1)
+    assert not limiter.should_retry("GET", 429, 2)
+    assert limiter.should_retry("PUT", 503, 0)
+    assert not limiter.should_retry("POST", 503, 0)
+    assert not limiter.should_retry("GET", 500, 0)
+
+
+def test_retry_after():
+    now = 1626523200.0
+    assert retry_after(None) is None
+    assert retry_after({}) is None
+    assert retry_after({"Retry-After": "120"}, now) == 120.0
+    assert retry_after({"Retry-After": "-5"}, now) == 0.0
+    assert retry_after({"Retry-After": formatdate(now + 90, usegmt=True)}, now) == 90.0
+    assert retry_after({"Retry-After": formatdate(now - 90, usegmt=True)}, now) == 0.0
+    assert retry_after({"Retry-After": "soon"}, now) is None
+
+
+def test_host_key():
+    assert host_key(URL) == "fhir.example.org:8080"
+    assert host_key("https://FHIR.example.org/fhir") == "fhir.example.org"
+    assert host_key("fhir.example.org:8080") == "fhir.example.org:8080"
@@ -0,0 +1,80 @@
+import datetime
+
+import synthetic
+from conftest import CONFIG_PATH, fail_pages
+from fhirutils.loader import Connector
+from fhirutils.transport import Transport
+
+RESOURCES = ["Encounter", "Patient", "MedicationStatement", "Medication"]
+
+
+def _connector(source, destination, encounters, statepath):
+    return Connector(fhirbase_source=source.url,
+                     fhirbase_destination=destination.url,
+                     enc_no_lst=encounters,
+                     statepath=statepath,
+                     verbose=0,
+                     transport=Transport(retries=0))
+
+
+def _touch(resource):
+    stamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    resource["meta"] = {"lastUpdated": stamp}
+    resource["status"] = "completed"
+
+
+def test_sync_keeps_watermarks_if_scan_fails(server, tmp_path):
+    resources = synthetic.generate(patients=3, encounters_per_patient=2, statements_per_encounter=2,
+                                   administrations_per_encounter=0, medications=5, unresolvable_rate=0)
+    encounters = synthetic.encounter_ids(resources)
+    source = server(resources)
+    destination = server()
+    statepath = str(tmp_path / "state.db")
+
+    connector = _connector(source, destination, encounters, statepath)
+    assert connector.sync(RESOURCES, CONFIG_PATH, "ID Logik", count=2) == []
+    marks = {r: connector.syncstate.watermark("ID Logik", r) for r in RESOURCES}
+    assert all(marks.values())
+
+    changed = [r for r in resources if r["resourceType"] == "MedicationStatement"][:5]
+    for resource in changed:
+        _touch(resource)
+    # the second page of the changed statements fails
+    restore = fail_pages(source, "_offset=2")
+    connector = _connector(source, destination, encounters, statepath)
+    failed = connector.sync(RESOURCES, CONFIG_PATH, "ID Logik", count=2)
+    assert sorted(failed) == sorted(encounters)
+    assert {r: connector.syncstate.watermark("ID Logik", r) for r in RESOURCES} == marks
+    stored = destination.store.resources["MedicationStatement"]
+    assert all(stored[r["id"]]["status"] == "active" for r in changed)
+
+    # the next sync finds the changes again
+    restore()
+    connector = _connector(source, destination, encounters, statepath)
+    assert connector.sync(RESOURCES, CONFIG_PATH, "ID Logik", count=2) == []
+    stored = destination.store.resources["MedicationStatement"]
+    assert all(stored[r["id"]]["status"] == "completed" for r in changed)
+
+
+def test_sync_stores_watermarks_if_a_record_has_no_statements(server, tmp_path, capsys):
+    resources = synthetic.generate(patients=3, encounters_per_patient=2, statements_per_encounter=2,
+                                   administrations_per_encounter=0, medications=5, unresolvable_rate=0)
+    encounters = synthetic.encounter_ids(resources)
+    # the first encounter has no MedicationStatements, a warning but no error
+    resources = [r for r in resources
+                 if r["resourceType"] != "MedicationStatement" or
+                 r["context"]["reference"] != "Encounter/" + encounters[0]]
+    source = server(resources)
+    destination = server()
+    statepath = str(tmp_path / "state.db")
+
+    connector = _connector(source, destination, encounters, statepath)
+    assert connector.sync(RESOURCES, CONFIG_PATH, "ID Logik", count=2) == []
+    assert all(connector.syncstate.watermark("ID Logik", r) for r in RESOURCES)
+
+    capsys.readouterr()
+    connector = _connector(source, destination, encounters, statepath)
+    assert connector.sync(RESOURCES, CONFIG_PATH, "ID Logik", count=2) == []
+    out = capsys.readouterr().out
+    assert "no watermark yet" not in out
+    assert "0 encounters to transfer" in out
@@ -0,0 +1,45 @@
+import synthetic
+from conftest import CONFIG_PATH, FlakyTransport
+from fhirutils.loader import Connector
+from fhirutils.syncstate import SyncState
+
+RESOURCES = ["Encounter", "Patient", "MedicationStatement", "Medication"]
+
+
+def test_pending(tmp_path):
+    state = SyncState(str(tmp_path / "state.db"), "http://destination/fhir/")
+    state.seed(["enc-0"])
+    state.checkpoint("enc-1")
+    state.checkpoint("enc-2", failed=True)
+    state.commit()
+
+    assert state.pending(["enc-0", "enc-1", "enc-2", "enc-3"]) == ["enc-2", "enc-3"]
+    other = SyncState(str(tmp_path / "state.db"), "http://other/fhir/")
+    assert other.pending(["enc-0", "enc-1"]) == ["enc-0", "enc-1"]
+
+
+def test_records_without_resources_are_checkpointed_as_transferred(server, tmp_path):
+    resources = synthetic.generate(patients=3, encounters_per_patient=1, statements_per_encounter=2,
+                                   administrations_per_encounter=0, medications=5, unresolvable_rate=0)
+    encounters = synthetic.encounter_ids(resources)
+    # enc-0-0 has no MedicationStatements, the download of enc-1-0 fails
+    resources = [r for r in resources
+                 if r["resourceType"] != "MedicationStatement" or
+                 r["context"]["reference"] != "Encounter/enc-0-0"]
+    source = server(resources)
+    destination = server()
+    statepath = str(tmp_path / "state.db")
+
+    def connect(fail):
+        connector = Connector(fhirbase_source=source.url,
+                              fhirbase_destination=destination.url,
+                              enc_no_lst=encounters,
+                              incr=True,
+                              statepath=statepath,
+                              verbose=0,
+                              transport=FlakyTransport(fail=fail, retries=0))
+        return connector.enc_no_lst, connector.connect(RESOURCES, CONFIG_PATH, "ID Logik")
+
+    assert connect(["encounter=enc-1-0"]) == (encounters, ["enc-1-0"])
+    assert connect([]) == (["enc-1-0"], [])
+    assert connect([]) == ([], [])
@@ -0,0 +1,96 @@
+import requests
+
+from fhirutils import serialization
+from fhirutils.upload import BundleUploader, chunk_entries, dependency_tier, encode_entries
+
+
+class FakeTransport():
+    """answers the transactions it gets with the statuses of respond(types)
+    (an exception is raised), types are the resource types of a transaction"""
+
+    status_forcelist = (500, 502, 503, 504)
+    retries = 3
+
+    def __init__(self, respond=lambda types: 200):
+        self.respond = respond
+        self.sent = []
+
+    def request(self, method, url, data=None, headers=None):
+        types = [entry["resource"]["resourceType"] for entry in serialization.loads(data)["entry"]]
+        self.sent.append(types)
+        status = self.respond(types)
+        if isinstance(status, Exception):
+            raise status
+        response = requests.Response()
+        response.status_code = status
+        response._content = b'{"resourceType": "OperationOutcome", "issue": [{"diagnostics": "injected"}]}'
+        return response
+
+
+def _entry(resource_type, n, size=0):
+    return {"resource": {"resourceType": resource_type, "id": resource_type.lower() + "-" + str(n),
+                         "text": "x" * size},
+            "request": {"method": "PUT", "url": resource_type + "/" + str(n)}}
+
+
+def _bundle():
+    entries = [_entry("MedicationStatement", n) for n in range(3)] + \
+        [_entry("Medication", n) for n in range(2)] + \
+        [_entry("Encounter", 0), _entry("Patient", 0)]
+    return {"resourceType": "Bundle", "type": "transaction", "entry": entries}
+
+
+def test_dependency_tier():
+    tiers = [dependency_tier(_entry(t, 0)) for t in ("Patient", "Encounter", "Medication", "MedicationStatement")]
+    assert tiers == sorted(tiers) and len(set(tiers)) == 4
+
+
+def test_chunk_entries_limits():
+    encoded = encode_entries([_entry("Observation", n, size=100) for n in range(5)])
+    size = len(encoded[0][1]) + 1
+    assert [len(chunk) for chunk in chunk_entries(encoded, max_entries=2)] == [2, 2, 1]
+    assert [len(chunk) for chunk in chunk_entries(encoded, max_bytes=3 * size)] == [3, 2]
+    assert [len(chunk) for chunk in chunk_entries(encoded, max_entries=4, max_bytes=3 * size - 1)] == [2, 2, 1]
+    # an entry larger than max_bytes is a chunk of its own
+    assert [len(chunk) for chunk in chunk_entries(encoded, max_bytes=10)] == [1, 1, 1, 1, 1]
+    assert list(chunk_entries(encoded)) == [encoded]
+
+
+def test_tiers_are_uploaded_in_dependency_order():
+    transport = FakeTransport()
+    results = BundleUploader(transport, "http://fhir/", max_entries=2).upload(_bundle())
+    assert all(result.ok for result in results)
+    assert transport.sent == [["Patient"], ["Encounter"], ["Medication", "Medication"],
+                              ["MedicationStatement", "MedicationStatement"], ["MedicationStatement"]]
+    # a bundle within the limits is sent as one transaction
+    transport = FakeTransport()
+    BundleUploader(transport, "http://fhir/", max_entries=10).upload(_bundle())
+    assert len(transport.sent) == 1 and len(transport.sent[0]) == 7
+
+
+def test_later_tiers_are_skipped_after_a_failed_tier():
+    transport = FakeTransport(lambda types: 422 if "Encounter" in types else 200)
+    results = BundleUploader(transport, "http://fhir/", max_entries=2).upload(_bundle())
+    assert [result.ok for result in results] == [True, False, None, None, None]
+    assert results[1].status == 422 and results[1].message == "injected"
+    # a 4xx is not retried, the skipped tiers aren't sent
+    assert transport.sent == [["Patient"], ["Encounter"]]
+
+
+def test_retries():
+    def flaky(status):
+        answers = [status, 200]
+        return lambda types: answers.pop(0) if answers else 200
+
+    for method, status, sent in (("POST", 503, 2), ("POST", 429, 2), ("PUT", 429, 2),
+                                 ("PUT", 503, 1), ("POST", 400, 1), ("POST", 409, 1),
+                                 ("POST", requests.ConnectionError("dropped"), 2)):
+        transport = FakeTransport(flaky(status))
+        results = BundleUploader(transport, "http://fhir/", method=method).upload(_bundle())
+        assert len(transport.sent) == sent, (method, status)
+        assert results[0].ok == (sent == 2)
+
+    transport = FakeTransport(lambda types: requests.ConnectionError("dropped"))
+    results = BundleUploader(transport, "http://fhir/", retries=2).upload(_bundle())
+    assert len(transport.sent) == 3
+    assert results[0].ok is False and results[0].status is None and "ConnectionError" in results[0].message
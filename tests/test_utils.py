@@ -0,0 +1,99 @@
+import pytest
+
+from fhirutils.utils import Utils, compile_path
+
+BUNDLE = {"resourceType": "Bundle",
+          "entry": [{"resource": {"resourceType": "Encounter", "id": "enc-0", "status": "finished",
+                                  "type": [{"coding": [{"code": "a"}, {"code": "b"}]}]}},
+                    {"resource": {"resourceType": "Encounter", "id": "enc-1",
+                                  "type": [{"coding": [{"code": "c"}]}, {"text": "t"}]}},
+                    {"search": {"mode": "include"}}]}
+
+XML_BUNDLE = """<?xml version="1.0" encoding="UTF-8"?>
+<Bundle xmlns="http://hl7.org/fhir">
+  <entry><resource><Encounter><id value="enc-0"/><status value="finished"/>
+    <type><coding><code value="a"/></coding><coding><code value="b"/></coding></type>
+  </Encounter></resource></entry>
+  <entry><resource><Encounter><id value="enc-1"/>
+    <type><coding><code value="c"/></coding></type><type><text value="t"/></type>
+  </Encounter></resource></entry>
+  <entry><search><mode value="include"/></search></entry>
+</Bundle>
+"""
+
+
+# the results of the path engine before paths were compiled; paths it
+# couldn't handle (out-of-range indices, indices and wildcards behind a
+# wildcard) and missing keys (it returned the element the path broke off at)
+# are expected to give no match now
+@pytest.mark.parametrize("path, expected", [
+    ("entry.0.resource.id", [("entry.0.resource.id", "enc-0")]),
+    ("entry.0.resource.type.0.coding.1.code", [("entry.0.resource.type.0.coding.1.code", "b")]),
+    ("entry.-1.search.mode", [("entry.-1.search.mode", "include")]),
+    ("entry.-3.resource.id", [("entry.-3.resource.id", "enc-0")]),
+    ("entry.X.resource.id", [("entry.0.resource.id", "enc-0"), ("entry.1.resource.id", "enc-1")]),
+    ("entry.X.resource.status", [("entry.0.resource.status", "finished")]),
+    ("entry.X.resource.type", [("entry.0.resource.type", BUNDLE["entry"][0]["resource"]["type"]),
+                               ("entry.1.resource.type", BUNDLE["entry"][1]["resource"]["type"])]),
+    ("entry.X.resource.type.0.coding.0.code", [("entry.0.resource.type.0.coding.0.code", "a"),
+                                               ("entry.1.resource.type.0.coding.0.code", "c")]),
+    ("entry.X.resource.type.X.coding.X.code", [("entry.0.resource.type.0.coding.0.code", "a"),
+                                               ("entry.0.resource.type.0.coding.1.code", "b"),
+                                               ("entry.1.resource.type.0.coding.0.code", "c")]),
+    ("entry.3.resource.id", []),
+    ("entry.-4.resource.id", []),
+    ("entry.0.resource.missing", []),
+    ("entry.0.resource.id.missing", []),
+    ("entry.X.resource.missing", []),
+    ("entry.X.missing.id", []),
+])
+def test_find_by_path(path, expected):
+    assert Utils().find_by_path(path, BUNDLE, as_frame=False) == expected
+    compiled = compile_path(path)
+    assert list(compiled.items(BUNDLE)) == expected
+    assert list(compiled.values(BUNDLE)) == [value for _, value in expected]
+    assert compiled.first(BUNDLE, "default") == (expected[0][1] if expected else "default")
+
+
+def test_compile_path_is_cached():
+    assert compile_path("entry.X.resource") is compile_path("entry.X.resource")
+    assert compile_path("entry.X.resource.type.-1").steps == ("entry", "X", "resource", "type", -1)
+
+
+def test_frame():
+    pytest.importorskip("pandas")
+    utils = Utils()
+
+    df = utils.find_by_path("entry.X.resource.id", BUNDLE)
+    assert list(df.columns) == ["path", "value"]
+    assert df.values.tolist() == [["entry.0.resource.id", "enc-0"], ["entry.1.resource.id", "enc-1"]]
+
+    # like before, a path without wildcard gives a single row even if nothing matches
+    for path in ("entry.0.resource.missing", "entry.3.resource.id"):
+        assert utils.find_by_path(path, BUNDLE).values.tolist() == [[path, None]]
+
+    df = utils.find_by_path("entry.X.resource.missing", BUNDLE)
+    assert list(df.columns) == ["path", "value"] and len(df) == 0
+
+
+@pytest.mark.parametrize("path", [
+    "entry.1.resource.id",
+    "entry.0.resource.type.0.coding.X.code",
+    "entry.X.resource.id",
+    "entry.X.resource.type.X.coding.X.code",
+    "entry.X.search.mode",
+    "entry.X",
+    "entry.1",
+    "entry.3.resource.id",
+    "entry.-1.search.mode",
+    "entry.-3.resource.id",
+    "resourceType",
+])
+def test_find_in_xml(tmp_path, path):
+    source = tmp_path / "bundle.xml"
+    source.write_text(XML_BUNDLE, encoding="utf-8")
+    utils = Utils()
+
+    expected = utils.find_by_path(path, BUNDLE, as_frame=False)
+    assert utils.find_in_xml(path, str(source), as_frame=False) == expected
+    assert utils.get(i=path, s=str(source), t="local", f="xml", as_frame=False) == expected
@@ -0,0 +1,113 @@
+import io
+
+import synthetic
+from conftest import CONFIG_PATH
+from fhirutils import xmlio
+from fhirutils.loader import Loader
+
+RESOURCES = ["Encounter", "Patient", "MedicationStatement", "Medication"]
+
+DIV = '<div xmlns="http://www.w3.org/1999/xhtml"><p>Käthe <b>Müller</b></p><br /></div>'
+
+ABSENT = [{"url": "http://hl7.org/fhir/StructureDefinition/data-absent-reason", "valueCode": "unknown"}]
+
+
+def _enrich(resources):
+    """adds narratives, primitives with extensions, repeated elements and
+    numbers to synthetic resources"""
+    for resource in resources:
+        if resource["resourceType"] == "Patient":
+            resource["text"] = {"status": "generated", "div": DIV}
+            resource["identifier"] = [{"system": "urn:pid", "value": resource["id"]}]
+            resource["active"] = True
+            resource["name"][0]["given"] = ["Anna", "Lena", "Maria"]
+            resource["name"][0]["_given"] = [None, {"id": "g1", "extension": ABSENT}, None]
+            resource["_birthDate"] = {"extension": [{"url": "http://hl7.org/fhir/StructureDefinition/patient-birthTime",
+                                                     "valueDateTime": resource["birthDate"] + "T08:15:00+01:00"}]}
+            resource["_gender"] = {"id": "gender"}
+        elif resource["resourceType"] == "MedicationStatement":
+            resource["dosage"] = [{"sequence": 1, "text": "1-0-1",
+                                   "timing": {"repeat": {"frequency": 2, "period": 1.5, "periodUnit": "d",
+                                                         "when": ["MORN", "EVE"]}},
+                                   "doseAndRate": [{"doseQuantity": {"value": 0.5, "unit": "mg"}}]},
+                                  {"sequence": 2,
+                                   "doseAndRate": [{"doseQuantity": {"value": 40, "unit": "mg"}}]}]
+        elif resource["resourceType"] == "Encounter":
+            resource["type"] = [{"coding": [{"code": "stationaer"}]}]
+            resource["_status"] = {"extension": ABSENT}
+    return resources
+
+
+def test_xml_records_equal_json_records(server):
+    resources = _enrich(synthetic.generate(patients=2, encounters_per_patient=2, statements_per_encounter=3,
+                                           administrations_per_encounter=0, medications=5,
+                                           unresolvable_rate=0))
+    source = server(resources, page_size=2)
+    loader = Loader(fhirbase=source.url, verbose=0)
+
+    for enc in synthetic.encounter_ids(resources):
+        records = {}
+        for form in ("json", "xml"):
+            bundle = loader.getRecord(enc, RESOURCES, CONFIG_PATH, "KDS", count=2, form=form)
+            assert not loader.errorstatus and not loader.warningstatus
+            records[form] = sorted((entry["resource"] for entry in bundle["entry"]),
+                                   key=lambda resource: (resource["resourceType"], resource["id"]))
+        assert records["xml"] == records["json"]
+        assert {resource["resourceType"] for resource in records["json"]} == set(RESOURCES)
+        patient = next(resource for resource in records["json"] if resource["resourceType"] == "Patient")
+        assert patient["text"]["div"] == DIV and patient["name"][0]["_given"][1]["id"] == "g1"
+
+
+def test_loads():
+    patient = xmlio.loads("""<?xml version="1.0" encoding="UTF-8"?>
+        <Patient xmlns="http://hl7.org/fhir">
+          <!-- a comment -->
+          <id value="pat-0"/>
+          <text><status value="generated"/>""" + DIV + """</text>
+          <identifier><value value="1"/></identifier>
+          <active value="true"/>
+          <name>
+            <family value="Müller"><extension url="urn:own-prefix"><valueString value="von"/></extension></family>
+            <given value="Anna"/>
+          </name>
+          <name><given value="Anna"/><given id="g1"><extension url="urn:absent"><valueCode value="unknown"/></extension></given></name>
+          <birthDate value="1970-01-01"/>
+          <multipleBirthInteger value="2"/>
+        </Patient>""")
+    assert patient == {
+        "resourceType": "Patient",
+        "id": "pat-0",
+        "text": {"status": "generated", "div": DIV},
+        "identifier": [{"value": "1"}],
+        "active": True,
+        "name": [{"family": "Müller",
+                  "_family": {"extension": [{"url": "urn:own-prefix", "valueString": "von"}]},
+                  "given": ["Anna"]},
+                 {"given": ["Anna", None],
+                  "_given": [None, {"id": "g1", "extension": [{"url": "urn:absent", "valueCode": "unknown"}]}]}],
+        "birthDate": "1970-01-01",
+        "multipleBirthInteger": 2}
+
+
+def test_iter_entries():
+    source = io.BytesIO(b"""<Bundle xmlns="http://hl7.org/fhir">
+          <type value="searchset"/>
+          <total value="3"/>
+          <link><relation value="self"/><url value="http://x/Medication"/></link>
+          <link><relation value="next"/><url value="http://x/Medication?_offset=2"/></link>
+          <entry><resource><Medication><id value="med-0"/></Medication></resource></entry>
+          <entry><resource><Medication><id value="med-1"/>
+            <ingredient><strength><numerator><value value="500"/><unit value="mg"/></numerator></strength></ingredient>
+          </Medication></resource><search><mode value="match"/></search></entry>
+        </Bundle>""")
+    bundle = {}
+    entries = xmlio.iter_entries(source, bundle)
+
+    # the bundle's elements in front of the entries are there before the first entry
+    assert next(entries) == {"resource": {"resourceType": "Medication", "id": "med-0"}}
+    assert bundle == {"resourceType": "Bundle", "type": "searchset", "total": 3,
+                      "link": [{"relation": "self", "url": "http://x/Medication"},
+                               {"relation": "next", "url": "http://x/Medication?_offset=2"}]}
+    assert list(entries) == [{"resource": {"resourceType": "Medication", "id": "med-1",
+                                           "ingredient": [{"strength": {"numerator": {"value": 500, "unit": "mg"}}}]},
+                              "search": {"mode": "match"}}]